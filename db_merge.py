@@ -33,11 +33,34 @@ def main():
 			db.execute("BEGIN")
 
 			for table in tables:
+				if table in ('packets', 'flows') and 'flows' in tables:
+					continue
 				db.execute("INSERT OR IGNORE INTO " + table + " SELECT * FROM dba." + table)
 
+			if 'flows' in tables:
+				merge_flows(db)
+
 			db.commit()
 			db.execute("DETACH DATABASE dba")
 
+FLOW_KEY = ['a_ip', 'a_port', 'b_ip', 'b_port']
+
+def merge_flows(db):
+	"""
+	Copy the packets of dba with their flow ids mapped to the ones in main, matching flows
+	on their addresses and ports.  Flows that main doesn't have yet get new flow ids.
+	"""
+	key = ', '.join(FLOW_KEY)
+	db.execute("INSERT OR IGNORE INTO flows(" + key + ") SELECT " + key + " FROM dba.flows")
+
+	columns = [row[1] for row in db.execute("PRAGMA table_info(packets)")]
+	db.execute(
+		"INSERT INTO packets SELECT " + ', '.join('flows.flow_id' if c == 'flow' else 'p.' + c for c in columns) +
+		" FROM dba.packets AS p JOIN dba.flows AS f ON f.flow_id = p.flow" +
+		" JOIN flows ON " + ' AND '.join('flows.' + k + ' = f.' + k for k in FLOW_KEY) +
+		" ORDER BY p.rowid"
+	)
+
 
 if __name__ == '__main__':
 	main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import socket
 import struct
 import argparse
 from collections import namedtuple
@@ -23,8 +24,17 @@ def fmt(p):
 
 db_fields = "sec, nsec, ip_src, tcp_sport, ip_dst, tcp_dport, ip_len, plen, tcp_csum, pcrc, tcp_flags, tcp_seq, flow"
 Packet = namedtuple('Packet', 'sec nsec src sport dst dport len plen crc pcrc flags seq flow')
+IP = struct.Struct('!I')
+FLOW = struct.Struct('!IHIH')
+class Addresses(dict):
+	"""Dotted forms of the integer addresses in packets, each converted once."""
+	def __missing__(self, ip):
+		self[ip] = address = socket.inet_ntoa(IP.pack(ip))
+		return address
+addresses = Addresses()
 def packet_factory(cursor, row):
-	return Packet(*row)
+	sec, nsec, src, sport, dst, dport, *rest = row
+	return Packet(sec, nsec, addresses[src], sport, addresses[dst], dport, *rest)
 
 def main():
 	args = arguments()
@@ -52,6 +62,8 @@ def main():
 
 	try:
 		db = sql.connect(args.infile)
+		# packets.flow is a flow_id, files are still named after the base64 of the flow's addresses and ports
+		flows = {row[0]: str(b64encode(FLOW.pack(*row[1:])))[2:-1] for row in db.execute('SELECT flow_id, a_ip, a_port, b_ip, b_port FROM flows')}
 		db.row_factory = packet_factory
 		session = (None, None)
 
@@ -91,13 +103,13 @@ order by flow
 				session = (pkt.flow, pkt.seq)
 
 				if debug or not args.quiet:
-					print(f"{pkt.src}:{pkt.sport} => {pkt.dst}:{pkt.dport}  {pkt.flow}  {hex(pkt.seq)[2:]}")
+					print(f"{pkt.src}:{pkt.sport} => {pkt.dst}:{pkt.dport}  {flows[pkt.flow]}  {hex(pkt.seq)[2:]}")
 
 				if writer:
 					f.close()
 
 				seq = str(b64encode(struct.pack('!I', pkt.seq)))[2:-1]
-				fn = f"{pkt.flow}_{seq}.csv".replace('+', '-').replace('/', '_').replace('=', '')
+				fn = f"{flows[pkt.flow]}_{seq}.csv".replace('+', '-').replace('/', '_').replace('=', '')
 				outfile = os.path.join(args.outpath, fn)
 
 				f = open(outfile, 'w')
@@ -2,12 +2,11 @@
 
 import argparse
 import csv
-import struct
 import logging as log
 from binascii import hexlify
 
-from generator.checksum import Checksum
-from pcap.pcap_util import PcapReader, Record
+from generator.checksum import record_payload_checksum
+from pcap.pcap_util import PcapReader
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -95,7 +94,7 @@ def main():
 				pkt['L3'].len,
 				pkt['L3'].len - len(pkt['L3']) - len(pkt['L4']),
 				pkt['L4'].csum,
-				int(payload_checksum(pkt)),
+				record_payload_checksum(pkt),
 			)
 
 			if args.outfile:
@@ -114,23 +113,5 @@ def main():
 		if args.outfile:
 			f.close()
 
-def payload_checksum(pkt: Record):
-	if 'L7' in pkt:
-		return Checksum(bytes(pkt['L7']))
-
-	L4_bytes = bytes(pkt['L4'])
-
-	# IPV4 pseudo header: src, dst, proto, tcp segment length
-	# TCP pseudo header: TCP header without checksum
-	pseudo = bytes(pkt['L3'])[12:20] + struct.pack('!HH', pkt['L3'].proto, pkt['L3'].len - len(pkt['L3']))
-	b = bytes(pkt['L4'])
-
-	if pkt['L4'].type == 'TCP':
-		pseudo += b[0:16] + b[18:]
-	elif pkt['L4'].type == 'UDP':
-		pseudo += b[0:6]
-
-	return Checksum(pkt['L4'].csum) - pseudo
-
 if __name__ == '__main__':
 	main()
@@ -74,8 +74,119 @@ def sum_words(data):
 
     return sum(array.array("H", data))
 
+# The checksum of a TCP or UDP payload backed out of the segment's checksum by taking the IPv4
+# pseudo header and the transport header (without its checksum field) out of it, so the payload
+# needn't have been captured.  data is a buffer with the IPv4 header at ip and the transport
+# header at l4, captured up to end.  The protocol, lengths and checksum are read from data and
+# the words are unpacked from it in place, without building the pseudo header or slicing data.
+def recover_payload_checksum(data, ip, l4, end):
+    proto = data[ip + 9]
+    length = ((data[ip + 2] << 8) | data[ip + 3]) - (data[ip] & 0x0f) * 4
+    csum_at = l4 + (16 if proto == 6 else 6)
+    csum = (data[csum_at] << 8) | data[csum_at + 1]
+
+    # pseudo header: the addresses, then protocol and length as network-endian words (the
+    # byte swap of checksum_endian_transform written out, proto fits in the low byte)
+    s = sum(WORDS[4].unpack_from(data, ip + 12))
+    if NATIVE_BIG_ENDIAN:
+        s += proto + length
+    else:
+        s += (proto << 8) + (((length >> 8) | (length << 8)) & 0xffff)
+
+    # the transport header without its checksum, udp stops at the checksum; sums aren't
+    # folded, so taking the checksum word back out of the whole header's sum is exact
+    if proto == 6 and end >= csum_at + 2:
+        s += sum_range(data, l4, end) - WORDS[1].unpack_from(data, csum_at)[0]
+    else:
+        s += sum_range(data, l4, min(csum_at, end))
+
+    return invert(invert(csum) - s)
+
+# recover_payload_checksum of a pcap_util Record of a TCP or UDP packet over IPv4, read in place
+# from the reader's buffer with the transport header as far as it was captured
+def record_payload_checksum(pkt):
+    L3 = pkt['L3']
+    L4 = pkt['L4']
+    base = pkt.offset
+    l4 = base + L4.offset
+    return recover_payload_checksum(pkt.data, base + L3.offset, l4, min(l4 + L4.len, base + len(pkt)))
+
+# sum_words of data[start:stop], unpacked in place instead of slicing data
+def sum_range(data, start, stop):
+    n = stop - start
+    if n <= 0:
+        return 0
+
+    s = sum(words(n >> 1).unpack_from(data, start))
+    if n & 1:
+        s += data[stop - 1] << 8 if NATIVE_BIG_ENDIAN else data[stop - 1]
+    return s
+
+# Structs unpacking n native-endian words, enough for any IPv4 or TCP header to start with
+WORDS = [struct.Struct(f"={n}H") for n in range(31)]
+def words(n):
+    while n >= len(WORDS):
+        WORDS.append(struct.Struct(f"={len(WORDS)}H"))
+    return WORDS[n]
+
+# RFC 1624 incremental update (eqn. 3):  HC' = ~(~HC + ~m + m')
+# The checksum after a 16-bit word of the checksummed data changed from old to new, in O(1).
+# csum, old and new are network-endian values as read from the header with "!H"; one's
+# complement sums don't depend on byte order, so no swapping is needed.  Unlike eqn. 2 this
+# never turns a checksum into 0x0000 when the true sum is 0xffff (except from an all-zero
+# start), so the result is the checksum a full recomputation would give.
+def update_checksum16(csum, old, new):
+    c = (~csum & 0xffff) + (~old & 0xffff) + (new & 0xffff)
+    c = (c >> 16) + (c & 0xffff)
+    c += c >> 16
+    return ~c & 0xffff
+
+# update_checksum16 for a 32-bit field (an IPv4 address, a sequence number) as two 16-bit words
+def update_checksum32(csum, old, new):
+    csum = update_checksum16(csum, old >> 16, new >> 16)
+    return update_checksum16(csum, old & 0xffff, new & 0xffff)
+
+# sum_words of every segment data[offset:offset+length] at once, as a numpy int64 array.  data is
+# any buffer (bytes, bytearray, mmap); segments may overlap, start at odd offsets and have odd
+# lengths, which are right-padded like sum_words does.  Words are native-endian like array("H"),
+# so the sums can be passed to invert, which works elementwise on numpy arrays too.  Takes time
+# linear in len(data) plus the number of segments, data should hold little besides the segments.
+def sum_segments(data, offsets, lengths):
+    import numpy as np
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    if len(buf) == 0:
+        return np.zeros(len(offsets), dtype=np.int64)
+
+    # running sums of the words starting at even (row 0) and at odd (row 1) byte offsets,
+    # each with a leading 0, a segment's whole words are a difference of two of them
+    prefix = np.zeros((2, len(buf) // 2 + 1), dtype=np.int64)
+    for parity in (0, 1):
+        words = buf[parity:len(buf) - (len(buf) - parity) % 2].view("=u2")
+        np.cumsum(words, out=prefix[parity, 1:len(words) + 1])
+
+    parity = offsets % 2
+    first = offsets // 2
+    sums = prefix[parity, first + lengths // 2] - prefix[parity, first]
+
+    # the last byte of an odd segment, padded with a zero byte on the right
+    tail = lengths % 2 == 1
+    last = buf[offsets[tail] + lengths[tail] - 1].astype(np.int64)
+    sums[tail] += (last << 8) if NATIVE_BIG_ENDIAN else last
+
+    return sums
+
+# checksum of every segment data[offset:offset+length] at once, see sum_segments
+def checksum_segments(data, offsets, lengths):
+    return invert(sum_segments(data, offsets, lengths))
+
+NATIVE_BIG_ENDIAN = struct.pack("H", 1) == b"\x00\x01"
+
 # Swap bytes in 2-byte word if little-endian:  0xABCD -> 0xCDAB
-if struct.pack("H", 1) == b"\x00\x01":  # big endian
+if NATIVE_BIG_ENDIAN:
     checksum_endian_transform = lambda chk: chk
 else:
     checksum_endian_transform = lambda chk: ((chk >> 8) & 0xff) | ((chk & 0xff) << 8)
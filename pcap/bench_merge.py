@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import struct
+import argparse
+import tempfile
+from pcap_util import PcapReader, MmapPcapReader, MergeReader, PcapHeader
+
+def arguments():
+	ap = argparse.ArgumentParser(description='merge throughput of MergeReader and a linear scan as the number of inputs grows')
+	ap.add_argument('--packets', type=int, default=200000, help='total packets across all inputs')
+	ap.add_argument('--inputs', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64], help='numbers of inputs to merge')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the inputs instead of reading them')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+	reader_class = MmapPcapReader if args.mmap else PcapReader
+
+	print(f"{'inputs':>6} {'packets':>9} {'heap pkt/s':>12} {'linear pkt/s':>12}")
+
+	with tempfile.TemporaryDirectory() as directory:
+		for k in args.inputs:
+			infiles = write_inputs(directory, k, args.packets)
+			rates = []
+
+			for merge in (MergeReader, LinearMerge):
+				readers = [reader_class(fn, lazy=True) for fn in infiles]
+				merged = merge(readers)
+
+				start = time.perf_counter()
+				count = sum(1 for _ in merged)
+				rates.append(count / (time.perf_counter() - start))
+
+				merged.close()
+
+			print(f"{k:6d} {count:9d} {rates[0]:12.0f} {rates[1]:12.0f}")
+
+			for fn in infiles:
+				os.remove(fn)
+
+def write_inputs(directory, k, packets):
+	"""k captures of 40-byte IPv4/TCP packets whose timestamps interleave at random."""
+	rnd = random.Random(k)
+	header = bytes(PcapHeader(None, endian='<', linktype=101))
+	packet = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, 6, 0, bytes(4), bytes(4)) + bytes(20)
+	infiles = [os.path.join(directory, f"{k}.{i}.pcap") for i in range(k)]
+	records = [[header] for _ in range(k)]
+	ns = [0] * k
+
+	for _ in range(packets):
+		i = rnd.randrange(k)
+		ns[i] += rnd.randrange(1, 2000) * 1000
+		records[i].append(struct.pack('<IIII', ns[i] // 10**9, ns[i] % 10**9 // 1000, len(packet), len(packet)) + packet)
+
+	for fn, data in zip(infiles, records):
+		with open(fn, 'wb') as f:
+			f.write(b''.join(data))
+
+	return infiles
+
+class LinearMerge:
+	"""The merge MultiReader and DualReader used to do: scan every reader for the minimum timestamp."""
+	def __init__(self, readers):
+		self.readers = [r for r in readers if next(r, None) is not None]
+		self.current = None
+
+	def close(self):
+		for reader in self.readers:
+			reader.close()
+
+	def __iter__(self):
+		return self
+	def __next__(self):
+		if self.current is not None:
+			try:
+				next(self.readers[self.current])
+			except StopIteration:
+				self.readers[self.current].close()
+				del self.readers[self.current]
+
+		self.current = None
+
+		for i, reader in enumerate(self.readers):
+			if self.current is None or reader.record.time < self.readers[self.current].record.time:
+				self.current = i
+
+		if self.current is None:
+			raise StopIteration
+
+		return self.readers[self.current]
+
+if __name__ == '__main__':
+	main()
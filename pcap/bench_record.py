@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import struct
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import pcap_util
+from pcap_util import PcapHeader
+
+def arguments():
+	ap = argparse.ArgumentParser(description='per-packet cost of reading records and looking up their layers')
+	ap.add_argument('--packets', type=int, default=200000)
+	ap.add_argument('--repeat', type=int, default=3, help='best of this many runs')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input instead of reading it')
+	ap.add_argument('--baseline', type=str, help='also time the pcap_util.py at this path or git revision, e.g. 473a3be^ from before Record had __slots__')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+
+	with tempfile.TemporaryDirectory() as directory:
+		fn = write_input(directory, args.packets)
+
+		modules = [pcap_util]
+		if args.baseline is not None:
+			modules.insert(0, load_baseline(directory, args.baseline))
+
+		columns = ['ns/pkt'] if len(modules) == 1 else ['before', 'after', 'after/before']
+		print(f"{'case':>14}" + ''.join(f" {c:>12}" for c in columns))
+
+		for name, lazy, body in CASES:
+			costs = []
+			for module in modules:
+				reader_class = module.MmapPcapReader if args.mmap else module.PcapReader
+				best = None
+				for _ in range(args.repeat):
+					reader = reader_class(fn, lazy=lazy)
+					start = time.perf_counter()
+					body(reader)
+					elapsed = time.perf_counter() - start
+					reader.close()
+					best = elapsed if best is None else min(best, elapsed)
+				costs.append(best / args.packets * 1e9)
+
+			if len(costs) == 2:
+				costs.append(costs[1] / costs[0])
+			print(f"{name:>14}" + ''.join(f" {c:12.0f}" if i < 2 else f" {c:12.2f}" for i, c in enumerate(costs)))
+
+		os.remove(fn)
+
+def load_baseline(directory, baseline):
+	"""pcap_util.py from a path or, failing that, a git revision of this repository, imported as its own module."""
+	if os.path.isfile(baseline):
+		path = baseline
+	else:
+		here = os.path.dirname(os.path.abspath(__file__))
+		path = os.path.join(directory, 'baseline_pcap_util.py')
+		source = subprocess.run(['git', 'show', f"{baseline}:./pcap_util.py"], cwd=here, capture_output=True, check=True).stdout
+		with open(path, 'wb') as f:
+			f.write(source)
+
+	spec = importlib.util.spec_from_file_location('baseline_pcap_util', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+def iterate(reader):
+	for pkt in reader:
+		pass
+
+def times(reader):
+	for pkt in reader:
+		pkt.time.ns
+		pkt.header.incl_len
+
+def contains(reader):
+	for pkt in reader:
+		'tcp' in pkt
+
+def lookups(reader):
+	for pkt in reader:
+		if 'tcp' in pkt:
+			pkt['tcp']; pkt['tcp']; pkt['ip']; pkt['ip']; pkt['L4']
+			pkt['TCP']; pkt['TCP']; pkt['IP']; pkt['IP']; pkt['L3']
+
+def fields(reader):
+	for pkt in reader:
+		if 'tcp' in pkt:
+			ip, tcp = pkt['ip'], pkt['tcp']
+			ip.src, ip.dst, ip.len, tcp.sport, tcp.dport, tcp.flags, tcp.seq
+
+CASES = [
+	('iterate', False, iterate),
+	('lazy iterate', True, iterate),
+	('time', True, times),
+	('lazy contains', True, contains),
+	('lookups', False, lookups),
+	('lazy fields', True, fields),
+	('fields', False, fields),
+]
+
+def write_input(directory, packets):
+	"""A capture of raw IPv4 packets, mostly TCP with some UDP and ICMP."""
+	rnd = random.Random(1)
+	fn = os.path.join(directory, 'records.pcap')
+	records = [bytes(PcapHeader(None, endian='<', linktype=101))]
+
+	for i in range(packets):
+		proto = rnd.choice((6, 6, 6, 6, 6, 6, 17, 17, 1))
+		l4 = {6: struct.pack('!HHIIBBHHH', 1024 + i % 50000, 80, i, 0, 0x50, 0x18, 1000, 0, 0), 17: bytes(8), 1: bytes(8)}[proto]
+		payload = bytes(rnd.randrange(0, 64))
+		ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4) + len(payload), 0, 0, 64, proto, 0, bytes(4), bytes(4))
+		packet = ip + l4 + payload
+		records.append(struct.pack('<IIII', i // 1000, i % 1000 * 1000, len(packet), len(packet)) + packet)
+
+	with open(fn, 'wb') as f:
+		f.write(b''.join(records))
+	return fn
+
+if __name__ == '__main__':
+	main()
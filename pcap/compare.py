@@ -1,38 +1,236 @@
 #!/usr/bin/env python3
 
-import pcap_util
+import os
 import sys
+import mmap
+import struct
+import argparse
 import binascii
+from collections import deque
+from pcap_util import RECORD_HEADER_LEN, PcapHeader, compression, pcap_format, open_reader
 
-infile1 = sys.argv[1]
-infile2 = sys.argv[2]
-
-if (len(sys.argv) >= 4):
-	end=int(sys.argv[3])
-else:
-	end=None
-
-count = 0
-
-
-with pcap_util.PcapReader(infile1) as reader1:
-    print('-------------')
-    with pcap_util.PcapReader(infile2) as reader2:
-        print('-------------')
-        while True:
-            count += 1
-            if end is not None and count > end:
-                break
-
-            try:
-                pkt1 = reader1.next()
-                pkt2 = reader2.next()
-            except StopIteration:
-                break
-
-            if bytes(pkt1) != bytes(pkt2):
-                print(pkt1)
-                print(binascii.hexlify(bytes(pkt1)))
-                print(pkt2)
-                print(binascii.hexlify(bytes(pkt2)))
-                print('-------------')
+BLOCK_SIZE = 1<<20
+
+def arguments():
+	ap = argparse.ArgumentParser(description='diff the records of two pcaps, exits 1 if they differ')
+	ap.add_argument('infile1', type=str)
+	ap.add_argument('infile2', type=str)
+	ap.add_argument('limit', type=int, nargs='?', help='compare at most this many records of each file')
+	ap.add_argument('--window', type=int, default=1000, help='records to look ahead for a match after a difference')
+	ap.add_argument('--ignore_time', action='store_true', help='records that only differ in their timestamp count as equal')
+	ap.add_argument('--quiet', action='store_true', help='only print the summary')
+	ap.add_argument('--verbose', action='store_true', help='print the bytes of records that differ')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input files instead of reading them')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+
+	if args.limit is None:
+		diff_at = first_difference(args.infile1, args.infile2)
+		if diff_at is None:
+			print(f"identical: {args.infile1} {args.infile2}")
+			return
+	else:
+		diff_at = 0
+
+	readers = []
+	report = Report(args)
+
+	try:
+		# records before the first block that differs are identical in both files
+		skip, offset = prefix_records(args.infile1, args.infile2, diff_at)
+
+		for fn in (args.infile1, args.infile2):
+			reader = open_reader(fn, mmap=args.mmap, lazy=True)
+			readers.append(reader)
+			if skip:
+				reader._seek(offset)
+
+		report.equal = skip
+		diff(
+			Records(readers[0], skip, args.limit, args.verbose),
+			Records(readers[1], skip, args.limit, args.verbose),
+			report,
+			args.window
+		)
+
+	except:
+		raise
+	finally:
+		for reader in readers:
+			reader.close()
+
+	report.summary()
+	if report.differences():
+		sys.exit(1)
+
+def first_difference(fn1: str, fn2: str) -> int:
+	"""Offset of the first BLOCK_SIZE block of fn1 and fn2 that differs, None if the files are identical."""
+	same_size = os.path.getsize(fn1) == os.path.getsize(fn2)
+	offset = 0
+
+	with open(fn1, 'rb') as f1, open(fn2, 'rb') as f2:
+		while True:
+			b1 = f1.read(BLOCK_SIZE)
+			b2 = f2.read(BLOCK_SIZE)
+			if b1 != b2:
+				return offset
+			if len(b1) == 0:
+				return None if same_size else offset
+			offset += len(b1)
+
+def prefix_records(fn1: str, fn2: str, end: int):
+	"""
+	Number and end offset of the complete records before end, for two uncompressed
+	classic pcaps that are byte-identical up to end.  Found from the record headers alone.
+	"""
+	if end < 24 + RECORD_HEADER_LEN or any(compression(fn) is not None or pcap_format(fn) != 'pcap' for fn in (fn1, fn2)):
+		return 0, 0
+
+	with open(fn1, 'rb') as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			lengths = struct.Struct(PcapHeader(data[:24]).endian + 'I')
+			n, pos = 0, 24
+			while pos + RECORD_HEADER_LEN <= end:
+				incl_len, = lengths.unpack_from(data, pos + 8)
+				if pos + RECORD_HEADER_LEN + incl_len > end:
+					break
+				n += 1
+				pos += RECORD_HEADER_LEN + incl_len
+		finally:
+			data.close()
+
+	return n, pos
+
+class Records:
+	"""
+	The records of a reader as (index, ns, key, raw) tuples, key a hash of the record
+	lengths and bytes that leaves out the timestamp, raw its bytes when they'll be printed.
+	The bytes are hashed through a memoryview of the reader's buffer, without a copy.
+	"""
+	def __init__(self, reader, start=0, limit=None, keep=False):
+		self.reader = reader
+		self.index = start
+		self.limit = limit
+		self.keep = keep
+	def __iter__(self):
+		return self
+	def __next__(self):
+		if self.limit is not None and self.index >= self.limit:
+			raise StopIteration
+		pkt = next(self.reader)
+		start = pkt.offset + len(pkt.header)
+		body = memoryview(pkt.data)[start:start + pkt.header.incl_len]
+		key = hash((pkt.header.incl_len, pkt.header.orig_len, body))
+		self.index += 1
+		return self.index - 1, pkt.time.ns, key, bytes(body) if self.keep else None
+
+def diff(a: Records, b: Records, report, window: int):
+	"""
+	Walk a and b in step.  At a mismatch, look up to window records ahead in each for the
+	other's record: records skipped over in b were inserted, in a deleted; no match either
+	way and the two records count as modified.
+	"""
+	A, B = deque(), deque()
+
+	def fill(q, it):
+		while len(q) < window:
+			r = next(it, None)
+			if r is None:
+				return
+			q.append(r)
+
+	while True:
+		if not A:
+			fill(A, a)
+		if not B:
+			fill(B, b)
+		if not A or not B:
+			break
+
+		x, y = A[0], B[0]
+		if x[2] == y[2]:
+			if x[1] == y[1]:
+				report.equal += 1
+			else:
+				report.time(x, y)
+			A.popleft()
+			B.popleft()
+			continue
+
+		fill(A, a)
+		fill(B, b)
+		j = next((j for j, r in enumerate(B) if r[2] == x[2]), None)
+		i = next((i for i, r in enumerate(A) if r[2] == y[2]), None)
+
+		if j is not None and (i is None or j <= i):
+			for _ in range(j):
+				report.inserted(B.popleft())
+		elif i is not None:
+			for _ in range(i):
+				report.deleted(A.popleft())
+		else:
+			report.modified(A.popleft(), B.popleft())
+
+	for r in A:
+		report.deleted(r)
+	for r in a:
+		report.deleted(r)
+	for r in B:
+		report.inserted(r)
+	for r in b:
+		report.inserted(r)
+
+class Report:
+	"""Prints differences as they are found, lines start with - deleted, + inserted, ~ modified, t timestamp only."""
+	def __init__(self, args):
+		self.quiet = args.quiet
+		self.verbose = args.verbose
+		self.ignore_time = args.ignore_time
+		self.equal = 0
+		self.n_time = 0
+		self.n_modified = 0
+		self.n_deleted = 0
+		self.n_inserted = 0
+
+	def _print(self, *line):
+		if not self.quiet:
+			print(*line)
+
+	def _bytes(self, r):
+		if self.verbose and not self.quiet:
+			print(binascii.hexlify(r[3]))
+
+	def time(self, x, y):
+		if self.ignore_time:
+			self.equal += 1
+			return
+		self.n_time += 1
+		self._print(f"t {x[0]} {y[0]}  {x[1]} {y[1]}  {y[1] - x[1]:+d}ns")
+
+	def modified(self, x, y):
+		self.n_modified += 1
+		self._print(f"~ {x[0]} {y[0]}  {x[1]} {y[1]}")
+		self._bytes(x)
+		self._bytes(y)
+
+	def deleted(self, x):
+		self.n_deleted += 1
+		self._print(f"- {x[0]}  {x[1]}")
+		self._bytes(x)
+
+	def inserted(self, y):
+		self.n_inserted += 1
+		self._print(f"+ {y[0]}  {y[1]}")
+		self._bytes(y)
+
+	def differences(self) -> int:
+		return self.n_time + self.n_modified + self.n_deleted + self.n_inserted
+
+	def summary(self):
+		print(f"equal: {self.equal}  timestamp only: {self.n_time}  modified: {self.n_modified}  deleted: {self.n_deleted}  inserted: {self.n_inserted}")
+
+if __name__ == '__main__':
+	main()
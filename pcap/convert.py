@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import argparse
+from pcap_util import PcapWriter, PcapngWriter, open_reader
+
+def arguments():
+	ap = argparse.ArgumentParser(description='convert between pcap and pcapng')
+	ap.add_argument('infile', type=str)
+	ap.add_argument('outfile', type=str)
+	ap.add_argument('--format', choices=['pcap', 'pcapng'], help='output format, by default from the outfile extension')
+	ap.add_argument('--nano', action='store_true', help='write ns timestamps even if the input has usec')
+	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
+	ap.add_argument('--readahead', action='store_true', help='read the input ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed input on a background thread or in a child process')
+	ap.add_argument('--filter', type=str, help='only keep packets matching this filter expression, e.g. "tcp and port 80"')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+	pcapng = (args.format or ('pcapng' if args.outfile.endswith('.pcapng') else 'pcap')) == 'pcapng'
+
+	reader = None
+	writer = None
+
+	try:
+		reader = open_reader(args.infile, lazy=True, filter=args.filter, readahead=args.readahead, decompress=args.decompress)
+		writer = (PcapngWriter if pcapng else PcapWriter)(
+			args.outfile,
+			endian=reader.header.endian,
+			nano=args.nano or reader.header.nano,
+			version=reader.header.version,
+			snaplen=reader.header.snaplen,
+			fcs=reader.header.fcs,
+			linktype=reader.header.linktype
+		)
+
+		# each interface of a pcapng input gets its own header, and becomes an interface of the output
+		interfaces = {reader.header: 0}
+
+		for pkt in reader:
+			if pcapng:
+				if reader.header not in interfaces:
+					interfaces[reader.header] = writer.add_interface(
+						nano=args.nano or reader.header.nano,
+						snaplen=reader.header.snaplen,
+						linktype=reader.header.linktype
+					)
+				writer.write_packet(pkt, interface=interfaces[reader.header])
+			else:
+				if reader.header.linktype != writer.header.linktype:
+					raise Exception(f"Packet {reader.count} has linktype {reader.header.linktype}, a pcap can only hold {writer.header.linktype}")
+				if reader.header.nano != writer.header.nano:
+					writer.write_packet(pkt, sec=pkt.time.sec, usec=pkt.time.nsec if writer.header.nano else pkt.time.usec)
+				else:
+					writer.write_packet(pkt)
+
+			if args.checkpoint and reader.count % args.checkpoint == 0:
+				print(reader.count)
+
+	except:
+		raise
+	finally:
+		if reader is not None:
+			reader.close()
+		if writer is not None:
+			writer.close()
+
+
+if __name__ == '__main__':
+	main()
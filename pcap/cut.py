@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-from pcap_util import PcapReader, PcapWriter
+from pcap_util import PcapWriter, Timestamp, first_time, open_reader
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -10,6 +10,12 @@ def arguments():
 	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
 	ap.add_argument('--limit', type=int)
 	ap.add_argument('--seconds', type=float)
+	ap.add_argument('--start', type=float, help='start this many seconds after the first packet, seeking with the .pcapidx index of an uncompressed pcap and reading up to it otherwise')
+	ap.add_argument('--end', type=float, help='stop this many seconds after the first packet')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input file instead of reading it')
+	ap.add_argument('--readahead', action='store_true', help='read the input ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed input on a background thread or in a child process')
+	ap.add_argument('--filter', type=str, help='only keep packets matching this filter expression, e.g. "tcp and port 80"')
 	return ap.parse_args()
 
 def main():
@@ -19,7 +25,17 @@ def main():
 	writer = None
 
 	try:
-		reader = Reader(args.infile, limit=args.limit, seconds=args.seconds)
+		reader = Reader(
+			args.infile,
+			limit=args.limit,
+			seconds=args.seconds,
+			start=args.start,
+			end=args.end,
+			mmap=args.mmap,
+			pcap_filter=args.filter,
+			readahead=args.readahead,
+			decompress=args.decompress
+		)
 		writer = PcapWriter(
 			args.outfile,
 			endian=reader.pcap.header.endian,
@@ -45,14 +61,22 @@ def main():
 			writer.close()
 
 class Reader:
-	def __init__(self, infile, limit=None, seconds=None):
-		self.pcap = PcapReader(infile)
+	def __init__(self, infile, limit=None, seconds=None, start=None, end=None, mmap=False, pcap_filter=None, readahead=False, decompress=None):
+		self.pcap = open_reader(infile, mmap=mmap, lazy=True, filter=pcap_filter, readahead=readahead, decompress=decompress)
 		self.limit = limit
 		self.seconds = seconds
+		self.end = end
+		self.end_ns = None
 
 		self.n_read = 0
 		self.first_ts = None
 
+		if start is not None:
+			first = first_time(infile) or 0
+			self.pcap.seek_time(Timestamp.from_ns(first + Timestamp.from_str(str(start)).ns))
+			if end is not None:
+				self.end_ns = first + Timestamp.from_str(str(end)).ns
+
 	def close(self):
 		self.pcap.close()
 
@@ -66,9 +90,15 @@ class Reader:
 			pkt = self.pcap.next()
 
 			if self.first_ts is None:
-				self.first_ts = float(pkt.time)
+				self.first_ts = pkt.time.ns
+				# without a start the first packet read is the first of the file
+				if self.end is not None and self.end_ns is None:
+					self.end_ns = self.first_ts + Timestamp.from_str(str(self.end)).ns
+
+			if self.seconds and pkt.time.ns - self.first_ts >= self.seconds * 10**9:
+				raise StopIteration
 
-			if self.seconds and (float(pkt.time) - self.first_ts) >= self.seconds:
+			if self.end_ns is not None and pkt.time.ns >= self.end_ns:
 				raise StopIteration
 		except:
 			self.close()
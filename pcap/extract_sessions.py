@@ -2,8 +2,9 @@
 
 import os
 import argparse
+from collections import OrderedDict
 from pcap_util import PcapReader, PcapWriter
-from tcp_util import Flow, is_syn_pkt
+from tcp_util import Flow, TCP_FLAGS, is_syn_pkt
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -12,13 +13,15 @@ def arguments():
 	ap.add_argument('--quiet', action='store_true')
 	ap.add_argument('--limit', type=int)
 	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
+	ap.add_argument('--max_open', type=int, default=512, help='session files kept open at once, the least recently written is closed first')
+	ap.add_argument('--buffer_size', type=int, default=16384, help='bytes buffered per open session file')
 	return ap.parse_args()
 
 def main():
 	args = arguments()
 
 	reader = None
-	writer = None
+	pool = None
 	count = 0
 
 	sessions = {}
@@ -26,15 +29,15 @@ def main():
 
 	try:
 		reader = PcapReader(args.infile)
-		writer = PcapWriter(
-			None,
+		pool = WriterPool(
+			max_open=args.max_open,
+			buffer_size=args.buffer_size,
 			endian=reader.header.endian,
 			nano=reader.header.nano,
 			version=reader.header.version,
 			snaplen=reader.header.snaplen,
 			fcs=reader.header.fcs,
-			linktype=reader.header.linktype,
-			append=True,
+			linktype=reader.header.linktype
 		)
 
 		for pkt in reader:
@@ -42,6 +45,10 @@ def main():
 			if args.limit and count > args.limit:
 				break
 
+			# sessions start with a SYN, only tcp packets can belong to one
+			if 'TCP' not in pkt:
+				continue
+
 			flow = Flow(pkt)
 
 			if is_syn_pkt(pkt): # and flow not in sessions:
@@ -52,10 +59,16 @@ def main():
 				if not args.quiet:
 					print(sessions[flow], pkt)
 				addr = flow.ordered
-				writer.fn = os.path.join(args.outpath, f"{addr[0].ip}:{addr[0].port}_{addr[1].ip}:{addr[1].port}.pcap")
-				writer.open()
-				writer.write_packet(pkt)
-				writer.close()
+				fn = os.path.join(args.outpath, f"{addr[0].ip}:{addr[0].port}_{addr[1].ip}:{addr[1].port}.pcap")
+				pool.get(fn).write_packet(pkt)
+
+				# the session is ending: a reset closes its file, a FIN puts it first in line
+				# to be closed, as the ACKs that usually follow it would only reopen the file
+				flags = pkt['TCP'].flags
+				if flags & TCP_FLAGS['R']:
+					pool.close(fn)
+				elif flags & TCP_FLAGS['F']:
+					pool.release(fn)
 
 			if args.checkpoint and count % args.checkpoint == 0:
 				print(count)
@@ -64,7 +77,48 @@ def main():
 	finally:
 		if reader is not None:
 			reader.close()
+		if pool is not None:
+			pool.close_all()
+
+class WriterPool:
+	"""
+	PcapWriters for session files, at most max_open of them open at once.  Writing to one
+	more closes the least recently written, flushing its buffer; its session file is
+	reopened in append mode if the session has more packets.
+	"""
+	def __init__(self, max_open=512, buffer_size=16384, **kwargs):
+		self.max_open = max_open
+		self.buffer_size = buffer_size
+		self.kwargs = kwargs
+		self.writers = OrderedDict()
+
+	def get(self, fn: str) -> PcapWriter:
+		writer = self.writers.get(fn)
 		if writer is not None:
+			self.writers.move_to_end(fn)
+			return writer
+
+		if len(self.writers) >= self.max_open:
+			_, lru = self.writers.popitem(last=False)
+			lru.close()
+
+		writer = PcapWriter(fn, append=True, buffer_size=self.buffer_size, **self.kwargs)
+		self.writers[fn] = writer
+		return writer
+
+	def release(self, fn: str):
+		"""Make fn the next to be closed, unless it is written to again first."""
+		if fn in self.writers:
+			self.writers.move_to_end(fn, last=False)
+
+	def close(self, fn: str):
+		writer = self.writers.pop(fn, None)
+		if writer is not None:
+			writer.close()
+
+	def close_all(self):
+		while self.writers:
+			_, writer = self.writers.popitem(last=False)
 			writer.close()
 
 if __name__ == '__main__':
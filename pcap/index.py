@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import argparse
+from pcap_util import INDEX_INTERVAL, Timestamp, build_index, index_path, load_index
+
+def arguments():
+	ap = argparse.ArgumentParser(description='build the .pcapidx sidecar index used to seek by time')
+	ap.add_argument('infiles', type=str, nargs='+')
+	ap.add_argument('--interval', type=int, default=INDEX_INTERVAL, help='index every X records')
+	ap.add_argument('--force', action='store_true', help='rebuild indexes that are up to date')
+	ap.add_argument('--find', type=float, help='print the offset of the first record at or after this many seconds from the start')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+
+	for fn in args.infiles:
+		index = None if args.force else load_index(fn)
+
+		if index is None or index.interval != args.interval:
+			index = build_index(fn, args.interval)
+			print(f"{index_path(fn)}: {index.n_records} records, {len(index.offsets)} entries")
+		else:
+			print(f"{index_path(fn)}: up to date")
+
+		if args.find is not None and index.first is not None:
+			ns = index.first + Timestamp.from_str(str(args.find)).ns
+			print(f"  {Timestamp.from_ns(ns)} at offset {index.find(ns)}")
+
+
+if __name__ == '__main__':
+	main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-from pcap_util import PcapReader, PcapWriter, Record
+from pcap_util import MergeReader, PcapWriter, Record, open_reader
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -12,6 +12,10 @@ def arguments():
 	ap.add_argument('--seconds', type=float)
 	ap.add_argument('--smallest', action='store_true')
 	ap.add_argument('--scapy', action='store_true')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input files instead of reading them')
+	ap.add_argument('--readahead', action='store_true', help='read the inputs ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed inputs on a background thread or in a child process')
+	ap.add_argument('--filter', type=str, help='only keep packets matching this filter expression, e.g. "tcp and port 80"')
 	return ap.parse_args()
 
 def main():
@@ -25,7 +29,11 @@ def main():
 			limit=args.limit,
 			seconds=args.seconds,
 			stop_smallest=args.smallest,
-			scapy=args.scapy
+			scapy=args.scapy,
+			mmap=args.mmap,
+			pcap_filter=args.filter,
+			readahead=args.readahead,
+			decompress=args.decompress
 		)
 
 		writer = PcapWriter(
@@ -53,8 +61,11 @@ def main():
 			writer.close()
 
 class DualReader:
-	def __init__(self, infiles, limit=None, seconds=None, stop_smallest=False, scapy=False):
-		self.readers = [PcapReader(fn) for fn in infiles]
+	def __init__(self, infiles, limit=None, seconds=None, stop_smallest=False, scapy=False, mmap=False, pcap_filter=None, readahead=False, decompress=None):
+		self.readers = [
+			open_reader(fn, mmap=mmap, lazy=True, filter=pcap_filter, readahead=readahead, decompress=decompress)
+			for fn in infiles
+		]
 		self.header = self.readers[0].header
 
 		self.limit = limit
@@ -63,18 +74,11 @@ class DualReader:
 
 		self.n_read = 0
 		self.first_ts = None
-		self.min_index = None
 
-		try:
-			for reader in self.readers:
-				reader.next()
-		except StopIteration:
-			raise Exception(f"File {reader.fn} is empty, aborting.")
+		self.merge = MergeReader(self.readers, stop_smallest=stop_smallest)
 
 	def close(self):
-		for reader in self.readers:
-			if reader is not None:
-				reader.close()
+		self.merge.close()
 
 	def __iter__(self):
 		return self
@@ -83,32 +87,12 @@ class DualReader:
 			if self.limit is not None and self.n_read >= self.limit:
 				raise StopIteration
 
-			if self.min_index is not None:
-				try:
-					self.readers[self.min_index].next()
-				except StopIteration:
-					if self.stop_smallest:
-						raise
-
-					self.readers[self.min_index].close()
-					self.readers[self.min_index] = None
-					self.readers = [r for r in self.readers if r is not None]
-
-				self.min_index = None
-
-			for i, reader in enumerate(self.readers):
-				if self.min_index is None or reader.record.time < self.readers[self.min_index].record.time:
-					self.min_index = i
-
-			if self.min_index is None:
-				raise StopIteration
-
-			record: Record = self.readers[self.min_index].record
+			record: Record = next(self.merge).record
 
 			if self.first_ts is None:
-				self.first_ts = float(record.time)
+				self.first_ts = record.time.ns
 
-			if self.seconds is not None and (float(record.time) - self.first_ts) >= self.seconds:
+			if self.seconds is not None and record.time.ns - self.first_ts >= self.seconds * 10**9:
 				raise StopIteration
 		except:
 			self.close()
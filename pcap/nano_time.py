@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
+import mmap
+import array
+import struct
 import argparse
-from pcap_util import PcapReader, PcapWriter
+from pcap_util import PcapHeader, PcapWriter, RECORD_HEADER_LEN, TIMES_BLOCK, compression, pcap_format, pcap_stem, open_reader, open_times
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -9,24 +12,45 @@ def arguments():
 	ap.add_argument('--limit_in', type=int)
 	ap.add_argument('--limit_out', type=int)
 	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
-	ap.add_argument('--proto', choices=['tcp', 'udp', 'icmp', 'all'], default='tcp')
-	return ap.parse_args()
+	ap.add_argument('--proto', choices=['tcp', 'udp', 'icmp', 'all'], help='packets to copy (default tcp)')
+	ap.add_argument('--inplace', action='store_true', help='rewrite the timestamps of infile in place instead of writing a filtered copy')
+	ap.add_argument('--filter', type=str, help='only keep packets matching this filter expression, e.g. "dst port 443"')
+	ap.add_argument('--readahead', action='store_true', help='read the input ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed input on a background thread or in a child process')
+	args = ap.parse_args()
+	if args.inplace and (args.proto or args.filter or args.limit_in is not None or args.limit_out is not None):
+		ap.error('--inplace rewrites every record, it can\'t be combined with --proto, --filter or limits')
+	args.proto = args.proto or 'tcp'
+	return args
 
 def main():
 	args = arguments()
 
+	if args.inplace:
+		times = open_times(args.infile)
+		try:
+			n = rewrite(args.infile, times)
+		finally:
+			if times is not None:
+				times.close()
+		print(f"{args.infile}: rewrote {n} timestamps")
+		return
+
 	reader = None
 	writer = None
 
 	try:
+		proto = 'ip' if args.proto == 'all' else args.proto
 		reader = Reader(
 			args.infile,
-			filter=lambda p: 'IP' in p and (args.proto == 'all' or args.proto in p),
+			pcap_filter=proto if args.filter is None else f'{proto} and ({args.filter})',
 			limit_in=args.limit_in,
-			limit_out=args.limit_out
+			limit_out=args.limit_out,
+			readahead=args.readahead,
+			decompress=args.decompress
 		)
 
-		outfile = f"{args.infile.rsplit('.', 1)[0]}.{args.proto}{'.nano' if reader.nano else ''}.pcap"
+		outfile = f"{pcap_stem(args.infile)}.{args.proto}{'.nano' if reader.nano else ''}.pcap"
 		writer = PcapWriter(
 			outfile,
 			endian=reader.pcap.header.endian,
@@ -54,20 +78,102 @@ def main():
 			writer.flush()
 			writer.close()
 
+def rewrite(fn, times=None):
+	"""
+	Give every record of the pcap fn its time from times, or its own time in ns without
+	them, and mark fn as nano.  Only the magic number and the 8 timestamp bytes of each
+	record header are written, in place through a shared mmap; packet bodies are left alone.
+	With numpy the timestamps are written a block of records at a time.  Returns the number
+	of records.
+	"""
+	if compression(fn) is not None or pcap_format(fn) != 'pcap':
+		raise ValueError(f"{fn} must be an uncompressed classic pcap to be rewritten in place")
+
+	try:
+		import numpy
+	except ImportError:
+		numpy = None
+
+	with open(fn, 'r+b') as f:
+		data = mmap.mmap(f.fileno(), 0)
+
+		try:
+			header = PcapHeader(data[:24])
+
+			# find the records first, so a short times file fails before anything is changed
+			offsets = array.array('Q', records(data, header))
+			n = len(offsets)
+			if times is not None and times.count() < n:
+				raise ValueError(f"{times.fn} has {times.count()} times, {fn} has {n} records")
+
+			if numpy is not None:
+				rewrite_blocks(numpy, data, header, offsets, times)
+			else:
+				timestamp = struct.Struct(header.endian + 'II')
+				scale = 1 if header.nano else 1000
+				for k, pos in enumerate(offsets):
+					if times is not None:
+						ns = times[k]
+					else:
+						sec, frac = timestamp.unpack_from(data, pos)
+						ns = sec * 1000000000 + frac * scale
+					timestamp.pack_into(data, pos, *divmod(ns, 1000000000))
+
+			# the magic last, so an interrupted rewrite doesn't claim to be nano
+			data[:4] = PcapHeader(None, endian=header.endian, nano=True).magic
+			data.flush()
+		finally:
+			data.close()
+
+	return n
+
+def rewrite_blocks(np, data, header, offsets, times=None):
+	"""rewrite with numpy: gather and scatter the timestamp bytes of TIMES_BLOCK records at a time."""
+	buf = np.frombuffer(data, dtype=np.uint8)
+	stamp = np.arange(8, dtype=np.int64)
+	u32 = np.dtype(header.endian + 'u4')
+
+	try:
+		for start in range(0, len(offsets), TIMES_BLOCK):
+			pos = np.frombuffer(offsets, dtype=np.uint64)[start:start + TIMES_BLOCK].astype(np.int64)[:, None] + stamp
+			if times is not None:
+				sec, nsec = np.divmod(times.array(start, start + len(pos)), np.uint64(1000000000))
+			else:
+				sec, frac = buf[pos].copy().view(u32).T
+				nsec = frac if header.nano else frac * np.uint32(1000)
+			out = np.empty((len(pos), 2), dtype=u32)
+			out[:, 0] = sec
+			out[:, 1] = nsec
+			buf[pos] = out.view(np.uint8).reshape(-1, 8)
+	finally:
+		# the mmap can't be closed while numpy holds its buffer
+		del buf
+
+def records(data, header):
+	"""Offsets of the complete records in a pcap held in data."""
+	lengths = struct.Struct(header.endian + 'I')
+	pos = len(header)
+
+	while pos + RECORD_HEADER_LEN <= len(data):
+		incl_len, = lengths.unpack_from(data, pos + 8)
+		if pos + RECORD_HEADER_LEN + incl_len > len(data):
+			return
+		yield pos
+		pos += RECORD_HEADER_LEN + incl_len
+
 class Reader:
-	def __init__(self, fn, filter=lambda p: True, limit_in=None, limit_out=None):
-		self.pcap = PcapReader(fn)
+	def __init__(self, fn, filter=lambda p: True, limit_in=None, limit_out=None, pcap_filter=None, readahead=False, decompress=None):
+		self.pcap = open_reader(fn, lazy=True, filter=pcap_filter, readahead=readahead, decompress=decompress)
 		self.nano = self.pcap.header.nano
-		try:
-			self.times = open(fn.rsplit('.', 1)[0] + '.times')
+		self.times = open_times(fn)
+		if self.times:
 			self.nano = True
-		except:
-			self.times = None
 		self.filter = filter
 		self.limit_in = limit_in
 		self.limit_out = limit_out
 		self.n_read = 0
 		self.n_out = 0
+		self.n_skipped = 0
 	def close(self):
 		self.pcap.close()
 		if self.times:
@@ -84,17 +190,23 @@ class Reader:
 					raise StopIteration
 
 				pkt = next(self.pcap)
-				self.n_read += 1
+
+				# records the reader's filter skipped still count, times are indexed by record number
+				skipped = self.pcap.n_skipped - self.n_skipped
+				self.n_skipped = self.pcap.n_skipped
+				self.n_read += 1 + skipped
+
+				if self.limit_in is not None and self.n_read > self.limit_in:
+					raise StopIteration
 
 				if self.times:
-					ts = self.times.readline()
+					ns = self.times[self.pcap.count + self.pcap.n_skipped - 1]
 
 				if self.filter(pkt):
 					break
 
 			if self.times:
-				sec, usec = ts.strip().split('.', 1)
-				sec, usec = int(sec), int(usec)
+				sec, usec = divmod(ns, 1000000000)
 			else:
 				sec = pkt.time.sec
 				usec = pkt.time.nsec if self.nano else pkt.header.ts_usec
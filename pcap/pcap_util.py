@@ -1,15 +1,86 @@
 import binascii
 import struct
+import array
+import bisect
 import socket
 import functools
+import heapq
+import mmap
 import os
-from decimal import Decimal
+import re
+import io
+import sys
+import queue
+import threading
+import subprocess
+import shutil
+import gzip
+import bz2
+import lzma
+import logging as log
 
 RECORD_HEADER_LEN = 16
 CHUNK_SIZE = 65535
+BATCH_SIZE = 65536
+BATCH_CHUNK_SIZE = 1 << 20
+READAHEAD_BLOCK_SIZE = 1 << 20
+READAHEAD_BLOCKS = 4
+DECOMPRESS_BLOCK_SIZE = 1 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+# compression formats by magic bytes, with the command that decompresses each to stdout
+COMPRESSION_MAGIC = {b'\x1f\x8b': 'gzip', b'BZh': 'bz2', b'\xfd7zXZ\x00': 'xz', b'\x28\xb5\x2f\xfd': 'zstd'}
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+DECOMPRESS_COMMANDS = {'gzip': ['gzip', '-dc'], 'bz2': ['bzip2', '-dc'], 'xz': ['xz', '-dc'], 'zstd': ['zstd', '-dcq']}
+
+# pcapng block types, and the header lengths of the blocks holding packets
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 1
+PCAPNG_PB = 2
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+PCAPNG_PACKET_HEADER_LEN = 28
+PCAPNG_SPB_HEADER_LEN = 12
+# the largest snaplen libpcap writes, standing in for pcapng's 0 (no limit)
+MAX_SNAPLEN = 262144
+
+# .pcapidx sidecars: an entry every INDEX_INTERVAL records
+INDEX_MAGIC = b'PCAPIDX1'
+INDEX_HEADER = struct.Struct('<IQqqQQQ')
+INDEX_INTERVAL = 1024
+INT64_MIN = -1 << 63
+
+# binary .times sidecars: the magic, then one little-endian uint64 ns per record
+TIMES_MAGIC = b'NSTIMES1'
+TIMES_BLOCK = 65536
+
+# L2 header length by linktype, matching L2HeaderView
+L2_LEN = {1: 14, 101: 0, 113: 16}
+# L4 layer name by IP protocol, matching L4HeaderView
+L4_TYPES = {6: 'tcp', 17: 'udp', 1: 'icmp'}
+# the fixed header fields unpacked by L3HeaderView (after the version byte) and L4HeaderView
+IP_FIELDS = struct.Struct('!BHHHBBH')
+TCP_FIELDS = struct.Struct('!HHIIBBHHH')
+UDP_FIELDS = struct.Struct('!HHHH')
+ICMP_FIELDS = struct.Struct('!BBH')
+
+# columns produced by decode_batch, numpy dtype strings so numpy is only needed for batches
+BATCH_FIELDS = [
+	('offset', 'i8'), ('sec', 'u4'), ('nsec', 'u4'), ('incl_len', 'u4'), ('orig_len', 'u4'),
+	('l3_valid', '?'), ('ip_version', 'u1'), ('ip_hl', 'u1'), ('ip_tos', 'u1'), ('ip_len', 'u2'),
+	('ip_id', 'u2'), ('ip_off', 'u2'), ('ip_ttl', 'u1'), ('ip_proto', 'u1'), ('ip_csum', 'u2'),
+	('ip_src', 'u4'), ('ip_dst', 'u4'),
+	('l4_valid', '?'), ('sport', 'u2'), ('dport', 'u2'), ('tcp_seq', 'u4'), ('tcp_ack', 'u4'),
+	('tcp_len', 'u1'), ('tcp_flags', 'u2'), ('tcp_win', 'u2'), ('l4_csum', 'u2'), ('tcp_urgent', 'u2'),
+	('udp_len', 'u2'), ('icmp_type', 'u1'), ('icmp_code', 'u1'),
+]
 
 class LayerException(Exception):
 	pass
+class FilterException(Exception):
+	pass
 class UnknownL3Exception(LayerException):
 	pass
 class UnknownL4Exception(LayerException):
@@ -19,6 +90,8 @@ class PcapHeader:
 	def __init__(self, data: bytes, **kwargs):
 		if data:
 			magic = data[:4]
+			if magic == PCAPNG_MAGIC:
+				raise ValueError("This is a pcapng file, read it with PcapngReader")
 			self.endian = '>' if magic[0] == 0xA1 else '<'
 			self.nano = magic[0 if self.endian == '<' else 3] == 0x4D
 
@@ -69,6 +142,176 @@ linktype: {self.linktype}"""
 		)
 		return bytes(b)
 
+class ReadaheadFile:
+	"""
+	Wraps a binary file, reading it block_size bytes at a time on a background thread
+	into a ring of n_blocks buffers so reads overlap with whatever the caller does with
+	the data.  Only read() is supported.
+	"""
+	def __init__(self, f, block_size: int = READAHEAD_BLOCK_SIZE, n_blocks: int = READAHEAD_BLOCKS):
+		self.f = f
+		self.free = queue.Queue()
+		self.filled = queue.Queue()
+		self.stop = False
+		self.eof = False
+
+		for _ in range(n_blocks):
+			self.free.put(bytearray(block_size))
+
+		# block being read from
+		self.block = None
+		self.view = memoryview(b'')
+		self.pos = 0
+
+		self.thread = threading.Thread(target=self._fill, daemon=True)
+		self.thread.start()
+
+	def _fill(self):
+		try:
+			while True:
+				block = self.free.get()
+				if block is None or self.stop:
+					return
+
+				n = self.f.readinto(block)
+				self.filled.put((block, n))
+
+				if n == 0:
+					return
+		except Exception as e: # handed to the reader
+			self.filled.put(e)
+
+	def _next_block(self):
+		# the current block has been copied out, hand it back to be refilled
+		if self.block is not None:
+			self.view.release()
+			self.free.put(self.block)
+
+		item = self.filled.get()
+		if isinstance(item, Exception):
+			raise item
+
+		self.block, n = item
+		self.view = memoryview(self.block)[:n]
+		self.pos = 0
+		self.eof = n == 0
+
+	def read(self, n: int = -1) -> bytes:
+		chunks = []
+
+		while n != 0 and not self.eof:
+			if self.pos == len(self.view):
+				if len(chunks) > 0:
+					chunks[-1] = bytes(chunks[-1]) # copy out before the block is reused
+				self._next_block()
+				continue
+
+			take = len(self.view) - self.pos if n < 0 else min(n, len(self.view) - self.pos)
+			chunks.append(self.view[self.pos:self.pos + take])
+			self.pos += take
+			if n > 0:
+				n -= take
+
+		return b''.join(chunks)
+
+	def close(self):
+		if self.thread is not None:
+			self.stop = True
+			self.free.put(None) # wake the thread if it's waiting for a free block
+			self.thread.join()
+			self.thread = None
+		self.f.close()
+
+def compression(fn: str):
+	"""The compression format of fn from its magic bytes ('gzip', 'bz2', 'xz' or 'zstd'), None if it isn't compressed."""
+	with open(fn, 'rb') as f:
+		magic = f.read(6)
+	return next((kind for prefix, kind in COMPRESSION_MAGIC.items() if magic.startswith(prefix)), None)
+
+def pcap_stem(fn: str) -> str:
+	"""fn without its extension and compression suffix, e.g. traces/a.pcap.gz -> traces/a"""
+	for suffix in COMPRESSION_SUFFIXES:
+		if fn.endswith(suffix):
+			fn = fn[:-len(suffix)]
+			break
+	return fn.rsplit('.', 1)[0]
+
+def open_pcap(fn: str, decompress: str = None):
+	"""
+	Open fn for reading, decompressing it on the fly if it is gzip, bz2, xz or zstd
+	compressed.  decompress is where that happens: None in the reading thread, 'thread' on a
+	background thread and 'process' in a child process feeding a pipe.  zstd needs the
+	zstandard module or else the zstd command, run in a child process.
+	"""
+	if decompress not in (None, 'thread', 'process'):
+		raise ValueError(f"Unknown decompress mode '{decompress}'")
+
+	kind = compression(fn)
+
+	if kind is None:
+		return open(fn, 'rb')
+	if decompress == 'process':
+		return DecompressProcess(fn, kind)
+
+	if kind == 'zstd':
+		try:
+			import zstandard
+		except ImportError:
+			if shutil.which('zstd') is None:
+				raise ImportError(f"Reading {fn} needs the zstandard module or the zstd command")
+			return DecompressProcess(fn, kind)
+		stream = zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb'))
+	else:
+		stream = {'gzip': gzip, 'bz2': bz2, 'xz': lzma}[kind].open(fn, 'rb')
+
+	# the readers ask for one record at a time, decompress in big blocks underneath
+	stream = io.BufferedReader(stream, buffer_size=DECOMPRESS_BLOCK_SIZE)
+	return ReadaheadFile(stream) if decompress == 'thread' else stream
+
+class DecompressProcess:
+	"""
+	Decompresses fn in a child process and reads the output from a pipe.  The child is
+	the format's own command if it is installed, else Python with the matching module.
+	"""
+	def __init__(self, fn: str, kind: str):
+		self.fn = fn
+		command = DECOMPRESS_COMMANDS[kind]
+
+		if shutil.which(command[0]) is None:
+			if kind == 'zstd':
+				opener = "zstandard.ZstdDecompressor().stream_reader(open(sys.argv[1], 'rb'))"
+				module = 'zstandard'
+			else:
+				module = {'gzip': 'gzip', 'bz2': 'bz2', 'xz': 'lzma'}[kind]
+				opener = f"{module}.open(sys.argv[1], 'rb')"
+			command = [sys.executable, '-c', f"import sys, shutil, {module}; shutil.copyfileobj({opener}, sys.stdout.buffer, {DECOMPRESS_BLOCK_SIZE})"]
+
+		self.proc = subprocess.Popen(command + [fn], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=DECOMPRESS_BLOCK_SIZE)
+
+	def _check(self):
+		# at the end of the output: make sure it ended because the input did
+		if self.proc.wait() != 0:
+			raise OSError(f"Decompressing {self.fn} failed: {self.proc.stderr.read().decode().strip()}")
+
+	def read(self, n: int = -1) -> bytes:
+		data = self.proc.stdout.read(n)
+		if len(data) == 0 and n != 0:
+			self._check()
+		return data
+
+	def readinto(self, b) -> int:
+		n = self.proc.stdout.readinto(b)
+		if n == 0 and len(b) > 0:
+			self._check()
+		return n
+
+	def close(self):
+		self.proc.stdout.close()
+		if self.proc.poll() is None:
+			self.proc.terminate()
+		self.proc.wait()
+		self.proc.stderr.close()
+
 class Pcap:
 	def __init__(self, fn: str):
 		self.fn = fn
@@ -86,10 +329,18 @@ class Pcap:
 		self.close()
 
 class PcapWriter(Pcap):
-	def __init__(self, fn: str, append=False, sync=False, **kwargs):
+	"""
+	Writes records to a pcap.  Each record is copied once, straight from the reader's buffer
+	into a preallocated bytearray of buffer_size bytes, with sec/usec overrides packed in
+	place, and the bytearray goes to the file whenever it fills up, on flush and on close.
+	With buffer_size=0 every record is written as it comes; sync flushes after every one.
+	"""
+	def __init__(self, fn: str, append=False, sync=False, buffer_size: int = WRITE_BUFFER_SIZE, **kwargs):
 		super().__init__(fn)
 		self.append = append
 		self.sync = sync
+		self.out = bytearray(buffer_size)
+		self.used = 0
 		self.header = PcapHeader(None, **kwargs)
 	@property
 	def header(self) -> PcapHeader:
@@ -107,13 +358,35 @@ class PcapWriter(Pcap):
 	def write(self, b):
 		if self.f is None:
 			self.open()
-		self.f.write(b)
-		self.len += len(b)
-		if self.sync:
-			self.flush()
+		out, pos = self._space(len(b))
+		out[pos:pos + len(b)] = b
+		self._done(out, len(b))
 	def flush(self):
 		if self.f:
+			if self.used > 0:
+				self.f.write(memoryview(self.out)[:self.used])
+				self.used = 0
 			self.f.flush()
+
+	def _space(self, n: int):
+		# where to put the next n bytes: the end of the buffer, written out first if they
+		# don't fit, or a bytearray of their own if they are bigger than the whole buffer
+		if self.used + n > len(self.out):
+			if self.used > 0:
+				self.f.write(memoryview(self.out)[:self.used])
+				self.used = 0
+			if n > len(self.out):
+				return bytearray(n), 0
+
+		pos = self.used
+		self.used += n
+		return self.out, pos
+	def _done(self, out, n: int):
+		if out is not self.out:
+			self.f.write(out)
+		self.len += n
+		if self.sync:
+			self.flush()
 	def close(self):
 		self.flush()
 		super().close()
@@ -121,27 +394,147 @@ class PcapWriter(Pcap):
 		b = bytes(self.header)
 		self.write(b)
 	def write_packet(self, pkt, **kwargs):
+		if self.f is None:
+			self.open()
 		if self.len == 0:
 			self.write_header()
 
-		b = bytes(pkt)
+		# data: packet bytes to write in place of pkt's, e.g. rewritten ones, the same length
+		data = kwargs.get('data')
+		if data is not None and len(data) != pkt.header.incl_len:
+			raise ValueError(f"data is {len(data)} bytes, the record has {pkt.header.incl_len}")
 
-		if 'sec' in kwargs or 'usec' in kwargs:
-			b = struct.pack(
-				pkt.endian + 'II',
-				kwargs.get('sec', pkt.header.ts_sec),
-				kwargs.get('usec', pkt.header.ts_usec)
-			) + b[8:]
+		n = RECORD_HEADER_LEN + pkt.header.incl_len
+		pos = self.used
+		if pos + n <= len(self.out):
+			out = self.out
+			self.used = pos + n
+		else:
+			out, pos = self._space(n)
+
+		# a memoryview slice when the reader's buffer is one (mmap), so the only copy is into out
+		if len(pkt.header) == RECORD_HEADER_LEN:
+			out[pos:pos + n] = pkt.data[pkt.offset:pkt.offset + n]
+
+			if 'sec' in kwargs or 'usec' in kwargs:
+				struct.pack_into(
+					pkt.endian + 'II', out, pos,
+					kwargs.get('sec', pkt.header.ts_sec),
+					kwargs.get('usec', pkt.header.ts_usec)
+				)
+		else:
+			# a pcapng record: give the packet a classic record header
+			sec, usec = divmod(pkt.time.ns, 10**9)
+			if not self.header.nano:
+				usec //= 1000
+			struct.pack_into(
+				self.header.endian + 'IIII', out, pos,
+				kwargs.get('sec', sec),
+				kwargs.get('usec', usec),
+				pkt.header.incl_len,
+				pkt.header.orig_len
+			)
+			start = pkt.offset + len(pkt.header)
+			out[pos + RECORD_HEADER_LEN:pos + n] = pkt.data[start:start + pkt.header.incl_len]
+
+		if data is not None:
+			out[pos + RECORD_HEADER_LEN:pos + n] = data
+
+		if out is self.out and not self.sync:
+			self.len += n
+		else:
+			self._done(out, n)
+		self.count += 1
 
-		self.write(b)
+class PcapngWriter(PcapWriter):
+	"""
+	Writes records as a pcapng file: one section with interface 0 described by the
+	PcapHeader kwargs, plus any added with add_interface, and one Enhanced Packet Block per
+	record.  Timestamps are written in ns for nano interfaces, else in usec.  With append a
+	new section is added to the end of an existing file.
+	"""
+	def __init__(self, fn: str, append=False, sync=False, **kwargs):
+		super().__init__(fn, append=append, sync=sync, **kwargs)
+		self.interfaces = [self.header]
+		self.n_described = 0
+		self.epb = struct.Struct(self.header.endian + 'IIIIIII')
+		self.trailer = struct.Struct(self.header.endian + 'I')
+
+	def add_interface(self, **kwargs) -> int:
+		"""Describe another interface from PcapHeader kwargs and return its id for write_packet."""
+		kwargs['endian'] = self.header.endian
+		self.interfaces.append(PcapHeader(None, **kwargs))
+		return len(self.interfaces) - 1
+
+	def write_header(self, _dummy=None):
+		# section header: byte-order magic, version 1.0, unknown section length, no options
+		self.write(struct.pack(self.header.endian + 'IIIHHqI', PCAPNG_SHB, 28, PCAPNG_BYTE_ORDER, 1, 0, -1, 28))
+		self.n_described = 0
+
+	def write_interfaces(self, n: int):
+		# interface descriptions only have to come before the first packet that uses them
+		endian = self.header.endian
+
+		for header in self.interfaces[self.n_described:n]:
+			# if_tsresol 9 for ns, the default of 6 otherwise
+			options = struct.pack(endian + 'HHB3x', 9, 1, 9) if header.nano else b''
+			options += struct.pack(endian + 'HH', 0, 0)
+			length = 20 + len(options)
+			self.write(struct.pack(endian + 'IIHHI', PCAPNG_IDB, length, header.linktype, 0, header.snaplen) + options + struct.pack(endian + 'I', length))
+
+		self.n_described = max(self.n_described, n)
+
+	def write_packet(self, pkt, interface: int = 0, **kwargs):
+		if self.f is None:
+			self.open()
+		if self.count == 0:
+			self.write_header()
+		if interface >= self.n_described:
+			self.write_interfaces(interface + 1)
+
+		nano = self.interfaces[interface].nano
+		ts = pkt.time.ns
+
+		if 'sec' in kwargs or 'usec' in kwargs:
+			sec, usec = divmod(ts, 10**9)
+			ts = kwargs.get('sec', sec) * 10**9 + (kwargs['usec'] * (1 if nano else 1000) if 'usec' in kwargs else usec)
+		if not nano:
+			ts //= 1000
+
+		incl_len = pkt.header.incl_len
+		data = kwargs.get('data')
+		if data is not None and len(data) != incl_len:
+			raise ValueError(f"data is {len(data)} bytes, the record has {incl_len}")
+
+		data_end = PCAPNG_PACKET_HEADER_LEN + incl_len
+		length = data_end + -incl_len % 4 + 4
+		out, pos = self._space(length)
+
+		self.epb.pack_into(out, pos, PCAPNG_EPB, length, interface, ts >> 32, ts & 0xffffffff, incl_len, pkt.header.orig_len)
+		start = pkt.offset + len(pkt.header)
+		out[pos + PCAPNG_PACKET_HEADER_LEN:pos + data_end] = pkt.data[start:start + incl_len] if data is None else data
+		out[pos + data_end:pos + length - 4] = bytes(length - 4 - data_end)
+		self.trailer.pack_into(out, pos + length - 4, length)
+
+		self._done(out, length)
 		self.count += 1
 
 class PcapReader(Pcap):
-	def __init__(self, fn: str):
+	"""
+	Iterates over the records of a pcap.  filter is a compile_filter expression; records
+	it rejects are skipped before being decoded and counted in n_skipped.  readahead reads
+	the file through a ReadaheadFile.  Compressed files are decompressed as they are read,
+	where decompress says (see open_pcap).
+	"""
+	def __init__(self, fn: str, lazy=False, filter: str = None, readahead=False, decompress: str = None):
 		super().__init__(fn)
+		self.readahead = readahead
+		self.decompress = decompress
 		self.open()
-		self.record: Record = Record(self)
+		self.record: Record = Record(self, lazy=lazy)
 		self.pos = 0
+		self.filter = compile_filter(filter, self.header) if filter else None
+		self.n_skipped = 0
 	@property
 	def header(self) -> PcapHeader:
 		return self._header
@@ -150,9 +543,12 @@ class PcapReader(Pcap):
 		self._header = header
 
 	def open(self):
-		self.f = open(self.fn, 'rb')
+		self.f = open_pcap(self.fn, self.decompress)
+		if self.readahead and not isinstance(self.f, ReadaheadFile):
+			self.f = ReadaheadFile(self.f)
 		self.buffer = self.f.read(24 + RECORD_HEADER_LEN)
 		self.header = PcapHeader(self.buffer[:24])
+		self.skip = 24
 
 	def next(self):
 		return next(self)
@@ -160,8 +556,31 @@ class PcapReader(Pcap):
 	def __iter__(self):
 		return self
 	def __next__(self):
-		self.buffer = self.buffer[len(self.record) if self.count > 0 else 24:]
+		self._advance()
+
+		while self.filter is not None and not self.filter(
+			self.record.data, self.record.offset, self.record.header.incl_len, self.record.header.orig_len
+		):
+			self.n_skipped += 1
+			self._advance()
+
+#		print(binascii.hexlify(self.record[RECORD_HEADER_LEN:len(self.record)]))
+		try:
+			self.record.update()
+		except Exception:
+			log.debug("Can't decode record %d of %s: incl_len %d, layers %s", self.count, self.fn, self.record.header.incl_len, self.record.peek())
+			raise
+
+		self.count += 1
+		return self.record
+
+	def _advance(self):
+		# move to the next complete record and read its header
+		self.buffer = self.buffer[self.skip:]
 
+		# only short after read_batch left a partial header behind, or at the end of the file
+		if len(self.buffer) < RECORD_HEADER_LEN:
+			self.buffer += self.f.read(RECORD_HEADER_LEN - len(self.buffer))
 		if len(self.buffer) < RECORD_HEADER_LEN:
 			raise StopIteration
 
@@ -171,28 +590,115 @@ class PcapReader(Pcap):
 		if len(self.buffer) < len(self.record):
 			raise StopIteration
 
-#		print(binascii.hexlify(self.record[RECORD_HEADER_LEN:len(self.record)]))
-		try:
-			self.record.update()
-		except Exception as e:
-			print(len(self.buffer), self.record.header.incl_len, bytes(self.record))
-			print(self.record._pointers)
-			print(self.record.layers[1].valid, self.record.layers[2].valid)
-			raise e
+		self.skip = len(self.record)
+
+	def _unread(self):
+		return self.buffer[self.skip:]
+	def _rewind(self, data):
+		self.buffer = data
+		self.skip = 0
+
+	def seek_time(self, ts):
+		"""
+		Move to the first record at or after ts (a Timestamp, or seconds), so next() returns
+		it.  Bisects the .pcapidx sidecar, building it first if it is missing or stale, then
+		scans at most a few records from the entry it lands on.  A compressed file can't be
+		indexed, it is read up to the record instead.
+		"""
+		ns = ts.ns if isinstance(ts, Timestamp) else Timestamp.from_str(str(ts)).ns
+		if compression(self.fn) is None:
+			self._seek(open_index(self.fn).find(ns))
+		else:
+			self._scan_to(ns)
+
+	def _scan_to(self, ns: int):
+		# read up to the first record at or after ns and step back onto it, so next() returns it
+		while True:
+			try:
+				self._advance()
+			except StopIteration:
+				self._rewind(b'')
+				return
+			if self.record.time.ns >= ns:
+				self._back()
+				return
+	def _back(self):
+		self.skip = 0
+
+	def _seek(self, offset: int):
+		self._seek_file(offset)
+		self.buffer = b''
+		self.skip = 0
+	def _seek_file(self, offset: int):
+		if isinstance(self.f, ReadaheadFile):
+			# start the background reads over from the new position
+			self.f.close()
+			self.f = open(self.fn, 'rb')
+			self.f.seek(offset)
+			self.f = ReadaheadFile(self.f)
+		else:
+			self.f.seek(offset)
+
+	def scan_batch(self, n: int):
+		"""
+		Collect up to n raw records without decoding them.  Returns a buffer holding the
+		records and the offset of each record in it.  The reader picks up after the last one.
+		"""
+		data = bytearray(self._unread())
+		offsets = []
+		pos = 0
+		lengths = struct.Struct(self.header.endian + 'II')
+
+		while len(offsets) < n:
+			if len(data) - pos >= RECORD_HEADER_LEN:
+				incl_len, orig_len = lengths.unpack_from(data, pos + 8)
+				end = pos + RECORD_HEADER_LEN + incl_len
+
+				if end <= len(data):
+					if self.filter is None or self.filter(data, pos, incl_len, orig_len):
+						offsets.append(pos)
+					else:
+						self.n_skipped += 1
+					pos = end
+					continue
+			else:
+				end = pos + RECORD_HEADER_LEN
+
+			bytes_read = self.f.read(max(BATCH_CHUNK_SIZE, end - len(data)))
 
-		self.count += 1
-		return self.record
+			if len(bytes_read) == 0:
+				break
+
+			data += bytes_read
+
+		self._rewind(bytes(data[pos:]))
+		self.count += len(offsets)
+		return data, offsets
+
+	def read_batch(self, n: int = BATCH_SIZE):
+		"""Decode the next n records into a numpy structured array with BATCH_FIELDS columns."""
+		data, offsets = self.scan_batch(n)
+		return decode_batch(data, offsets, self.header)
+
+	def iter_batches(self, n: int = BATCH_SIZE):
+		while True:
+			batch = self.read_batch(n)
+
+			if len(batch) == 0:
+				return
+
+			yield batch
 
 class BufferedPcapReader(PcapReader):
-	def __init__(self, fn: str):
-		super().__init__(fn)
-		self.record = Record(self)
+	def __init__(self, fn: str, lazy=False, filter: str = None, readahead=False, decompress: str = None):
+		super().__init__(fn, filter=filter, readahead=readahead, decompress=decompress)
+		self.record = Record(self, lazy=lazy)
 		self.pos = None
 
-		self.open()
-
 	def open(self):
-		self.f = open(self.fn, 'rb')
+		self.f = open_pcap(self.fn, self.decompress)
+		if self.readahead and not isinstance(self.f, ReadaheadFile):
+			self.f = ReadaheadFile(self.f)
 		self.buffer = self.f.read(CHUNK_SIZE)
 		self.header = PcapHeader(self.buffer)
 		self.next_pos = len(self.header)
@@ -202,9 +708,13 @@ class BufferedPcapReader(PcapReader):
 
 	def __iter__(self):
 		return self
-	def __next__(self):
+	def _advance(self):
 		self.pos = self.next_pos
 
+		# only short after read_batch left a partial header behind, or at the end of the file
+		if len(self.buffer) - self.pos < RECORD_HEADER_LEN:
+			self.buffer = self.buffer[self.pos:] + self.f.read(CHUNK_SIZE)
+			self.pos = 0
 		if len(self.buffer) - self.pos < RECORD_HEADER_LEN:
 			raise StopIteration
 
@@ -227,37 +737,1002 @@ class BufferedPcapReader(PcapReader):
 		if len(self.buffer) - self.pos < len(self.record):
 			raise StopIteration
 
-#		print(binascii.hexlify(self.record[RECORD_HEADER_LEN:len(self.record)]))
+		self.next_pos = self.pos + len(self.record)
 
-		self.record.update()
+	def _unread(self):
+		return self.buffer[self.next_pos:]
+	def _rewind(self, data):
+		self.buffer = data
+		self.next_pos = 0
+	def _back(self):
+		self.next_pos = self.pos
+	def _seek(self, offset: int):
+		self._seek_file(offset)
+		self.buffer = b''
+		self.next_pos = 0
+
+class MmapPcapReader(PcapReader):
+	"""
+	Reads records straight out of a memory-mapped file.  The record buffer is a memoryview
+	over the whole file and pos is the absolute file offset of the current record, so
+	moving to the next record is just an offset increment with no copying.
+
+	start and end limit the reader to the records starting in [start, end), e.g. one
+	chunk of a file read in parallel.  With readahead the kernel is told the mapping will be
+	read sequentially, so it reads ahead of the page faults.
+	"""
+	def __init__(self, fn: str, start: int = None, end: int = None, lazy=False, filter: str = None, readahead=False, decompress: str = None):
+		self.mmap = None
+		self.start = start
+		self.end = end
+		super().__init__(fn, lazy=lazy, filter=filter, readahead=readahead, decompress=decompress)
+
+	def open(self):
+		if compression(self.fn) is not None:
+			raise ValueError(f"{self.fn} is compressed and can't be memory-mapped")
+
+		self.f = open(self.fn, 'rb')
+
+		if os.fstat(self.f.fileno()).st_size > 0:
+			self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+			if self.readahead and hasattr(mmap, 'MADV_SEQUENTIAL'):
+				self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+			self.buffer = memoryview(self.mmap)
+		else:
+			self.buffer = memoryview(b'')
+
+		self.header = PcapHeader(bytes(self.buffer[:24]))
+		self.pos = None
+		self.next_pos = len(self.header) if self.start is None else self.start
+		self.stop = len(self.buffer) if self.end is None else min(self.end, len(self.buffer))
+
+	def close(self):
+		if self.mmap is not None:
+			self.buffer.release()
+			try:
+				self.mmap.close()
+			except BufferError:
+				pass # a caller still holds a slice of the buffer, leave it to the gc
+			self.mmap = None
+		super().close()
+
+	def _advance(self):
+		self.pos = self.next_pos
+
+		if self.pos >= self.stop or len(self.buffer) - self.pos < RECORD_HEADER_LEN:
+			raise StopIteration
+
+		self.record.header.update()
+
+		# could be incomplete record at the tail
+		if len(self.buffer) - self.pos < len(self.record):
+			raise StopIteration
 
 		self.next_pos = self.pos + len(self.record)
+
+	def _back(self):
+		self.next_pos = self.pos
+	def _seek(self, offset: int):
+		self.next_pos = offset
+
+	def scan_batch(self, n: int):
+		# the whole file is already addressable, so offsets are simply file offsets
+		offsets = []
+		pos = self.next_pos
+		lengths = struct.Struct(self.header.endian + 'II')
+
+		while len(offsets) < n and pos < self.stop and len(self.buffer) - pos >= RECORD_HEADER_LEN:
+			incl_len, orig_len = lengths.unpack_from(self.buffer, pos + 8)
+			end = pos + RECORD_HEADER_LEN + incl_len
+
+			if end > len(self.buffer):
+				break
+
+			if self.filter is None or self.filter(self.buffer, pos, incl_len, orig_len):
+				offsets.append(pos)
+			else:
+				self.n_skipped += 1
+			pos = end
+
+		self.next_pos = pos
+		self.count += len(offsets)
+		return self.buffer, offsets
+
+class PcapngInterface:
+	"""
+	An interface from an Interface Description Block.  header is a PcapHeader standing in
+	for it, nano if its timestamps are finer than usec; ns converts its timestamps.
+	"""
+	def __init__(self, endian: str, linktype: int, snaplen: int, units: int = 10**6, tsoffset: int = 0):
+		self.linktype = linktype
+		self.snaplen = snaplen
+		self.units = units
+		self.offset = tsoffset * 10**9
+		self.scale = 10**9 // units if 10**9 % units == 0 else None
+		self.header = PcapHeader(None, endian=endian, nano=units > 10**6, snaplen=snaplen or MAX_SNAPLEN, linktype=linktype)
+
+	def ns(self, ts: int) -> int:
+		return (ts * self.scale if self.scale is not None else ts * 10**9 // self.units) + self.offset
+
+class PcapngReader(PcapReader):
+	"""
+	Iterates over the packets of a pcapng file as Records, streaming it block by block
+	through a buffer like BufferedPcapReader.  Enhanced, Simple and the obsolete Packet Blocks
+	are read; section headers and interface descriptions update the state they describe and
+	every other block is skipped.
+
+	header is the PcapHeader of the current packet's interface, so a capture with several
+	interfaces can change linktype or timestamp resolution from one packet to the next.
+	Records hold their timestamp in ns (or usec) whatever the interface's resolution, and
+	record.header.interface is the interface id.  There is one Record per linktype, so
+	record only changes object when the linktype does.
+	"""
+	def __init__(self, fn: str, lazy=False, filter: str = None, readahead=False, decompress: str = None):
+		Pcap.__init__(self, fn)
+		self.lazy = lazy
+		self.filter_expression = filter
+		self.readahead = readahead
+		self.decompress = decompress
+		self.records = {}
+		self.interface = None
+		self.n_skipped = 0
+		self.open()
+
+	def open(self):
+		self.f = open_pcap(self.fn, self.decompress)
+		if self.readahead and not isinstance(self.f, ReadaheadFile):
+			self.f = ReadaheadFile(self.f)
+		self.buffer = b''
+		self.pos = 0
+		self.next_pos = 0
+		self.interfaces = []
+		self._set_endian('<')
+
+		self._fill(4)
+		if self.buffer[:4] != PCAPNG_MAGIC:
+			raise ValueError(f"{self.fn} is not a pcapng file")
+
+		# read up to the first packet so header describes the interface it was captured on
+		try:
+			while True:
+				block_type, block_len = self._block()
+				if block_type in (PCAPNG_EPB, PCAPNG_PB, PCAPNG_SPB):
+					break
+				self._control(block_type, block_len)
+				self.pos += block_len
+		except StopIteration:
+			pass
+
+		self.next_pos = self.pos
+		self._switch(self.interfaces[0] if self.interfaces else PcapngInterface(self.endian, 101, 0))
+
+	def _set_endian(self, endian: str):
+		self.endian = endian
+		self.block = struct.Struct(endian + 'II')
+		self.epb = struct.Struct(endian + 'IIIII')
+		self.pb = struct.Struct(endian + 'HHIIII')
+
+	def _switch(self, interface: PcapngInterface):
+		self.interface = interface
+		self.header = interface.header
+
+		if interface.linktype not in self.records:
+			record = Record(self, lazy=self.lazy)
+			record.header = PcapngRecordHeaderView(record)
+			test = compile_filter(self.filter_expression, interface.header) if self.filter_expression else None
+			self.records[interface.linktype] = (record, test)
+
+		self.record, self.filter = self.records[interface.linktype]
+
+	def _fill(self, n: int):
+		# move what is left to the front of the buffer and read until there are n bytes
+		buffer = self.buffer[self.pos:]
+
+		while len(buffer) < n:
+			bytes_read = self.f.read(max(CHUNK_SIZE, n - len(buffer)))
+
+			if len(bytes_read) == 0:
+				break
+
+			buffer += bytes_read
+
+		self.buffer = buffer
+		self.pos = 0
+
+	def _block(self):
+		# make sure the whole block at pos is buffered and return its type and length
+		if len(self.buffer) - self.pos < 12:
+			self._fill(12)
+			if len(self.buffer) - self.pos < 12:
+				raise StopIteration
+
+		if self.buffer[self.pos:self.pos + 4] == PCAPNG_MAGIC:
+			# a section header sets the byte order of everything up to the next one
+			order = self.buffer[self.pos + 8:self.pos + 12]
+			if order not in (b'\x1a\x2b\x3c\x4d', b'\x4d\x3c\x2b\x1a'):
+				raise ValueError(f"{self.fn}: bad byte-order magic at section header")
+			self._set_endian('>' if order[0] == 0x1a else '<')
+
+		block_type, block_len = self.block.unpack_from(self.buffer, self.pos)
+
+		if block_len < 12 or block_len % 4:
+			raise ValueError(f"{self.fn}: bad pcapng block length {block_len}")
+
+		if len(self.buffer) - self.pos < block_len:
+			self._fill(block_len)
+			# could be an incomplete block at the tail
+			if len(self.buffer) < block_len:
+				raise StopIteration
+
+		return block_type, block_len
+
+	def _control(self, block_type: int, block_len: int):
+		if block_type == PCAPNG_SHB:
+			self.interfaces = []
+		elif block_type == PCAPNG_IDB:
+			linktype, _, snaplen = struct.unpack_from(self.endian + 'HHI', self.buffer, self.pos + 8)
+			units, tsoffset = 10**6, 0
+
+			pos = self.pos + 16
+			end = self.pos + block_len - 4
+			while pos + 4 <= end:
+				code, length = struct.unpack_from(self.endian + 'HH', self.buffer, pos)
+				if code == 0:
+					break
+				if code == 9 and length >= 1: # if_tsresol: a power of 10, or of 2 with the top bit set
+					b = self.buffer[pos + 4]
+					units = 2 ** (b & 0x7f) if b & 0x80 else 10 ** b
+				elif code == 14 and length >= 8: # if_tsoffset: seconds added to every timestamp
+					tsoffset, = struct.unpack_from(self.endian + 'q', self.buffer, pos + 4)
+				pos += 4 + length + (-length % 4)
+
+			self.interfaces.append(PcapngInterface(self.endian, linktype, snaplen, units, tsoffset))
+
+	def __next__(self):
+		self._advance()
+
+		while self.filter is not None and not self.filter(
+			self.buffer, self.pos + len(self.record.header) - RECORD_HEADER_LEN, self.record.header.incl_len, self.record.header.orig_len
+		):
+			self.n_skipped += 1
+			self._advance()
+
+		self.record.update()
 		self.count += 1
 		return self.record
 
+	def _advance(self):
+		while True:
+			self.pos = self.next_pos
+			block_type, block_len = self._block()
+			self.next_pos = self.pos + block_len
+
+			if block_type in (PCAPNG_EPB, PCAPNG_PB, PCAPNG_SPB):
+				break
+
+			self._control(block_type, block_len)
+
+		if block_type == PCAPNG_EPB:
+			interface, high, low, incl_len, orig_len = self.epb.unpack_from(self.buffer, self.pos + 8)
+			header_len = PCAPNG_PACKET_HEADER_LEN
+		elif block_type == PCAPNG_PB:
+			interface, _, high, low, incl_len, orig_len = self.pb.unpack_from(self.buffer, self.pos + 8)
+			header_len = PCAPNG_PACKET_HEADER_LEN
+		else:
+			# simple packet blocks have no timestamp and belong to the first interface
+			interface, high, low = 0, None, 0
+			orig_len, = struct.unpack_from(self.endian + 'I', self.buffer, self.pos + 8)
+			header_len = PCAPNG_SPB_HEADER_LEN
+			incl_len = min(orig_len, block_len - header_len - 4)
+			if self.interfaces and self.interfaces[0].snaplen:
+				incl_len = min(incl_len, self.interfaces[0].snaplen)
+
+		if interface >= len(self.interfaces):
+			raise ValueError(f"{self.fn}: packet from undescribed interface {interface}")
+		if header_len + incl_len + 4 > block_len:
+			raise ValueError(f"{self.fn}: packet longer than its block")
+
+		if self.interfaces[interface] is not self.interface:
+			self._switch(self.interfaces[interface])
+
+		header = self.record.header
+		header.len = header_len
+		header.interface = interface
+		header.incl_len = incl_len
+		header.orig_len = orig_len
+		header.ts_sec, header.ts_usec = divmod(0 if high is None else self.interface.ns(high << 32 | low), 10**9)
+		if not self.header.nano:
+			header.ts_usec //= 1000
+
+	def _back(self):
+		self.next_pos = self.pos
+	def _rewind(self, data):
+		self.buffer = data
+		self.pos = self.next_pos = 0
+
+	def scan_batch(self, n: int):
+		"""
+		Collect up to n packets as classic pcap records in the byte order and timestamp
+		resolution of header, like PcapReader.scan_batch.  A batch ends early before a packet
+		from an interface of another linktype or resolution, so header describes all of it.
+		"""
+		data = bytearray()
+		offsets = []
+		interface = None
+
+		while len(offsets) < n:
+			try:
+				self._advance()
+			except StopIteration:
+				break
+
+			if interface is None:
+				interface = self.interface
+				pack = struct.Struct(self.header.endian + 'IIII').pack
+			elif self.interface is not interface and (self.header.linktype, self.header.nano) != (interface.header.linktype, interface.header.nano):
+				self._back()
+				break
+
+			header = self.record.header
+			start = self.pos + len(header)
+			if self.filter is not None and not self.filter(self.buffer, start - RECORD_HEADER_LEN, header.incl_len, header.orig_len):
+				self.n_skipped += 1
+				continue
+
+			offsets.append(len(data))
+			data += pack(header.ts_sec, header.ts_usec, header.incl_len, header.orig_len)
+			data += self.buffer[start:start + header.incl_len]
+
+		# read_batch decodes the batch with header
+		if interface is not None and self.interface is not interface:
+			self._switch(interface)
+
+		self.count += len(offsets)
+		return data, offsets
+
+	def seek_time(self, ts):
+		"""Move to the first packet at or after ts, reading up to it: pcapng files aren't indexed."""
+		self._scan_to(ts.ns if isinstance(ts, Timestamp) else Timestamp.from_str(str(ts)).ns)
+
+def pcap_format(fn: str) -> str:
+	"""'pcapng' or 'pcap', from the first bytes of fn after any decompression."""
+	f = open_pcap(fn)
+	try:
+		magic = f.read(4)
+	finally:
+		f.close()
+	return 'pcapng' if magic == PCAPNG_MAGIC else 'pcap'
+
+def open_reader(fn: str, mmap=False, **kwargs) -> PcapReader:
+	"""A reader for fn whatever its format: PcapngReader, or MmapPcapReader with mmap, or PcapReader."""
+	if pcap_format(fn) == 'pcapng':
+		return PcapngReader(fn, **kwargs)
+	if mmap:
+		return MmapPcapReader(fn, **kwargs)
+	return PcapReader(fn, **kwargs)
+
+class TimesFile:
+	"""
+	The .times sidecar of a pcap, the time in ns of each of its records in order: either
+	text lines of sec.nsec or, after TIMES_MAGIC, packed little-endian uint64 ns.  times[k]
+	is the time of record k.  A binary file is memory-mapped, with numpy.memmap when numpy
+	is installed, so a lookup is an array access; a text file is parsed forward as records
+	are asked for, times.py converts it to binary.
+	"""
+	def __init__(self, fn: str):
+		self.fn = fn
+		self.f = open(fn, 'rb')
+		self.binary = self.f.read(len(TIMES_MAGIC)) == TIMES_MAGIC
+		self.mm = None
+		self.ns = None
+		if self.binary:
+			self.ns = self._map()
+			# item returns a python int without building a numpy scalar first
+			self.get = getattr(self.ns, 'item', self.ns.__getitem__)
+		else:
+			self.f.seek(0)
+			self.n_parsed = 0
+			self.last = None
+
+	def _map(self):
+		n = (os.fstat(self.f.fileno()).st_size - len(TIMES_MAGIC)) // 8
+		if n == 0:
+			return array.array('Q')
+		try:
+			import numpy as np
+			return np.memmap(self.f, dtype='<u8', mode='r', offset=len(TIMES_MAGIC), shape=(n,))
+		except ImportError:
+			pass
+		self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+		if sys.byteorder == 'little':
+			return memoryview(self.mm)[len(TIMES_MAGIC):len(TIMES_MAGIC) + 8 * n].cast('Q')
+		ns = array.array('Q', self.mm[len(TIMES_MAGIC):len(TIMES_MAGIC) + 8 * n])
+		ns.byteswap()
+		return ns
+
+	def close(self):
+		if isinstance(self.ns, memoryview):
+			self.ns.release()
+		self.ns = self.get = None
+		if self.mm is not None:
+			self.mm.close()
+		self.f.close()
+
+	def count(self) -> int:
+		"""Number of times in the file."""
+		if self.binary:
+			return len(self.ns)
+		with open(self.fn, 'rb') as f:
+			return sum(1 for line in f if line.strip())
+
+	def first(self) -> int:
+		"""Time of the first record, None if there are none."""
+		if self.binary:
+			return int(self.ns[0]) if len(self.ns) else None
+		with open(self.fn, 'rb') as f:
+			line = f.readline()
+		return self._parse(line) if line.strip() else None
+
+	def _parse(self, line: bytes) -> int:
+		sec, nsec = line.strip().split(b'.', 1)
+		return int(sec) * 10**9 + int(nsec)
+
+	def __getitem__(self, k: int) -> int:
+		if self.binary:
+			try:
+				return self.get(k)
+			except IndexError:
+				raise ValueError(f"{self.fn} has fewer times than the pcap has records") from None
+
+		if k < self.n_parsed - 1:
+			raise ValueError(f"{self.fn} is text and can only be read forward, convert it with times.py")
+		while self.n_parsed <= k:
+			line = self.f.readline()
+			if not line:
+				raise ValueError(f"{self.fn} has fewer times than the pcap has records")
+			self.last = self._parse(line)
+			self.n_parsed += 1
+		return self.last
+
+	def array(self, start: int = 0, stop: int = None):
+		"""Times of records start to stop as a numpy uint64 array, a view of the file when it's binary."""
+		import numpy as np
+		stop = self.count() if stop is None else stop
+		if self.binary:
+			return np.asarray(self.ns[start:stop], dtype=np.uint64)
+		return np.fromiter((self[k] for k in range(start, stop)), dtype=np.uint64, count=stop - start)
+
+def write_times(fn: str, ns):
+	"""Write the times ns, an iterable of ints in ns, to fn as a binary .times file."""
+	tmp = fn + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(TIMES_MAGIC)
+		block = array.array('Q')
+		for t in ns:
+			block.append(t)
+			if len(block) == TIMES_BLOCK:
+				_write_block(f, block)
+		_write_block(f, block)
+	os.replace(tmp, fn)
+
+def _write_block(f, block):
+	if sys.byteorder == 'big':
+		block.byteswap()
+	block.tofile(f)
+	del block[:]
+
+def open_times(fn: str) -> TimesFile:
+	"""The .times sidecar of the pcap fn, None if it has none."""
+	path = pcap_stem(fn) + '.times'
+	return TimesFile(path) if os.path.exists(path) else None
+
+def index_path(fn: str) -> str:
+	return pcap_stem(fn) + '.pcapidx'
+
+class PcapIndex:
+	"""
+	A .pcapidx sidecar: the byte offset of every interval-th record of a pcap and, for
+	each, the latest timestamp of any record before it.  Those timestamps never decrease
+	even if the records are slightly out of order, so bisecting them finds where to start
+	looking for the first record at or after a time.  size and mtime_ns are those of the
+	pcap when it was indexed; first is the time of its first record and end the offset
+	after its last complete one.
+	"""
+	def __init__(self, fn: str, interval: int, size: int, mtime_ns: int, first: int, end: int, n_records: int, times, offsets):
+		self.fn = fn
+		self.interval = interval
+		self.size = size
+		self.mtime_ns = mtime_ns
+		self.first = first
+		self.end = end
+		self.n_records = n_records
+		self.times = times
+		self.offsets = offsets
+
+	def find(self, ns: int) -> int:
+		"""Offset of the first record at or after ns, end if there is none."""
+		if len(self.offsets) == 0:
+			return self.end
+
+		offset = self.offsets[max(bisect.bisect_left(self.times, ns) - 1, 0)]
+
+		with open(self.fn, 'rb') as f:
+			header = PcapHeader(f.read(24))
+			record = struct.Struct(header.endian + 'III')
+			scale = 1 if header.nano else 1000
+			f.seek(offset)
+
+			while offset < self.end:
+				sec, frac, incl_len = record.unpack(f.read(12))
+				if sec * 1000000000 + frac * scale >= ns:
+					return offset
+				offset += RECORD_HEADER_LEN + incl_len
+				f.seek(offset)
+
+		return self.end
+
+	def write(self):
+		times, offsets = array.array('q', self.times), array.array('Q', self.offsets)
+		if sys.byteorder == 'big':
+			times.byteswap()
+			offsets.byteswap()
+
+		path = index_path(self.fn)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(INDEX_MAGIC)
+			f.write(INDEX_HEADER.pack(self.interval, self.size, self.mtime_ns, self.first or 0, self.end, self.n_records, len(times)))
+			f.write(times.tobytes())
+			f.write(offsets.tobytes())
+		os.replace(path + '.tmp', path)
+
+def build_index(fn: str, interval: int = INDEX_INTERVAL, write=True) -> PcapIndex:
+	"""Index fn in one pass over its record headers and, with write, write the index next to it."""
+	if compression(fn) is not None:
+		raise ValueError(f"{fn} is compressed, only plain pcap files can be indexed")
+
+	times = array.array('q')
+	offsets = array.array('Q')
+	first = None
+	latest = INT64_MIN
+	n_records = 0
+
+	with open(fn, 'rb') as f:
+		stat = os.fstat(f.fileno())
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size > 0 else b''
+
+		try:
+			header = PcapHeader(data[:24])
+			record = struct.Struct(header.endian + 'III')
+			scale = 1 if header.nano else 1000
+			pos = len(header)
+
+			while pos + RECORD_HEADER_LEN <= len(data):
+				sec, frac, incl_len = record.unpack_from(data, pos)
+				if pos + RECORD_HEADER_LEN + incl_len > len(data):
+					break
+
+				if n_records % interval == 0:
+					times.append(latest)
+					offsets.append(pos)
+
+				ns = sec * 1000000000 + frac * scale
+				if first is None:
+					first = ns
+				if ns > latest:
+					latest = ns
+
+				pos += RECORD_HEADER_LEN + incl_len
+				n_records += 1
+		finally:
+			if isinstance(data, mmap.mmap):
+				data.close()
+
+	index = PcapIndex(fn, interval, stat.st_size, stat.st_mtime_ns, first, pos, n_records, times, offsets)
+	if write:
+		index.write()
+	return index
+
+def load_index(fn: str) -> PcapIndex:
+	"""The index of fn from its sidecar, None if there is none or fn has changed since."""
+	try:
+		with open(index_path(fn), 'rb') as f:
+			data = f.read()
+		stat = os.stat(fn)
+	except FileNotFoundError:
+		return None
+
+	if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+		return None
+
+	interval, size, mtime_ns, first, end, n_records, n_entries = INDEX_HEADER.unpack_from(data, len(INDEX_MAGIC))
+	if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+		return None
+
+	pos = len(INDEX_MAGIC) + INDEX_HEADER.size
+	times = array.array('q', data[pos:pos + 8 * n_entries])
+	offsets = array.array('Q', data[pos + 8 * n_entries:pos + 16 * n_entries])
+	if sys.byteorder == 'big':
+		times.byteswap()
+		offsets.byteswap()
+
+	return PcapIndex(fn, interval, size, mtime_ns, first if n_records else None, end, n_records, times, offsets)
+
+def open_index(fn: str) -> PcapIndex:
+	"""The index of fn, built first if it has none or it is stale."""
+	return load_index(fn) or build_index(fn)
+
+def first_time(fn: str) -> int:
+	"""The time in ns of the first record of fn, from its index if it can have one; None if it has no records."""
+	if compression(fn) is None and pcap_format(fn) == 'pcap':
+		return open_index(fn).first
+
+	with open_reader(fn, lazy=True) as reader:
+		for record in reader:
+			return record.time.ns
+	return None
+
+class MergeReader:
+	"""
+	Merges readers of time-ordered records into one stream in timestamp order, yielding
+	the reader holding the next record.  Each reader is read one record ahead and keyed
+	on a heap by (time.ns, index), so ties go to the reader listed first and each record
+	costs O(log k) comparisons for k readers.  Readers are closed as they run out; with
+	stop_smallest the merge ends as soon as the first one does.  A reader whose filter
+	rejects all of its records has run out from the start, only one without any records
+	at all is an error.
+	"""
+	def __init__(self, readers, stop_smallest=False):
+		self.readers = list(readers)
+		self.stop_smallest = stop_smallest
+		self.heap = []
+		self.current = None
+		ran_out = False
+
+		for index, reader in enumerate(self.readers):
+			try:
+				next(reader)
+			except StopIteration:
+				if reader.n_skipped == 0:
+					raise Exception(f"File {reader.fn} is empty, aborting.")
+				reader.close()
+				ran_out = True
+				continue
+			self.heap.append((reader.record.time.ns, index))
+
+		if ran_out and stop_smallest:
+			self.heap = []
+		heapq.heapify(self.heap)
+
+	def close(self):
+		for reader in self.readers:
+			reader.close()
+
+	def __iter__(self):
+		return self
+	def __next__(self):
+		if self.current is not None:
+			reader = self.readers[self.current]
+
+			try:
+				next(reader)
+				heapq.heapreplace(self.heap, (reader.record.time.ns, self.current))
+			except StopIteration:
+				if self.stop_smallest:
+					raise
+
+				reader.close()
+				heapq.heappop(self.heap)
+
+			self.current = None
+
+		if len(self.heap) == 0:
+			raise StopIteration
+
+		self.current = self.heap[0][1]
+		return self.readers[self.current]
+
+def decode_batch(data, offsets, header: PcapHeader):
+	"""
+	Decode the record header, IPv4 header and TCP/UDP/ICMP header of every record at
+	offsets in data into a numpy structured array, one row per record.  Fields are
+	gathered for all records at once by viewing fixed-size header slices through
+	big-endian structured dtypes.  l3_valid and l4_valid mark the rows where the same
+	layers would have been decoded by Record.update.
+	"""
+	import numpy as np
+
+	batch = np.zeros(len(offsets), dtype=BATCH_FIELDS)
+
+	if len(offsets) == 0:
+		return batch
+
+	buf = np.frombuffer(data, dtype=np.uint8)
+	offset = np.asarray(offsets, dtype=np.int64)
+
+	def gather(start, dtype):
+		# fixed-size slice at each start, clipped at the end of the buffer; callers mask rows that ran short
+		dtype = np.dtype(dtype)
+		index = start[:, None] + np.arange(dtype.itemsize)
+		np.minimum(index, len(buf) - 1, out=index)
+		return buf[index].view(dtype)[:, 0]
+
+	rec = gather(offset, [(k, header.endian + 'u4') for k in ('sec', 'usec', 'incl_len', 'orig_len')])
+	batch['offset'] = offset
+	batch['sec'] = rec['sec']
+	batch['nsec'] = rec['usec'] * (1 if header.nano else 1000)
+	batch['incl_len'] = rec['incl_len']
+	batch['orig_len'] = rec['orig_len']
+	incl_len = rec['incl_len'].astype(np.int64)
+
+	# Record.update stops at an L2 header it doesn't know the length of
+	if header.linktype == 101:
+		l2_len = 0
+	elif L2_LEN.get(header.linktype):
+		l2_len = L2_LEN[header.linktype]
+	else:
+		return batch
+
+	l3 = offset + RECORD_HEADER_LEN + l2_len
+	ip = gather(l3, [
+		('vihl', 'u1'), ('tos', 'u1'), ('len', '>u2'), ('id', '>u2'), ('off', '>u2'),
+		('ttl', 'u1'), ('proto', 'u1'), ('csum', '>u2'), ('src', '>u4'), ('dst', '>u4')
+	])
+	ihl = (ip['vihl'] & 0x0f).astype(np.int64)
+	m3 = (incl_len >= l2_len + 20) & ((ip['vihl'] >> 4) == 4)
+
+	batch['l3_valid'] = m3
+	batch['ip_version'] = np.where(m3, 4, 0)
+	batch['ip_hl'] = np.where(m3, ihl, 0)
+	for field in ('tos', 'len', 'id', 'off', 'ttl', 'proto', 'csum', 'src', 'dst'):
+		batch['ip_' + field] = np.where(m3, ip[field], 0)
+
+	l4 = l3 + ihl * 4
+	l4_len = incl_len - l2_len - ihl * 4
+	m3 &= (ihl > 0) & (l4_len > 0)
+
+	tcp = gather(l4, [
+		('sport', '>u2'), ('dport', '>u2'), ('seq', '>u4'), ('ack', '>u4'), ('data_off', 'u1'),
+		('flags', 'u1'), ('win', '>u2'), ('csum', '>u2'), ('urgent', '>u2')
+	])
+	is_tcp = m3 & (ip['proto'] == 6) & (l4_len >= 20)
+	is_udp = m3 & (ip['proto'] == 17) & (l4_len >= 8)
+	is_icmp = m3 & (ip['proto'] == 1) & (l4_len >= 4)
+	ports = is_tcp | is_udp
+
+	batch['l4_valid'] = is_tcp | is_udp | is_icmp
+	batch['sport'] = np.where(ports, tcp['sport'], 0)
+	batch['dport'] = np.where(ports, tcp['dport'], 0)
+	batch['tcp_seq'] = np.where(is_tcp, tcp['seq'], 0)
+	batch['tcp_ack'] = np.where(is_tcp, tcp['ack'], 0)
+	batch['tcp_len'] = np.where(is_tcp, (tcp['data_off'] >> 4) * 4, 0)
+	batch['tcp_flags'] = np.where(is_tcp, tcp['flags'] | ((tcp['data_off'].astype(np.uint16) & 0x01) << 8), 0)
+	batch['tcp_win'] = np.where(is_tcp, tcp['win'], 0)
+	batch['tcp_urgent'] = np.where(is_tcp, tcp['urgent'], 0)
+	# the udp length and checksum sit where tcp has seq, icmp's type/code/checksum where tcp has ports
+	batch['udp_len'] = np.where(is_udp, tcp['seq'] >> 16, 0)
+	batch['icmp_type'] = np.where(is_icmp, tcp['sport'] >> 8, 0)
+	batch['icmp_code'] = np.where(is_icmp, tcp['sport'] & 0xff, 0)
+	batch['l4_csum'] = np.select([is_tcp, is_udp, is_icmp], [tcp['csum'], tcp['seq'] & 0xffff, tcp['dport']], 0)
+
+	return batch
+
+FILTER_TOKEN = re.compile(r'\s*(?:(\d+\.\d+\.\d+\.\d+(?:/\d+)?)|(\d+-\d+)|(\d+)|([A-Za-z_]+)|(&&|\|\||<=|>=|!=|==|[()!<>=]))')
+FILTER_PROTOS = {name: proto for proto, name in L4_TYPES.items()}
+
+def compile_filter(expression: str, header: PcapHeader):
+	"""
+	Compile a BPF-like filter expression into a function of (data, offset, incl_len, orig_len)
+	that tests the record at offset in data with raw byte reads, without decoding it.
+
+	Primitives are ip, tcp, udp, icmp, [ip] proto N, [src|dst] host A.B.C.D,
+	[src|dst] net A.B.C.D/N, [src|dst] port N, [src|dst] portrange N-M, len <op> N, less N and
+	greater N, where len is the original length of the packet as in BPF.  A protocol can qualify
+	a port (tcp dst port 443).  They combine with not/!, and/&&, or/|| and parentheses; and and
+	or group left to right with the same precedence, as in BPF.  Protocols match the same
+	records as `'tcp' in record` does.
+	"""
+	tokens = []
+	pos = 0
+	expression = expression.strip()
+
+	while pos < len(expression):
+		match = FILTER_TOKEN.match(expression, pos)
+		if match is None or match.end() == pos:
+			raise FilterException(f"Invalid filter at '{expression[pos:]}'")
+		tokens.append(next(t for t in match.groups() if t is not None))
+		pos = match.end()
+
+	# d, o, n, w: record buffer, record offset, incl_len, orig_len
+	# decode stops at an L2 header of unknown length, so nothing above it can match
+	l2 = L2_LEN.get(header.linktype)
+	l3 = f"o+{RECORD_HEADER_LEN + (l2 or 0)}"
+	ihl = f"((d[{l3}] & 15) << 2)"
+
+	def ip(length=1):
+		if l2 is None:
+			return "False"
+		return f"n >= {l2 + length} and d[{l3}] >> 4 == 4"
+
+	def l4(protos, length=0):
+		# p is the L4 offset, guarded like L4HeaderView by a nonzero ihl and a byte past the IP header
+		protos = sorted(protos)
+		match = f"d[{l3}+9] == {protos[0]}" if len(protos) == 1 else f"d[{l3}+9] in {tuple(protos)}"
+		return f"{ip(10)} and {match} and d[{l3}] & 15 and {l2 or 0} + {ihl} + {max(length, 1)} <= n and (p := {l3} + {ihl}) >= 0"
+
+	def number(token, limit=None):
+		if token is None or not token.isdigit():
+			raise FilterException(f"Expected a number, got '{token}'")
+		if limit is not None and int(token) > limit:
+			raise FilterException(f"{token} is out of range (0-{limit})")
+		return int(token)
+
+	def address(token):
+		if token is None or not re.fullmatch(r'\d+\.\d+\.\d+\.\d+(/\d+)?', token):
+			raise FilterException(f"Expected an address, got '{token}'")
+		addr, _, bits = token.partition('/')
+		try:
+			value = int.from_bytes(socket.inet_aton(addr), 'big')
+		except OSError:
+			raise FilterException(f"Invalid address '{addr}'")
+		bits = number(bits, 32) if bits else 32
+		mask = (0xffffffff << (32 - bits)) & 0xffffffff
+		return value & mask, mask
+
+	def peek():
+		return tokens[0].lower() if tokens else None
+
+	def take():
+		if not tokens:
+			raise FilterException("Unexpected end of filter")
+		return tokens.pop(0)
+
+	def either(direction, src, dst):
+		if direction == 'src':
+			return src
+		if direction == 'dst':
+			return dst
+		return f"({src} or {dst})"
+
+	def primitive():
+		word = take().lower()
+		protos = None
+
+		if word in FILTER_PROTOS and peek() in ('src', 'dst', 'port', 'portrange'):
+			protos = {FILTER_PROTOS[word]}
+			word = take().lower()
+		elif word in FILTER_PROTOS:
+			return f"({l4({FILTER_PROTOS[word]})})"
+		elif word == 'ip' and peek() == 'proto':
+			word = take().lower()
+		elif word == 'ip':
+			return f"({ip()})"
+
+		direction = None
+		if word in ('src', 'dst'):
+			direction = word
+			word = take().lower()
+
+		if word in ('port', 'portrange'):
+			if word == 'port':
+				low = high = number(take(), 0xffff)
+			else:
+				token = take()
+				if not re.fullmatch(r'\d+-\d+', token):
+					raise FilterException(f"Expected a port range, got '{token}'")
+				low, high = (number(t, 0xffff) for t in token.split('-'))
+			test = (lambda at: f"(d[{at}] << 8 | d[{at}+1]) == {low}") if low == high else \
+				(lambda at: f"{low} <= (d[{at}] << 8 | d[{at}+1]) <= {high}")
+			return f"({l4(protos or {6, 17}, 4)} and {either(direction, test('p'), test('p+2'))})"
+
+		if protos is not None:
+			raise FilterException(f"Expected port after protocol, got '{word}'")
+
+		if word in ('host', 'net'):
+			value, mask = address(take())
+			if word == 'host' and mask != 0xffffffff:
+				raise FilterException("Use net for an address with a prefix length")
+			test = lambda at: f"int.from_bytes(d[{l3}+{at}:{l3}+{at + 4}], 'big') & {mask} == {value}"
+			return f"({ip(20)} and {either(direction, test(12), test(16))})"
+
+		if direction is not None:
+			raise FilterException(f"Expected host, net, port or portrange after {direction}, got '{word}'")
+
+		if word == 'proto':
+			return f"({ip(10)} and d[{l3}+9] == {number(take(), 0xff)})"
+		if word == 'len':
+			op = take()
+			if op not in ('<', '<=', '>', '>=', '=', '==', '!='):
+				raise FilterException(f"Expected a comparison after len, got '{op}'")
+			return f"w {'==' if op == '=' else op} {number(take())}"
+		if word == 'less':
+			return f"w <= {number(take())}"
+		if word == 'greater':
+			return f"w >= {number(take())}"
+
+		raise FilterException(f"Unknown filter primitive '{word}'")
+
+	def factor():
+		if peek() in ('not', '!'):
+			take()
+			return f"not {factor()}"
+		if peek() == '(':
+			take()
+			inner = combination()
+			if take() != ')':
+				raise FilterException("Expected ')'")
+			return f"({inner})"
+		return primitive()
+
+	def combination():
+		# and and or have the same precedence and group left to right, as in BPF
+		result = factor()
+		while peek() in ('and', '&&', 'or', '||'):
+			op = 'and' if take().lower() in ('and', '&&') else 'or'
+			result = f"({result} {op} {factor()})"
+		return result
+
+	if not tokens:
+		raise FilterException("Empty filter")
+
+	source = combination()
+	if tokens:
+		raise FilterException(f"Unexpected '{tokens[0]}' in filter")
+
+	test = eval(f"lambda d, o, n, w: {source}")
+	test.expression = expression
+	return test
+
+# Record layer keys: the name looked up -> (layer slot, the layer type it must have, None
+# for any), in lower and upper case so lookups skip lower(); other spellings fall back to it
+LAYER_KEYS = {
+	name: (index, None if name == names[0] else name)
+	for index, names in enumerate((('l2', 'ethernet', 'raw_ip', 'linux_sll'), ('l3', 'ip'), ('l4', 'tcp', 'udp', 'icmp')))
+	for name in names
+}
+LAYER_KEYS.update({name.upper(): key for name, key in LAYER_KEYS.items()})
+LAYER_NAMES = ('l2', 'l3', 'l4')
+# a layer peek found nothing at, as opposed to an L2 layer of unknown type (None)
+ABSENT = False
+
 class Record:
-	def __init__(self, pcap: PcapReader, L2=False, L3=True, L4=True):
+	"""
+	A view of the current record of a reader.  By default update decodes every layer of
+	each record; with lazy=True the layers are only decoded the first time one is looked
+	up, and `'tcp' in record` peeks at the IP version and protocol bytes instead.  Decoded
+	layers sit in fixed slots by level and record['tcp'] checks the type of the L4 slot.
+	"""
+	__slots__ = ('pcap', 'header', 'time', 'valid', 'lazy', 'layers', '_found', '_decoded')
+
+	def __init__(self, pcap: PcapReader, L2=False, L3=True, L4=True, lazy=False):
 		self.pcap = pcap
 		if pcap.header.linktype is not None and pcap.header.linktype != 101:
 			L2 = True
-		self._pointers = {}
 		self.header = RecordHeaderView(self)
 		self.time = TimestampView(self)
 		self.valid = False
+		self.lazy = lazy
+		self._decoded = False
 		self.layers = [
 			L2HeaderView(self) if L2 else None,
 			L3HeaderView(self) if L3 else None,
 			L4HeaderView(self) if L4 else None
 		]
+		self._found = [None, None, None]
 	def update(self):
-		self._pointers.clear()
-		offset = len(self.header)
+		self._decoded = False
+
+		if not self.lazy:
+			self.decode()
 
-		for index in range(len(self.layers)):
-			layer = self.layers[index]
-			L = index + 2
+	def decode(self):
+		self._decoded = True
+		found = self._found
+		found[0] = found[1] = found[2] = None
+		offset = len(self.header)
+		end = len(self)
 
-			if offset >= len(self):
+		for index, layer in enumerate(self.layers):
+			if offset >= end:
 				break
 
 			if layer is not None:
@@ -266,8 +1741,7 @@ class Record:
 				if not layer.valid:
 					break
 
-				self[f'L{L}'] = layer
-				self[layer.type] = layer
+				found[index] = layer
 
 				if len(layer) == 0:
 					break
@@ -284,11 +1758,68 @@ class Record:
 	def endian(self):
 		return self.pcap.header.endian
 
+	def unpack(self, fmt, offset: int):
+		"""Unpack fmt, a format string or a precompiled struct.Struct, at offset in the record."""
+		if not isinstance(fmt, struct.Struct):
+			fmt = struct.Struct(fmt)
+		# unpack_from would happily read past the end of the record into whatever follows it
+		if offset + fmt.size > len(self):
+			raise struct.error(f"record too short to unpack '{fmt.format}' at {offset}")
+		return fmt.unpack_from(self.data, self.offset + offset)
+
 	def __len__(self):
 		return len(self.header) + self.header.incl_len
+	def _types(self):
+		# the type of each layer decode would find, ABSENT where it would stop, from the
+		# version and protocol bytes alone
+		if self._decoded:
+			return tuple(ABSENT if layer is None else layer.type for layer in self._found)
+
+		types = [ABSENT, ABSENT, ABSENT]
+		offset = len(self.header)
+		end = len(self)
+		L2, L3, L4 = self.layers
+
+		try:
+			if L2 is not None and offset < end:
+				types[0] = L2.type
+				if len(L2) == 0:
+					return types
+				offset += len(L2)
+
+			if L3 is None or offset >= end or self[offset] >> 4 != 4:
+				return types
+			types[1] = 'ip'
+
+			ihl = self[offset] & 0x0f
+			proto = self[offset + 9]
+			offset += ihl * 4
+
+			if L4 is None or ihl == 0 or offset >= end:
+				return types
+			types[2] = L4_TYPES.get(proto, ABSENT)
+		except IndexError: # too short to peek at, let decode sort it out
+			self.decode()
+			return self._types()
+
+		return types
+	def peek(self):
+		"""Names of the layers decode would find, from the version and protocol bytes alone."""
+		keys = set()
+		for name, t in zip(LAYER_NAMES, self._types()):
+			if t is not ABSENT:
+				keys.update((name, t))
+		return keys
+
 	def __getitem__(self, key):
 		if isinstance(key, str):
-			return self._pointers[key.lower()]
+			if not self._decoded:
+				self.decode()
+			index, tag = LAYER_KEYS.get(key) or LAYER_KEYS.get(key.lower(), (None, None))
+			layer = self._found[index] if index is not None else None
+			if layer is None or (tag is not None and layer.type != tag):
+				raise KeyError(key)
+			return layer
 		elif isinstance(key, slice):
 			start, stop, step = key.indices(len(self))
 			return self.data[start + self.offset : stop + self.offset : step]
@@ -296,22 +1827,26 @@ class Record:
 			return self.data[key + self.offset]
 		else:
 			raise TypeError('Invalid argument type: {}'.format(type(key)))
-	def __setitem__(self, key, data):
-		if isinstance(key, str):
-			self._pointers[key.lower()] = data
-		else:
-			raise TypeError('Invalid argument type: {}'.format(type(key)))
 	def __contains__(self, key):
 		if isinstance(key, str):
-			return key.lower() in self._pointers
+			index, tag = LAYER_KEYS.get(key) or LAYER_KEYS.get(key.lower(), (None, None))
+			if index is None:
+				return False
+			if self._decoded:
+				layer = self._found[index]
+				return layer is not None and (tag is None or layer.type == tag)
+			t = self._types()[index]
+			return t is not ABSENT and (tag is None or t == tag)
 		else:
 			raise TypeError('Invalid argument type: {}'.format(type(key)))
 	def __str__(self):
 		return f"{str(self.time)} {self.header.incl_len} {self.header.orig_len}  {self['ip'].src}:{self['tcp'].sport} ==> {self['ip'].dst}:{self['tcp'].dport}"
 	def __bytes__(self):
-		return self[:]
+		return bytes(self[:])
 
 class MutableRecord(Record):
+	__slots__ = ('_data',)
+
 	def update(self):
 		self._data = self.pcap.buffer[self.pcap.pos:self.pcap.pos + len(self)]
 	@property
@@ -323,31 +1858,45 @@ class MutableRecord(Record):
 
 @functools.total_ordering
 class Timestamp:
+	"""
+	A point in time (or a difference between two) held as one integer number of
+	nanoseconds, so comparing, adding and subtracting are plain integer operations.
+	sigfigs is the number of fractional digits printed: 6 unless built from nsec.
+	"""
+	__slots__ = ('ns', '_sigfigs')
+
 	def __init__(self, sec=0, usec=0, nsec=None):
-		self.sec = int(sec)
 		self._sigfigs = 9 if nsec is not None else 6
-		self.nsec = nsec if nsec is not None else usec * 1000
+		self.ns = int(sec) * 10**9 + (nsec if nsec is not None else usec * 1000)
+	def from_ns(ns: int, sigfigs: int = 9):
+		ts = Timestamp()
+		ts.ns = ns
+		ts._sigfigs = sigfigs
+		return ts
 	def from_str(s):
 		if 'e' in s.lower():
-			s = f'{float(s):.9f}'.rstrip('0.')
-		if '.' not in s:
-			s += '.0'
-		if s[-1] == '.':
-			s += '0'
+			s = f'{float(s):.9f}'
 
-		sec, rem = s.split('.', 1)
+		sign = -1 if s.startswith('-') else 1
+		sec, _, rem = s.lstrip('+-').partition('.')
 		sigfigs = 9 if len(rem) > 6 else 6
-		sec = int(sec)
-		rem = int(rem.zfill(sigfigs)[:sigfigs])
 
-		return Timestamp(
-			sec=sec,
-			usec=0 if sigfigs == 9 else rem,
-			nsec=0 if sigfigs == 6 else rem
-		)
+		return Timestamp.from_ns(sign * (int(sec or 0) * 10**9 + int(rem[:9].ljust(9, '0'))), sigfigs)
+	@property
+	def sec(self) -> int:
+		return self.ns // 10**9
+	@sec.setter
+	def sec(self, sec: int):
+		self.ns = int(sec) * 10**9 + self.ns % 10**9
+	@property
+	def nsec(self) -> int:
+		return self.ns % 10**9
+	@nsec.setter
+	def nsec(self, nsec: int):
+		self.ns = self.ns - self.ns % 10**9 + int(nsec)
 	@property
 	def usec(self) -> int:
-		return int(self.nsec / 1000)
+		return self.nsec // 1000
 	@property
 	def sigfigs(self) -> int:
 		return self._sigfigs
@@ -355,28 +1904,41 @@ class Timestamp:
 	def frac(self) -> float:
 		return self.nsec / 10**self.sigfigs
 	def __str__(self):
-		return f"{self.sec}.{str(self.nsec if self.sigfigs == 9 else self.usec).zfill(self.sigfigs)}"
+		ns = abs(self.ns)
+		frac = ns % 10**9 if self.sigfigs == 9 else ns % 10**9 // 1000
+		return f"{'-' if self.ns < 0 else ''}{ns // 10**9}.{str(frac).zfill(self.sigfigs)}"
 	def __int__(self):
-		return self.sec
+		# truncate towards zero like int(float)
+		return self.ns // 10**9 if self.ns >= 0 else -(-self.ns // 10**9)
 	def __float__(self):
-		return float(str(self))
+		return self.ns / 10**9
+	def __hash__(self):
+		return hash(self.ns)
 	def __lt__(self, rhs):
-		return self.sec < rhs.sec or (self.sec == rhs.sec and self.nsec < rhs.nsec)
+		return self.ns < rhs.ns
+	def __eq__(self, rhs):
+		if not isinstance(rhs, Timestamp):
+			return NotImplemented
+		return self.ns == rhs.ns
 	def __add__(self, rhs):
-		return Timestamp.from_str(str(Decimal(str(self)) + Decimal(str(rhs))))
+		if not isinstance(rhs, Timestamp):
+			rhs = Timestamp.from_str(str(rhs))
+		return Timestamp.from_ns(self.ns + rhs.ns, max(self.sigfigs, rhs.sigfigs))
 	def __sub__(self, rhs):
-		return Timestamp.from_str(str(Decimal(str(self)) - Decimal(str(rhs))))
-#		return self.__class__(
-#			sec=self.sec - rhs.sec - int((self.nsec + rhs.nsec) / 10**9),
-#			nsec=(self.nsec - rhs.nsec) % 10**9
-#		)
-	def __eq__(self, rhs):
-		return self.sec == rhs.sec and self.nsec == rhs.nsec
+		if not isinstance(rhs, Timestamp):
+			rhs = Timestamp.from_str(str(rhs))
+		return Timestamp.from_ns(self.ns - rhs.ns, max(self.sigfigs, rhs.sigfigs))
 
 class TimestampView(Timestamp):
+	__slots__ = ('record',)
+
 	def __init__(self, record: Record):
 		self.record = record
 	@property
+	def ns(self) -> int:
+		header = self.record.header
+		return header.ts_sec * 1000000000 + header.ts_usec * (1 if self.record.pcap.header.nano else 1000)
+	@property
 	def sec(self) -> int:
 		return self.record.header.ts_sec
 	@property
@@ -391,20 +1953,39 @@ class TimestampView(Timestamp):
 
 
 class RecordHeaderView:
+	__slots__ = ('record', 'ts_sec', 'ts_usec', 'incl_len', 'orig_len', '_unpack')
+
 	def __init__(self, record: Record):
 		self.record = record
 		self.incl_len = len(self) # prevent circularity
+		self._unpack = struct.Struct(record.endian + 'IIII').unpack_from
 	def update(self):
-		self.ts_sec, self.ts_usec, self.incl_len, self.orig_len = struct.unpack(
-			self.record.endian + 'IIII',
-			self.record[:RECORD_HEADER_LEN]
-		)
+		# the reader has the whole header buffered before it asks for an update
+		self.ts_sec, self.ts_usec, self.incl_len, self.orig_len = \
+			self._unpack(self.record.data, self.record.offset)
 	def __len__(self):
 		return RECORD_HEADER_LEN
 	def __str__(self):
 		return f"RecordHeader ts={self.ts_sec}.{self.ts_usec} len={self.incl_len}/{self.orig_len}"
 
+class PcapngRecordHeaderView(RecordHeaderView):
+	"""The header of a pcapng packet block, filled in by PcapngReader as it reads the block."""
+	__slots__ = ('len', 'interface')
+
+	def __init__(self, record: Record):
+		self.len = PCAPNG_PACKET_HEADER_LEN
+		super().__init__(record)
+		self.interface = 0
+	def update(self):
+		pass
+	def __len__(self):
+		return self.len
+	def __str__(self):
+		return f"PcapngRecordHeader if={self.interface} ts={self.ts_sec}.{self.ts_usec} len={self.incl_len}/{self.orig_len}"
+
 class PacketHeaderView:
+	__slots__ = ('record', 'valid', 'offset', 'type')
+
 	def __init__(self, record: Record):
 		self.record = record
 	def update(self, offset: int):
@@ -419,6 +2000,8 @@ class PacketHeaderView:
 		pass
 
 class L2HeaderView(PacketHeaderView):
+	__slots__ = ('linktype', 'len', 'bsrc', 'bdst', 'ethtype')
+
 	def __init__(self, record: Record):
 		super().__init__(record)
 		self.record = record
@@ -463,26 +2046,30 @@ class L2HeaderView(PacketHeaderView):
 	def __len__(self):
 		return self.len
 	def __bytes__(self):
-		return self.record[self.offset:self.offset+self.len]
+		return bytes(self.record[self.offset:self.offset+self.len])
 
 class L3HeaderView(PacketHeaderView):
+	__slots__ = ('version', 'ihl', 'tos', 'len', 'id', 'off', 'ttl', 'proto', 'csum', 'bsrc', 'bdst', 'options')
+
 	def __init__(self, record: Record):
 		super().__init__(record)
 	def _update(self, offset: int):
 		self.offset = offset
-		b = self.record[offset]
+		record = self.record
+		data, base, end = record.data, record.offset, len(record)
+		b = data[base + offset]
 		self.version = (b >> 4) & 0x0f
 
 		if self.version == 4:
 			self.type = 'ip'
 			self.ihl = b & 0x0f
-			b = bytes(self)
 
 			self.tos, self.len, self.id, self.off, self.ttl, self.proto, self.csum = \
-				struct.unpack('!BHHHBBH', b[1:12])
-			self.bsrc = b[12:16]
-			self.bdst = b[16:20]
-			self.options = b[20:len(self)]
+				record.unpack(IP_FIELDS, offset+1)
+			# sliced straight from the reader's buffer, cut off at the end of the record like record[a:b]
+			self.bsrc = bytes(data[base + min(offset+12, end):base + min(offset+16, end)])
+			self.bdst = bytes(data[base + min(offset+16, end):base + min(offset+20, end)])
+			self.options = bytes(data[base + min(offset+20, end):base + min(offset+self.ihl*4, end)])
 		# elif self.version == 6:
 		# 	self.type = 'ip6'
 		# 	self.ihl = 10
@@ -505,37 +2092,44 @@ class L3HeaderView(PacketHeaderView):
 	def __len__(self):
 		return self.ihl * 4 if self.valid else 0
 	def __bytes__(self):
-		return self.record[self.offset:self.offset+ self.ihl*4]
+		return bytes(self.record[self.offset:self.offset+ self.ihl*4])
 
 class L4HeaderView(PacketHeaderView):
+	__slots__ = (
+		'sport', 'dport', 'seq', 'ack', 'data_off', 'flags', 'win', 'csum', 'urgent', 'len', 'options',
+		'total_len', 'mtype', 'code', 'rest'
+	)
+
 	def __init__(self, record: Record):
 		super().__init__(record)
 	def _update(self, offset: int):
 		self.offset = offset
-		proto = self.record['L3'].proto
+		record = self.record
+		proto = record.layers[1].proto
 
 		if proto == 6:
 			self.type = 'tcp'
 			self.sport, self.dport, self.seq, self.ack, self.data_off, self.flags, self.win, self.csum, self.urgent = \
-				struct.unpack('!HHIIBBHHH', self.record[offset:offset+20])
+				record.unpack(TCP_FIELDS, offset)
 			self.flags |= ((self.data_off & 0x01) << 8)
 			self.len = ((self.data_off >> 4) & 0x0f) * 4
-			self.options = self.record[offset+20:offset+len(self)]
+			data, base, end = record.data, record.offset, len(record)
+			self.options = bytes(data[base + min(offset+20, end):base + min(offset+self.len, end)])
 		elif proto == 17:
 			self.type = 'udp'
 			self.sport, self.dport, self.total_len, self.csum = \
-				struct.unpack('!HHHH', self.record[offset:offset+8])
+				record.unpack(UDP_FIELDS, offset)
 			self.len = 8
 		elif proto == 1:
 			self.type = 'icmp'
 			self.mtype, self.code, self.csum = \
-				struct.unpack('!BBH', self.record[offset:offset+4])
-			self.len = min(len(self.record) - offset, 8) # may or may not have the defined "rest of header" bytes
-			self.rest = self.record[offset+4:offset+self.len] # may be 0-length
+				record.unpack(ICMP_FIELDS, offset)
+			self.len = min(len(record) - offset, 8) # may or may not have the defined "rest of header" bytes
+			self.rest = bytes(record[offset+4:offset+self.len]) # may be 0-length
 		else:
 			self.type = None
 			raise LayerException(f"Unknown L3 protocol {proto}")
 	def __len__(self):
 		return self.len if self.valid else 0
 	def __bytes__(self):
-		return self.record[self.offset:self.offset+self.len]
+		return bytes(self.record[self.offset:self.offset+self.len])
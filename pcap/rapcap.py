@@ -1,6 +1,16 @@
-import pcap_util
-import heapq
-import time
+#!/usr/bin/env python3
+
+import os
+import mmap
+import struct
+import argparse
+import warnings
+import multiprocessing
+
+try:
+	import pcap_util
+except ImportError: # imported from the repository root
+	from pcap import pcap_util
 
 HEADER_LEN = 16
 INCL_OFFSET = 8
@@ -13,136 +23,298 @@ class Stats:
 		self.solutions_tested = 0
 		self.nonmerges = 0
 
-class Solution:
-	def __init__(self, last_i, next_i):
-		self.last_index = last_i
-		self.next_index = next_i
-		self.length = 0
-	def __repr__(self):
-		return "(%d,%d,%d)" % (self.last_index, self.next_index, self.length)
-	def __eq__(self, c):
-		if self.next_index == c.next_index: return True
-		return False
-	def __gt__(self, c):
-		if self.next_index > c.next_index: return True
-		return False
-	def __lt__(self, c):
-		if self.next_index < c.next_index: return True
-		return False
-	def __ge__(self, c):
-		return self > c or self == c
-	def __le__(self, c):
-		return self < c or self == c
-
-def validate_header(byte_array, index, snap_len, swap):
-	incl_len = pcap_util.btoint(byte_array[index+8 : index+12], swap)
-	orig_len = pcap_util.btoint(byte_array[index+12 : index+16], swap)
+def validate_header(byte_array, index, snap_len, endian):
+	if index + HEADER_LEN > len(byte_array):
+		return 0
+
+	incl_len, orig_len = struct.unpack_from(endian + 'II', byte_array, index + INCL_OFFSET)
 
 	if incl_len > 0 and incl_len == min(orig_len, snap_len):
 		return incl_len
 
 	return 0
 
-def find_start(file, snap_len, swap, stats):
-	# grab chunks in size of complete max length packet and header
-	packet_len = snap_len + HEADER_LEN
+def find_start(file, snap_len, endian, stats=None):
+	"""
+	Find the first record boundary at or after the current position of file, returned as
+	an offset from that position.  endian is the byte order of the pcap ('<' or '>').
+
+	Every byte of the first snap_len + HEADER_LEN bytes is a candidate header, checked in
+	one vectorized pass.  Each valid candidate starts a chain of records, and all chains
+	are followed together with array operations.  A chain ends at a header that doesn't
+	validate (a death), or when it reaches a header another chain has already been
+	through (a merge: from there on they are the same chain).
 
-#	print 'using chunk size', packet_len
+	The answer is the same as walking the chains one header at a time in file order:
+	the last chain standing, starting from the last point something merged into it.
+	It is returned at the first header of that chain past every other chain's death and
+	every merge into it, which is when the in-order walk would be left with one chain.
+	"""
+	import numpy as np
 
-	# candidate list of tuples (next_header_index, start_index) to make it simpler to use
-	# bisect for insertion, because python compares tuples by first element first.
-	# candidates are all possible header start bytes, avoiding partial header at the end
-	# we keep this list in reverse order so all removals are from the back, and we insert
-	# (in order) rarely
-	#
-	# in theory, the ideal data structure here would be one optimized for insert and
-	# peek/removal of minimum.  a BST can do both in O(lg n), maybe a hybrid BST over
-	# linked list for O(lg n) insertion and O(1) popmin?
-	solutions = []
-	heapq.heapify(solutions)
+	if stats is None:
+		stats = Stats()
 
 	# worst case: missing first byte of header at start, with a max length
 	# packet.  need to get the complete next header.
+	packet_len = snap_len + HEADER_LEN
 	chunk = file.read(packet_len + HEADER_LEN - 1)
-	file_offset = 0
+	chunk_offset = 0
 	stats.file_reads += 1
 
-#	print 'initial sample is %d bytes' % (len(chunk))
+	lengths = np.dtype([('incl_len', endian + 'u4'), ('orig_len', endian + 'u4')])
 
-	# differentiate between candidates and solutions: candidates are untested, solutions
-	# have passed initial test.  needed for coalescing: a tree solution is when two solutions
-	# point to the same index, not candidates.  also, all candidates exist in the first read
+	def validate(index):
+		# vectorized validate_header: incl_len of the header at each index, 0 if invalid
+		data = np.frombuffer(chunk, dtype=np.uint8)
+		fields = data[(index - chunk_offset)[:, None] + np.arange(INCL_OFFSET, HEADER_LEN)].view(lengths)[:, 0]
+		incl_len = fields['incl_len'].astype(np.int64)
+		valid = (incl_len > 0) & (incl_len == np.minimum(fields['orig_len'], snap_len))
+		return np.where(valid, incl_len, 0)
 
-#	start = time.clock()
+	candidates = np.arange(max(0, min(packet_len, len(chunk) - HEADER_LEN + 1)), dtype=np.int64)
+	incl_len = validate(candidates)
+	start = candidates[incl_len > 0]
 
-	for index in range(packet_len):
-#		header = pcap_util.PacketHeader(chunk, index, swap)
-		incl_len = validate_header(chunk, index, snap_len, swap)
-		if incl_len != 0:
-			s = Solution(index, index + incl_len + HEADER_LEN)
-			heapq.heappush(solutions, s)
+	if len(start) == 0:
+		raise ValueError("No solution")
 
-#	print 'initial parse:', time.clock() - start
-#	print 'initial solutions:', solutions
+	# per chain: the chain it merged into and where, or where it died (-1 while alive)
+	parent = np.arange(len(start))
+	merged_at = np.full(len(start), -1)
+	died_at = np.full(len(start), -1)
 
-	if len(solutions) == 0:
-		raise ValueError("No solution")
+	# chains being followed and the header each will test next
+	chain = np.arange(len(start))
+	next_index = start + incl_len[incl_len > 0] + HEADER_LEN
+
+	# chain that tested each header in chunk, whether it was valid or not
+	tested = np.full(len(chunk), -1)
+	path_index, path_chain = [], []
+	answer = None
+	n_tested = 0
+
+	def result():
+		# group chains by the chain they ended up merged into
+		root = parent.copy()
+		while True:
+			up = root[root]
+			if (up == root).all():
+				break
+			root = up
+
+		groups = np.flatnonzero(root == np.arange(len(root)))
+		end = np.where(died_at[groups] >= 0, died_at[groups], np.iinfo(np.int64).max)
+		if np.count_nonzero(end == end.max()) > 1:
+			# parallel solutions
+			raise ValueError("Parallel solutions")
+
+		last = groups[end.argmax()]
+		others = np.delete(end, end.argmax())
+		merges = merged_at[(root == last) & (merged_at >= 0)]
+		need = max(merges.max() if len(merges) else -1, others.max() + 1 if len(others) else -1)
+
+		# nothing may have been tested yet if a single chain was left from the start
+		index = np.concatenate(path_index) if path_index else np.empty(0, dtype=np.int64)
+		passed = index[(np.concatenate(path_chain) == last) & (index >= need)] if path_index else index
+		return len(passed) > 0, need, int(merges.max()) if len(merges) else int(start[last])
+
+	while True:
+		# chains arriving at the same header merge there
+		next_index, first, inverse = np.unique(next_index, return_index=True, return_inverse=True)
+		duplicate = np.ones(len(chain), dtype=bool)
+		duplicate[first] = False
+		parent[chain[duplicate]] = chain[first][inverse][duplicate]
+		merged_at[chain[duplicate]] = next_index[inverse][duplicate]
+		chain = chain[first]
+
+		# arriving where another chain has already been, even if it died there: the heap
+		# walk would have merged them on that header before testing it
+		inside = next_index < chunk_offset + len(tested)
+		other = np.full(len(chain), -1)
+		other[inside] = tested[next_index[inside] - chunk_offset]
+		follows = other >= 0
+		parent[chain[follows]] = other[follows]
+		merged_at[chain[follows]] = next_index[follows]
+		chain, next_index = chain[~follows], next_index[~follows]
+
+		if len(chain) == 0:
+			found, _, answer = result()
+			if found:
+				return answer
+			raise ValueError("No solution")
+
+		if len(chain) == 1:
+			# only the last chain is left: done once it tests a header past need, until
+			# then it is followed on like before
+			if answer is None:
+				found, need, answer = result()
+				if found:
+					return answer
+			elif len(path_index) > n_tested and path_index[-1].max(initial=-1) >= need:
+				return answer
+			n_tested = len(path_index)
+
+		ready = next_index + HEADER_LEN <= chunk_offset + len(chunk)
+
+		if not ready.any():
+			# drop what every chain is past, then read on
+			skip = min(int(next_index[0]) - chunk_offset, len(chunk))
+			bytes_read = file.read(packet_len)
+			stats.file_reads += 1
+
+			if len(bytes_read) == 0:
+				# parallel solutions
+				raise ValueError("Parallel solutions")
+
+			chunk = chunk[skip:] + bytes_read
+			tested = np.concatenate((tested[skip:], np.full(len(chunk) - len(tested) + skip, -1)))
+			chunk_offset += skip
+			continue
+
+		incl_len = validate(next_index[ready])
+		valid = incl_len > 0
+		index, ready_chain = next_index[ready], chain[ready]
+		stats.solutions_tested += len(index)
+		stats.bytes_tested = int(index.max()) + HEADER_LEN
+		stats.nonmerges += int(np.count_nonzero(valid))
+
+		tested[index - chunk_offset] = ready_chain
+		died_at[ready_chain[~valid]] = index[~valid]
+		path_index.append(index[valid])
+		path_chain.append(ready_chain[valid])
+
+		chain = np.concatenate((ready_chain[valid], chain[~ready]))
+		next_index = np.concatenate((index[valid] + incl_len[valid] + HEADER_LEN, next_index[~ready]))
+
+def chunk_ranges(fn, n_chunks, stats=None):
+	"""
+	Split the records of fn into at most n_chunks (start, end) byte ranges of roughly equal
+	size.  Each start is moved forward to a record boundary with find_start.  A split point
+	that can't be placed, because the candidate chains run to the end of the file or past
+	the next split point, is dropped with a warning and its chunk merged into the previous one.
+	"""
+	with open(fn, 'rb') as f:
+		header = pcap_util.PcapHeader(f.read(24))
+		size = os.fstat(f.fileno()).st_size
+		starts = [len(header)]
+
+		for i in range(1, n_chunks):
+			offset = len(header) + (size - len(header)) * i // n_chunks
+			f.seek(offset)
+
+			try:
+				offset += find_start(f, header.snaplen, header.endian, stats)
+			except ValueError:
+				# only chains still going at the end of the file can't be told apart
+				if f.tell() < size:
+					raise
+				warnings.warn(f"No record boundary found after {offset} in {fn}, chunk {i} is merged into the previous one")
+				continue
+
+			if offset > starts[-1] and offset < size:
+				starts.append(offset)
+			else:
+				warnings.warn(f"Record boundary for chunk {i} of {fn} is at {offset}, the chunk is merged into the previous one")
+
+	return list(zip(starts, starts[1:] + [size]))
+
+def read_range(task):
+	fn, start, end, func = task
+
+	with pcap_util.MmapPcapReader(fn, start=start, end=end) as reader:
+		result = func(reader)
+		return result, reader.next_pos
+
+def decode_range(reader):
+	batches = list(reader.iter_batches())
+	if len(batches) == 0:
+		return reader.read_batch(0)
+
+	import numpy as np
+	return np.concatenate(batches)
+
+def parallel_map(fn, func=decode_range, n_chunks=None, processes=None):
+	"""
+	Split fn into record-aligned chunks and call func(reader) on a MmapPcapReader limited to
+	each chunk in a process pool, yielding the results in file order.  func has to be a
+	module-level function so it can be sent to the workers; it can return its results or
+	write them out per chunk.  The default decodes each chunk into a batch array.
+	"""
+	processes = processes or os.cpu_count()
+	ranges = chunk_ranges(fn, n_chunks or processes)
+	tasks = [(fn, start, end, func) for start, end in ranges]
+
+	with multiprocessing.Pool(processes) as pool:
+		for (start, end), (result, stop) in zip(ranges, pool.imap(read_range, tasks)):
+			# a chunk that read past its end was cut at a false boundary and overlaps the next one
+			if stop > end:
+				raise ValueError(f"Chunk {start}-{end} ended at {stop}, misaligned chunk boundary")
+
+			yield result
+
+def repair(infile, outfile, stats=None):
+	"""
+	Copy the records of infile to outfile, skipping damaged regions.  Records are followed
+	while their lengths fit the snaplen and the file; at a bad one, find_start looks for the
+	next record boundary.  Returns the (offset, length) of each region skipped.
+	"""
+	damaged = []
+
+	with open(infile, 'rb') as f, open(outfile, 'wb') as out:
+		header = pcap_util.PcapHeader(f.read(24))
+		size = os.fstat(f.fileno()).st_size
+		out.write(bytes(header))
 
-	# test solutions
-	while len(chunk) >= HEADER_LEN:
-#		start = time.clock()
+		if size <= len(header):
+			return damaged
 
-		max_index = file_offset + len(chunk) - HEADER_LEN
-#		print 'max index:', max_index
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+			pos = len(header)
 
-		while solutions[0].next_index <= max_index:
-#			print solutions
-			s = heapq.heappop(solutions)
+			while pos < size:
+				run = pos
 
-			stats.bytes_tested = s.next_index + HEADER_LEN
-			stats.solutions_tested += 1
+				while pos + HEADER_LEN <= size:
+					incl_len, orig_len = struct.unpack_from(header.endian + 'II', m, pos + INCL_OFFSET)
+					if incl_len == 0 or incl_len > min(orig_len, header.snaplen) or pos + HEADER_LEN + incl_len > size:
+						break
+					pos += HEADER_LEN + incl_len
 
-#			print 'testing solution', s
+				out.write(m[run:pos])
 
-			# here we check for a tree solution, which is multiple candidates pointing
-			# to the same index.  it's impossible to tell which is correct, so we'll
-			# coalesce and mark the solution as a tree for later removal.  if this results
-			# in an empty solution set, it will be caught when the loop exits as a single
-			# tree solution
-			while len(solutions) > 0 and solutions[0].next_index == s.next_index:
-#				print 'converging with solution', solutions[0]
-				s.last_index = s.next_index
-				a = heapq.heappop(solutions)
-				s.length = max(s.length, a.length) + 1
+				if pos == size:
+					break
 
-			header_index = s.next_index - file_offset
-			incl_len = validate_header(chunk, header_index, snap_len, swap)
-#			header = pcap_util.PacketHeader(chunk, header_index, swap)
+				f.seek(pos + 1)
+				try:
+					resume = pos + 1 + find_start(f, header.snaplen, header.endian, stats)
+				except ValueError: # nothing usable left
+					resume = size
 
-#			if header.valid(snap_len):
-			if incl_len != 0:
-				if len(solutions) == 0:
-#					print 'iteration:', time.clock() - start
-					return s.last_index
+				damaged.append((pos, resume - pos))
+				pos = resume
 
-				if s.next_index != s.last_index:
-					stats.nonmerges += 1
+	return damaged
 
-				s.next_index += incl_len + HEADER_LEN
-#				print 'validated, new solution is', s
-				heapq.heappush(solutions, s)
-#			else:
-#				print 'throwing away solution', s
+def arguments():
+	ap = argparse.ArgumentParser(description='copy a pcap, skipping corrupted or truncated records')
+	ap.add_argument('infile', type=str)
+	ap.add_argument('outfile', type=str)
+	ap.add_argument('--quiet', action='store_true', help='don\'t list the damaged regions')
+	return ap.parse_args()
 
-#			print 'next solution to test will be', solutions[0]
+def main():
+	args = arguments()
 
-#		print 'iteration:', time.clock() - start
+	stats = Stats()
+	damaged = repair(args.infile, args.outfile, stats)
 
-		file_offset += packet_len
-		chunk = chunk[packet_len:] + file.read(packet_len)
-#		print '*** reading file, %d candidates left' % (len(solutions))
-		stats.file_reads += 1
+	if not args.quiet:
+		for offset, length in damaged:
+			print(f"skipped {length} bytes at {offset}")
 
-	# parallel solutions
-	raise ValueError("Parallel solutions")
+	print(f"{len(damaged)} damaged regions, {sum(length for _, length in damaged)} bytes lost")
 
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import zlib
+import argparse
+from pcap_util import PcapWriter, WRITE_BUFFER_SIZE, open_reader, pcap_stem
+from tcp_util import Flow
+
+def arguments():
+	ap = argparse.ArgumentParser(description='split a pcap into shards by flow, both directions of a flow go to the same shard')
+	ap.add_argument('infile', type=str)
+	ap.add_argument('-n', '--shards', type=int, default=os.cpu_count(), help='number of shards (default one per cpu)')
+	ap.add_argument('-o', '--outpath', type=str, default='.')
+	ap.add_argument('--limit', type=int)
+	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
+	ap.add_argument('--buffer_size', type=int, default=WRITE_BUFFER_SIZE, help='bytes buffered per shard before writing')
+	ap.add_argument('--readahead', action='store_true', help='read the input ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed input on a background thread or in a child process')
+	ap.add_argument('--filter', type=str, help='only keep packets matching this filter expression, e.g. "tcp and port 80"')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+
+	reader = None
+	writers = []
+
+	try:
+		reader = open_reader(args.infile, lazy=True, filter=args.filter, readahead=args.readahead, decompress=args.decompress)
+
+		stem = os.path.basename(pcap_stem(args.infile))
+		width = len(str(args.shards - 1))
+		for i in range(args.shards):
+			writers.append(PcapWriter(
+				os.path.join(args.outpath, f"{stem}.shard{i:0{width}d}.pcap"),
+				buffer_size=args.buffer_size,
+				endian=reader.header.endian,
+				nano=reader.header.nano,
+				version=reader.header.version,
+				snaplen=reader.header.snaplen,
+				fcs=reader.header.fcs,
+				linktype=reader.header.linktype
+			))
+			# every shard gets a header, even if no flow hashes to it
+			writers[-1].write_header()
+
+		flow = None
+		for pkt in reader:
+			if args.limit and reader.count > args.limit:
+				break
+
+			if 'tcp' in pkt or 'udp' in pkt:
+				if flow is None:
+					flow = Flow(pkt)
+				else:
+					ip, L4 = pkt['ip'], pkt['L4']
+					flow.src.ip, flow.dst.ip = ip.bsrc, ip.bdst
+					flow.src.port, flow.dst.port = L4.sport, L4.dport
+				shard = flow_hash(flow, pkt['ip'].proto) % args.shards
+			elif 'ip' in pkt:
+				ip = pkt['ip']
+				shard = zlib.crc32(min(ip.bsrc, ip.bdst) + max(ip.bsrc, ip.bdst) + bytes((ip.proto,))) % args.shards
+			else:
+				shard = 0
+
+			writers[shard].write_packet(pkt)
+
+			if args.checkpoint and reader.count % args.checkpoint == 0:
+				print(reader.count)
+
+		print(' '.join(str(writer.count) for writer in writers))
+
+	except:
+		raise
+	finally:
+		if reader is not None:
+			reader.close()
+		for writer in writers:
+			writer.close()
+
+FLOW_KEY = struct.Struct('!IHIHB')
+
+def flow_hash(flow: Flow, proto: int) -> int:
+	"""crc32 of the canonical 5-tuple of flow, the same for both of its directions."""
+	a, b = flow.ordered
+	return zlib.crc32(FLOW_KEY.pack(a.ip, a.port, b.ip, b.port, proto))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,37 +1,86 @@
 #!/usr/bin/env python3
 
-import os
+import csv
 import argparse
-import scapy.all
+from pcap_util import MmapPcapReader, PcapReader, PcapWriter, Timestamp, pcap_stem
 
-from tcp.tcp_state import Flow, is_syn_pkt
+MANIFEST_FIELDS = ['file', 'packets', 'first', 'last', 'window_start', 'window_end', 'start_offset', 'end_offset']
 
 def arguments():
-	ap = argparse.ArgumentParser()
+	ap = argparse.ArgumentParser(description='split a pcap into windows of fixed duration or size, outfile out.pcap gives out.0000.pcap, out.0001.pcap, ... and out.csv')
 	ap.add_argument('infile', type=str)
 	ap.add_argument('outfile', type=str)
-	ap.add_argument('--seconds', type=float)
+	ap.add_argument('--seconds', type=float, help='duration of each window, windows start at the first packet')
+	ap.add_argument('--size', type=int, help='maximum bytes per output file, records are never split')
+	ap.add_argument('--manifest', type=str, help='csv of the files written with their times and the byte offsets they came from in infile (default outfile with .csv)')
 	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
-	return ap.parse_args()
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input file instead of reading it')
+	ap.add_argument('--readahead', action='store_true', help='read the input ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed input on a background thread or in a child process')
+	args = ap.parse_args()
+	if args.seconds is None and args.size is None:
+		ap.error('one of --seconds or --size is required')
+	return args
 
 def main():
 	args = arguments()
+	stem = pcap_stem(args.outfile)
+	window_ns = Timestamp.from_str(str(args.seconds)).ns if args.seconds is not None else None
 
-	first_ts = None
 	reader = None
 	writer = None
+	manifest = None
 
 	try:
-		reader = scapy.all.PcapReader(args.infile)
-		writer = scapy.all.PcapWriter(args.outfile, linktype=reader.linktype, endianness=reader.endian)
+		# records are copied raw, lazy records never decode their layers
+		if args.mmap:
+			reader = MmapPcapReader(args.infile, lazy=True, decompress=args.decompress)
+		else:
+			reader = PcapReader(args.infile, lazy=True, readahead=args.readahead, decompress=args.decompress)
+
+		manifest = open(args.manifest or stem + '.csv', 'w', newline='')
+		rows = csv.writer(manifest)
+		rows.writerow(MANIFEST_FIELDS)
+
+		window = None
+		offset = len(reader.header)
 
 		for pkt in reader:
-			if first_ts is None:
-				first_ts = pkt.time
-			elif pkt.time - first_ts > args.seconds:
-				break
+			ns = pkt.time.ns
+			n = len(pkt)
+
+			if window is not None and (
+				(window_ns is not None and ns >= window.end) or
+				(args.size is not None and writer.len + n > args.size)
+			):
+				writer.close()
+				rows.writerow(window.row(writer))
+				writer = None
 
-			writer.write_packet(pkt, sec=int(pkt.time), usec=round((pkt.time % 1) * 1000000))
+			if writer is None:
+				window = Window(ns, offset, window, window_ns)
+				writer = PcapWriter(
+					f"{stem}.{window.index:04d}.pcap",
+					endian=reader.header.endian,
+					nano=reader.header.nano,
+					version=reader.header.version,
+					snaplen=reader.header.snaplen,
+					fcs=reader.header.fcs,
+					linktype=reader.header.linktype
+				)
+
+			writer.write_packet(pkt)
+			window.last = ns
+			offset += n
+			window.end_offset = offset
+
+			if args.checkpoint and reader.count % args.checkpoint == 0:
+				print(reader.count)
+
+		if writer is not None:
+			writer.close()
+			rows.writerow(window.row(writer))
+			writer = None
 
 	except:
 		raise
@@ -40,6 +89,36 @@ def main():
 			reader.close()
 		if writer is not None:
 			writer.close()
+		if manifest is not None:
+			manifest.close()
+
+class Window:
+	"""
+	One output file: the records from start_offset up to end_offset of the input.  With a
+	duration the window covers [start, end) counted in whole durations from the first packet;
+	a window cut short by --size is followed by another with the same bounds.
+	"""
+	def __init__(self, ns: int, offset: int, previous=None, window_ns: int = None):
+		self.index = previous.index + 1 if previous else 0
+		self.first = self.last = ns
+		self.start_offset = self.end_offset = offset
+		self.origin = previous.origin if previous else ns
+		self.start = self.end = None
+
+		if window_ns is not None:
+			if previous is not None and ns < previous.end:
+				self.start, self.end = previous.start, previous.end
+			else:
+				self.start = self.origin + (ns - self.origin) // window_ns * window_ns
+				self.end = self.start + window_ns
+
+	def row(self, writer: PcapWriter):
+		ts = lambda ns: '' if ns is None else str(Timestamp.from_ns(ns))
+		return [
+			writer.fn, writer.count,
+			ts(self.first), ts(self.last), ts(self.start), ts(self.end),
+			self.start_offset, self.end_offset
+		]
 
 if __name__ == '__main__':
 	main()
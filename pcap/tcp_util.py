@@ -43,8 +43,9 @@ class Address:
 
 class Flow:
     def __init__(self, pkt):
-        self.src = Address(pkt['IP'].src, pkt['TCP'].sport)
-        self.dst = Address(pkt['IP'].dst, pkt['TCP'].dport)
+        L4 = pkt['TCP'] if 'TCP' in pkt else pkt['UDP']
+        self.src = Address(pkt['IP'].src, L4.sport)
+        self.dst = Address(pkt['IP'].dst, L4.dport)
     def __hash__(self):
         return hash(self.ordered)
     def __repr__(self):
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+from pcap_util import TimesFile, pcap_stem, write_times
+
+def arguments():
+	ap = argparse.ArgumentParser(description='convert a .times sidecar between text sec.nsec lines and binary uint64 ns')
+	ap.add_argument('infile', type=str, help='a .times file, or a pcap to convert the .times sidecar of')
+	ap.add_argument('outfile', type=str, nargs='?', help='by default infile is converted in place')
+	ap.add_argument('--text', action='store_true', help='write text lines instead of binary')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+	infile = args.infile if args.infile.endswith('.times') else pcap_stem(args.infile) + '.times'
+	outfile = args.outfile or infile
+
+	times = None
+
+	try:
+		times = TimesFile(infile)
+		n = times.count()
+		if times.binary != args.text and outfile == infile:
+			print(f"{infile}: already {'text' if args.text else 'binary'}")
+			return
+
+		# outfile may be infile, both writers go through a temporary file
+		if args.text:
+			write_text(outfile, (times[k] for k in range(n)))
+		else:
+			write_times(outfile, (times[k] for k in range(n)))
+
+		print(f"{outfile}: wrote {n} times")
+
+	except:
+		raise
+	finally:
+		if times is not None:
+			times.close()
+
+def write_text(fn, ns):
+	tmp = fn + '.tmp'
+	with open(tmp, 'w') as f:
+		for t in ns:
+			sec, nsec = divmod(t, 1000000000)
+			f.write(f"{sec}.{nsec:09d}\n")
+	os.replace(tmp, fn)
+
+
+if __name__ == '__main__':
+	main()
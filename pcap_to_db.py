@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
 
 import os
-import struct
+import heapq
+import queue
 import argparse
+import multiprocessing
 import sqlite3 as sql
-from pcap.pcap_util import PcapReader, Timestamp
-from generator.checksum import Checksum, invert, sum_words
-from pcap.tcp_util import Flow
+from collections import deque
+from operator import itemgetter
+from pcap.pcap_util import RECORD_HEADER_LEN, MergeReader, Timestamp, build_index, compile_filter, compression, first_time, load_index, open_reader, open_times, pcap_format
+from generator.checksum import checksum_endian_transform, invert, record_payload_checksum, sum_segments
+
+# packets whose payload checksums are computed together
+CHECKSUM_BATCH = 4096
+# with --jobs, uncompressed pcaps bigger than this are decoded in chunks of about this many bytes
+JOB_CHUNK_SIZE = 1<<23
+# with --jobs, rows of a compressed or pcapng input sent back at a time, and how many such batches may wait
+STREAM_BATCH = 4096
+STREAM_BATCHES = 8
+# seconds to wait on a batch before checking that the process decoding the input is still running
+STREAM_TIMEOUT = 1
 
 def arguments():
 	ap = argparse.ArgumentParser()
@@ -15,8 +28,16 @@ def arguments():
 	ap.add_argument('--limit_in', type=int)
 	ap.add_argument('--limit_out', type=int)
 	ap.add_argument('--seconds', type=float)
+	ap.add_argument('--start', type=float, help='start this many seconds after the first packet, seeking with the .pcapidx index of an uncompressed pcap and reading up to it otherwise')
 	ap.add_argument('--verbose', action='store_true')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input files instead of reading them')
+	ap.add_argument('--readahead', action='store_true', help='read the inputs ahead on a background thread')
+	ap.add_argument('--decompress', choices=['thread', 'process'], help='decompress compressed inputs on a background thread or in a child process')
+	ap.add_argument('--filter', type=str, help='only keep tcp packets matching this filter expression, e.g. "dst port 443"')
 	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
+	ap.add_argument('-j', '--jobs', type=int, help='decode the inputs in this many worker processes (0 for one per cpu), the rows are still written in merged order; '
+		'each compressed or pcapng input is decoded by one process of its own, and merging and inserting the rows stays in the main process')
+	ap.add_argument('--chunk_size', type=int, default=JOB_CHUNK_SIZE, help='with --jobs, bytes of an uncompressed pcap decoded per task')
 	return ap.parse_args()
 
 def main():
@@ -39,13 +60,20 @@ def main():
 		max_filenum = int(db.execute('SELECT IFNULL(MAX(filenum), 0) FROM pcap').fetchone()[0])
 		infiles = [(infile, max_filenum + i + 1) for i, infile in enumerate(args.infiles)]
 
-		reader = MultiReader(
-			infiles,
-			filter=lambda p: 'ip' in p and 'tcp' in p,
+		options = dict(
+			pcap_filter='tcp' if args.filter is None else f'tcp and ({args.filter})',
 			limit_in=args.limit_in,
 			limit_out=args.limit_out,
-			seconds=args.seconds
+			seconds=args.seconds,
+			start=args.start,
+			mmap=args.mmap,
+			readahead=args.readahead,
+			decompress=args.decompress
 		)
+		if args.jobs is None:
+			reader = MultiReader(infiles, **options)
+		else:
+			reader = ParallelReader(infiles, jobs=args.jobs, chunk_size=args.chunk_size, **options)
 
 		for infile, filenum in infiles:
 			db.execute('insert into pcap values(?,?,?,?,?,?,?,?)', (
@@ -62,16 +90,32 @@ def main():
 		fields = [
 			'sec int', 'nsec int', 'len int',
 			'ip_version int', 'ip_hl int', 'ip_tos int', 'ip_len int', 'ip_id int', 'ip_off int',
-			'ip_ttl int', 'ip_proto int', 'ip_csum int', 'ip_src text', 'ip_dst text', 'ip_options blob',
+			'ip_ttl int', 'ip_proto int', 'ip_csum int', 'ip_src int', 'ip_dst int', 'ip_options blob',
 			'tcp_sport int', 'tcp_dport int', 'tcp_seq int', 'tcp_ack int', 'tcp_len int', 'tcp_flags int',
 			'tcp_win int', 'tcp_csum int', 'tcp_urgent int', 'tcp_options blob',
 			'plen int', 'pcrc int', 'flow int', 'filenum int'
 		]
 
+		tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+		if 'packets' in tables and 'flows' not in tables:
+			raise Exception(f"{args.outfile} has text flows and addresses, write to a new database instead.")
+
 		db.execute(f"CREATE TABLE IF NOT EXISTS packets({','.join(fields)})") #, PRIMARY KEY (sec, nsec)) WITHOUT ROWID""")
 
+		# a is the lower (ip, port) of the two ends of a flow
+		db.execute('CREATE TABLE IF NOT EXISTS flows(flow_id INTEGER PRIMARY KEY, a_ip int, a_port int, b_ip int, b_port int)')
+		db.execute('CREATE UNIQUE INDEX IF NOT EXISTS flows_key ON flows(a_ip, a_port, b_ip, b_port)')
+
+		# packets with dotted addresses and text flows, as they were stored before
+		columns = [field.split()[0] for field in fields]
+		text = {'ip_src': ip_text('ip_src'), 'ip_dst': ip_text('ip_dst'), 'flow': flow_text('flows')}
+		db.execute(f"""CREATE VIEW IF NOT EXISTS packets_text AS
+			SELECT {', '.join(f"{text[c]} AS {c}" if c in text else f"packets.{c}" for c in columns)}
+			FROM packets JOIN flows ON flows.flow_id = packets.flow""")
+
+		flows = FlowIds(db)
+
 		def iter_obj(reader, args):
-			flow = None
 			for pkt, filenum in reader:
 				if args.verbose:
 					print(filenum, pkt.time.sec, pkt.time.nsec)
@@ -79,23 +123,23 @@ def main():
 				if args.checkpoint and reader.n_out % args.checkpoint == 0:
 					print(f"in: {reader.n_read:9d}  out:{reader.n_out:9d}")
 
-				ip = pkt['ip']
-				tcp = pkt['tcp']
+				yield pkt, filenum
 
-				if flow is None:
-					flow = Flow(pkt)
-				else:
-					flow.src.ip, flow.dst.ip = ip.src, ip.dst
-					flow.src.port, flow.dst.port = tcp.sport, tcp.dport
+		# the workers of a ParallelReader have already turned the packets into rows
+		def iter_rows(reader, args):
+			for row in reader:
+				if args.verbose:
+					print(row[-1], row[0], row[1])
 
-				yield (
-					pkt.time.sec, pkt.time.nsec, pkt.header.orig_len,
-					ip.version, ip.ihl, ip.tos, ip.len, ip.id, ip.off, ip.ttl, ip.proto, ip.csum, ip.src, ip.dst, ip.options,
-					tcp.sport, tcp.dport, tcp.seq, tcp.ack, tcp.len, tcp.flags, tcp.win, tcp.csum, tcp.urgent, tcp.options,
-					ip.len - len(ip) - len(tcp), int(payload_checksum(pkt)), repr(flow), filenum
-				)
+				if args.checkpoint and reader.n_out % args.checkpoint == 0:
+					print(f"in: {reader.n_read:9d}  out:{reader.n_out:9d}")
+
+				yield row
+
+		rows = packet_rows(iter_obj(reader, args)) if args.jobs is None else iter_rows(reader, args)
 
-		db.executemany(f"insert into packets values({','.join(['?' for _ in fields])})", iter_obj(reader, args))
+		db.executemany(f"insert into packets values({','.join(['?' for _ in fields])})", flows.intern(rows))
+		db.executemany('insert into flows values(?,?,?,?,?)', flows.new)
 		db.commit()
 
 	except:
@@ -108,23 +152,61 @@ def main():
 
 
 class Reader:
-	def __init__(self, fn):
-		self.pcap = PcapReader(fn)
+	"""
+	The records of one input with their times from its .times sidecar, if it has one.  start
+	and end limit it to the records starting in [start, end) of an uncompressed pcap, read
+	through a memory map; first_record is then the number of the record at start.
+
+	The records pcap_filter rejects aren't skipped by the pcap reader but returned with kept()
+	False, so a merge passes every record in time order whatever the filter.  Records are
+	decoded lazily, so the rejected ones are never decoded.
+	"""
+	def __init__(self, fn, mmap=False, pcap_filter=None, readahead=False, decompress=None, start=None, end=None, first_record=0):
+		self.fn = fn
+		self.filter_expression = pcap_filter
+		self.tests = {}
+		if start is None:
+			self.pcap = open_reader(fn, mmap=mmap, lazy=True, readahead=readahead, decompress=decompress)
+		else:
+			self.pcap = open_reader(fn, mmap=True, start=start, end=end, lazy=True, readahead=readahead)
+		self.first_record = first_record
 		self.nano = self.pcap.header.nano
-		try:
-			self.times = open(fn.rsplit('.', 1)[0] + '.times')
+		self.times = open_times(fn)
+		if self.times:
 			self.nano = True
-			self.pcap.record.time = Timestamp()
-		except:
-			self.times = None
+			self.pcap.record.time = Timestamp(nsec=0)
 		self.n_read = 0
 	@property
 	def record(self):
 		return self.pcap.record
+	@property
+	def n_skipped(self):
+		return self.pcap.n_skipped
 	def close(self):
 		self.pcap.close()
 		if self.times:
 			self.times.close()
+	def kept(self):
+		"""Whether the current record passes pcap_filter."""
+		if self.filter_expression is None:
+			return True
+
+		# compiled per linktype, a pcapng can have interfaces of several
+		header = self.pcap.header
+		test = self.tests.get(header.linktype)
+		if test is None:
+			test = self.tests[header.linktype] = compile_filter(self.filter_expression, header)
+
+		record = self.record
+		return test(record.data, record.offset + len(record.header) - RECORD_HEADER_LEN, record.header.incl_len, record.header.orig_len)
+	def first_ns(self):
+		if self.times:
+			return self.times.first()
+		return first_time(self.fn)
+	def seek_time(self, ns):
+		# records are matched to times lines by position, so with a times file there is no seeking
+		if not self.times:
+			self.pcap.seek_time(Timestamp.from_ns(ns))
 	def __iter__(self):
 		return self
 	def __next__(self):
@@ -132,10 +214,7 @@ class Reader:
 			next(self.pcap)
 
 			if self.times:
-				ts = self.times.readline()
-				sec, nsec = ts.strip().split('.', 1)
-				self.pcap.record.time.sec = int(sec)
-				self.pcap.record.time.nsec = int(nsec)
+				self.pcap.record.time.ns = self.times[self.first_record + self.pcap.count - 1]
 		except:
 			self.close()
 			raise
@@ -147,10 +226,11 @@ class Reader:
 
 
 class MultiReader:
-	def __init__(self, infiles, filter=lambda p: True, limit_in=None, limit_out=None, seconds=None, stop_smallest=False):
+	def __init__(self, infiles, filter=lambda p: True, limit_in=None, limit_out=None, seconds=None, start=None, stop_smallest=False, mmap=False, pcap_filter=None, readahead=False, decompress=None):
 		self.readers = []
 		for fn, filenum in infiles:
-			reader = Reader(fn)
+			# the records the filter rejects go through the merge too, they count towards limit_in and hold back their input like in a merge of everything
+			reader = Reader(fn, mmap=mmap, pcap_filter=pcap_filter, readahead=readahead, decompress=decompress)
 			reader.filenum = filenum
 			self.readers.append(reader)
 		self.header = self.readers[0].pcap.header
@@ -164,18 +244,19 @@ class MultiReader:
 		self.n_read = 0
 		self.n_out = 0
 		self.first_ts = None
-		self.min_index = None
+		self.start_ns = None
 
-		try:
-			for reader in self.readers:
-				reader.next()
-		except StopIteration:
-			raise Exception(f"File {reader.fn} is empty, aborting.")
+		if start is not None:
+			firsts = [ns for ns in (reader.first_ns() for reader in self.readers) if ns is not None]
+			if firsts:
+				self.start_ns = min(firsts) + Timestamp.from_str(str(start)).ns
+				for reader in self.readers:
+					reader.seek_time(self.start_ns)
+
+		self.merge = MergeReader(self.readers, stop_smallest=stop_smallest)
 
 	def close(self):
-		for reader in self.readers:
-			if reader is not None:
-				reader.close()
+		self.merge.close()
 
 	def __iter__(self):
 		return self
@@ -188,63 +269,477 @@ class MultiReader:
 				if self.limit_in is not None and self.n_read >= self.limit_in:
 					raise StopIteration
 
-				if self.min_index is not None:
-					try:
-						self.readers[self.min_index].next()
-					except StopIteration:
-						if self.stop_smallest:
-							raise
+				min_reader = next(self.merge)
+
+				# readers with a times file couldn't seek, and records can be slightly out of order
+				if self.start_ns is not None and min_reader.record.time.ns < self.start_ns:
+					continue
+
+				self.n_read += 1
+
+				if self.limit_in is not None and self.n_read > self.limit_in:
+					raise StopIteration
+
+				if self.filter(min_reader.record) and min_reader.kept():
+					break
+
+			if self.first_ts is None:
+				self.first_ts = min_reader.record.time.ns
 
-						self.readers[self.min_index].close()
-						self.readers[self.min_index] = None
-						self.readers = [r for r in self.readers if r is not None]
+			if self.seconds is not None and min_reader.record.time.ns - self.first_ts >= self.seconds * 10**9:
+				raise StopIteration
+		except:
+			self.close()
+			raise
 
-					self.min_index = None
+		self.n_out += 1
+		return min_reader.record, min_reader.filenum
 
-				for i, reader in enumerate(self.readers):
-					if self.min_index is None or reader.record.time < min_reader.record.time:
-						min_reader = reader
-						self.min_index = i
+class ParallelReader:
+	"""
+	MultiReader's rows decoded by worker processes.  An uncompressed pcap is read by a pool
+	of jobs workers, in one task or, with a .pcapidx index, split at index entries into
+	tasks of about chunk_size bytes; a few tasks per input are kept in flight so the workers
+	stay busy while the merge waits on the input that's behind.  A compressed or pcapng
+	input can only be read from its start, so a process of its own decodes all of it and
+	streams the rows back STREAM_BATCH at a time, with at most STREAM_BATCHES waiting.
+	The rows of each input come back in record order and are merged here by (time, input)
+	like MergeReader does, so the order, limits, start and seconds are the same as
+	MultiReader's.
+	"""
+	def __init__(self, infiles, limit_in=None, limit_out=None, seconds=None, start=None, mmap=False, pcap_filter=None, readahead=False, decompress=None, jobs=None, chunk_size=JOB_CHUNK_SIZE):
+		self.limit_in = limit_in
+		self.limit_out = limit_out
+		self.seconds = seconds
+		self.options = dict(mmap=mmap, pcap_filter=pcap_filter, readahead=readahead, decompress=decompress, )
 
-				if self.min_index is None:
+		self.n_read = 0
+		self.n_out = 0
+		self.first_ts = None
+		self.start_ns = None
+		self.pool = None
+		self.inputs = []
+
+		jobs = jobs or os.cpu_count()
+		in_flight = max(2, -(-2 * jobs // len(infiles)))
+
+		readers = []
+		try:
+			for fn, filenum in infiles:
+				readers.append(Reader(fn, **self.options))
+			self.header = readers[0].pcap.header
+
+			# only uncompressed pcaps go through the pool, the others are streamed
+			if any(splittable(fn) for fn, _ in infiles):
+				self.pool = multiprocessing.Pool(jobs)
+
+			# indexes to split inputs into chunks or to seek in them are built in the pool, all at once
+			indexes = [
+				self.pool.apply_async(input_index, (reader.fn,))
+				if splittable(reader.fn) and (os.path.getsize(reader.fn) > chunk_size or start is not None and not reader.times) else None
+				for reader in readers
+			]
+			indexes = [index.get() if index is not None else None for index in indexes]
+
+			if start is not None:
+				firsts = [reader.times.first() if reader.times else index.first if index is not None else reader.first_ns() for reader, index in zip(readers, indexes)]
+				firsts = [ns for ns in firsts if ns is not None]
+				if firsts:
+					self.start_ns = min(firsts) + Timestamp.from_str(str(start)).ns
+
+			tasks = [self.tasks(reader, filenum, chunk_size, index) for reader, (fn, filenum), index in zip(readers, infiles, indexes)]
+		except:
+			self.close()
+			raise
+		finally:
+			for reader in readers:
+				reader.close()
+
+		try:
+			for (fn, _), input_tasks in zip(infiles, tasks):
+				if splittable(fn):
+					self.inputs.append(InputRows(self.pool, fn, input_tasks, in_flight))
+				else:
+					self.inputs.append(InputStream(fn, input_tasks[0]))
+		except:
+			self.close()
+			raise
+
+		self.merge = heapq.merge(*self.inputs, key=itemgetter(0))
+
+	def tasks(self, reader: Reader, filenum: int, chunk_size: int, index) -> list:
+		"""
+		(fn, filenum, start, end, first_record, start_ns, options) of each task reading the
+		input of reader, split into chunks with its index if it has one.
+		"""
+		fn = reader.fn
+		# records are matched to times lines by position, so with a times file there is no seeking
+		seek_ns = self.start_ns if not reader.times else None
+
+		if index is None:
+			return [(fn, filenum, None, None, 0, seek_ns, self.options)]
+
+		seek = index.find(seek_ns) if seek_ns is not None else None
+
+		# chunks start at index entries, which know their record numbers
+		starts = []
+		for k, offset in enumerate(index.offsets):
+			if not starts or offset - starts[-1][0] >= chunk_size:
+				starts.append((offset, k * index.interval))
+
+		tasks = []
+		for i, (offset, first_record) in enumerate(starts):
+			end = starts[i + 1][0] if i + 1 < len(starts) else None
+			if seek is not None:
+				if end is not None and end <= seek:
+					continue
+				offset = max(offset, seek)
+			tasks.append((fn, filenum, offset, end, first_record, None, self.options))
+
+		return tasks or [(fn, filenum, index.end, None, index.n_records, None, self.options)]
+
+	def close(self):
+		for source in self.inputs:
+			if isinstance(source, InputStream):
+				source.close()
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = None
+
+	def __iter__(self):
+		return self
+	def __next__(self):
+		try:
+			if self.limit_out is not None and self.n_out == self.limit_out:
+				raise StopIteration
+
+			while True:
+				if self.limit_in is not None and self.n_read >= self.limit_in:
 					raise StopIteration
 
+				ns, row = next(self.merge)
+
+				# readers with a times file couldn't seek, and records can be slightly out of order
+				if self.start_ns is not None and ns < self.start_ns:
+					continue
+
 				self.n_read += 1
 
-				if self.filter(min_reader.record):
+				if self.limit_in is not None and self.n_read > self.limit_in:
+					raise StopIteration
+
+				# records the filter rejected come without a row
+				if row is not None:
 					break
 
 			if self.first_ts is None:
-				self.first_ts = float(min_reader.record.time)
+				self.first_ts = ns
 
-			if self.seconds is not None and (float(min_reader.record.time) - self.first_ts) >= self.seconds:
+			if self.seconds is not None and ns - self.first_ts >= self.seconds * 10**9:
 				raise StopIteration
 		except:
 			self.close()
 			raise
 
 		self.n_out += 1
-		return min_reader.record, min_reader.filenum
+		return row
+
+class InputRows:
+	"""
+	The (ns, row) of each record of one input for ParallelReader, from its tasks in order
+	with up to in_flight of them submitted to the pool at a time.
+	"""
+	def __init__(self, pool, fn: str, tasks: list, in_flight: int):
+		self.pool = pool
+		self.fn = fn
+		self.tasks = deque(tasks)
+		self.in_flight = in_flight
+		self.pending = deque()
+		self.rows = iter(())
+		self.empty = True
+		self.submit()
+
+	def submit(self):
+		while self.tasks and len(self.pending) < self.in_flight:
+			self.pending.append(self.pool.apply_async(decode_task, (self.tasks.popleft(),)))
+
+	def __iter__(self):
+		return self
+	def __next__(self):
+		while True:
+			row = next(self.rows, None)
+			if row is not None:
+				self.empty = False
+				return row
+
+			if not self.pending:
+				if self.empty:
+					raise Exception(f"File {self.fn} is empty, aborting.")
+				raise StopIteration
+
+			rows = self.pending.popleft().get()
+			self.submit()
+			self.rows = iter(rows)
+
+class InputStream:
+	"""
+	The (ns, row) of each record of one input for ParallelReader, decoded in a
+	process of its own by stream_task and received in batches through a bounded queue.  If
+	the process ends without finishing, say it was killed, that's an error.
+	"""
+	def __init__(self, fn: str, task):
+		self.fn = fn
+		self.queue = multiprocessing.Queue(STREAM_BATCHES)
+		self.process = multiprocessing.Process(target=stream_task, args=(task, self.queue), daemon=True)
+		self.process.start()
+		self.rows = iter(())
+		self.done = False
+		self.empty = True
+
+	def close(self):
+		if self.process is not None:
+			self.process.terminate()
+			self.process.join()
+			self.process = None
+
+	def get(self):
+		while True:
+			try:
+				return self.queue.get(timeout=STREAM_TIMEOUT)
+			except queue.Empty:
+				if not self.process.is_alive():
+					break
+
+		# the last batches can still be on their way from a process that has just ended
+		try:
+			return self.queue.get(timeout=STREAM_TIMEOUT)
+		except queue.Empty:
+			raise Exception(f"Decoding {self.fn} ended with exit code {self.process.exitcode} before the end of the file, aborting.")
 
-def payload_checksum(pkt):
-	if 'L7' in pkt:
-		return Checksum(bytes(pkt['L7']))
+	def __iter__(self):
+		return self
+	def __next__(self):
+		while True:
+			row = next(self.rows, None)
+			if row is not None:
+				self.empty = False
+				return row
 
-	L3 = pkt['L3']
-	L4 = pkt['L4']
+			if self.done:
+				raise StopIteration
+
+			batch = self.get()
+			if isinstance(batch, Exception):
+				raise batch
+			if batch is None:
+				self.done = True
+				self.close()
+				if self.empty:
+					raise Exception(f"File {self.fn} is empty, aborting.")
+				raise StopIteration
+			self.rows = iter(batch)
+
+def splittable(fn: str) -> bool:
+	"""Whether fn can be read in chunks starting anywhere, an uncompressed classic pcap."""
+	return compression(fn) is None and pcap_format(fn) == 'pcap'
+
+def input_index(fn: str):
+	"""The index of fn from its .pcapidx sidecar if that's up to date, otherwise built without writing one."""
+	return load_index(fn) or build_index(fn, write=False)
+
+def decode_rows(task):
+	"""
+	The (ns, row) of each record of one ParallelReader task, decoded as they're taken.  The
+	records the filter rejects are there too, with a row of None.
+	"""
+	fn, filenum, start, end, first_record, seek_ns, options = task
+	reader = Reader(fn, start=start, end=end, first_record=first_record, **options)
+	# rows come out of packet_rows a checksum batch behind the packets
+	keys = deque()
+
+	def packets():
+		for pkt in reader:
+			kept = reader.kept()
+			keys.append((pkt.time.ns, kept))
+			if kept:
+				yield pkt, filenum
 
-	# IPV4 pseudo header: src, dst, proto, tcp segment length
-	# TCP pseudo header: TCP header without checksum
-	pseudo = L3.bsrc + L3.bdst + struct.pack('!HH', L3.proto, L3.len - len(L3))
-	b = bytes(L4)
+	try:
+		if seek_ns is not None:
+			reader.seek_time(seek_ns)
+
+		for row in packet_rows(packets()):
+			ns, kept = keys.popleft()
+			while not kept:
+				yield ns, None
+				ns, kept = keys.popleft()
+			yield ns, row
+
+		for ns, _ in keys:
+			yield ns, None
+	except:
+		raise
+	finally:
+		reader.close()
 
-	if L4.type == 'tcp':
-		pseudo += b[0:16] + b[18:]
-	elif L4.type == 'udp':
-		pseudo += b[0:6]
+def decode_task(task):
+	"""The rows of a pool task from decode_rows."""
+	return list(decode_rows(task))
 
-	return invert(invert(L4.csum) - sum_words(pseudo))
-#	return Checksum(L4.csum) - pseudo
+def stream_task(task, batches):
+	"""
+	Put the rows of a task from decode_rows on batches STREAM_BATCH at a time, then None.  An
+	exception is put in place of the rest.
+	"""
+	try:
+		batch = []
+		for entry in decode_rows(task):
+			batch.append(entry)
+			if len(batch) == STREAM_BATCH:
+				batches.put(batch)
+				batch = []
+		if batch:
+			batches.put(batch)
+		batches.put(None)
+	except Exception as e:
+		batches.put(e)
+
+def packet_rows(packets):
+	"""
+	The packets table row of each (pkt, filenum), with the payload checksums computed
+	CHECKSUM_BATCH at a time.  The flow column holds the (a_ip, a_port, b_ip, b_port) key
+	of the flow until FlowIds.intern replaces it with its flow_id.
+	"""
+	rows = []
+	payloads = PayloadChecksums()
+
+	def flush():
+		# pcrc is filled in once the checksums of the whole batch are known
+		for row, pcrc in zip(rows, payloads.checksums()):
+			row[-3] = pcrc
+		yield from rows
+		rows.clear()
+
+	for pkt, filenum in packets:
+		ip = pkt['ip']
+		tcp = pkt['tcp']
+		src = int.from_bytes(ip.bsrc, 'big')
+		dst = int.from_bytes(ip.bdst, 'big')
+		sport = tcp.sport
+		dport = tcp.dport
+
+		rows.append([
+			pkt.time.sec, pkt.time.nsec, pkt.header.orig_len,
+			ip.version, ip.ihl, ip.tos, ip.len, ip.id, ip.off, ip.ttl, ip.proto, ip.csum, src, dst, ip.options,
+			sport, dport, tcp.seq, tcp.ack, tcp.len, tcp.flags, tcp.win, tcp.csum, tcp.urgent, tcp.options,
+			ip.len - len(ip) - len(tcp), None,
+			(src, sport, dst, dport) if (src, sport) < (dst, dport) else (dst, dport, src, sport),
+			filenum
+		])
+		payloads.add(pkt)
+
+		if len(rows) == CHECKSUM_BATCH:
+			yield from flush()
+
+	yield from flush()
+
+class FlowIds:
+	"""
+	flow_ids of the flows table by (a_ip, a_port, b_ip, b_port).  Flows already in the
+	database keep theirs, the others are numbered on from the largest as they're first seen
+	and collected in new as flows rows, to be inserted after the packets.
+	"""
+	def __init__(self, db):
+		self.ids = {tuple(row[1:]): row[0] for row in db.execute('SELECT flow_id, a_ip, a_port, b_ip, b_port FROM flows')}
+		self.next_id = max(self.ids.values(), default=0) + 1
+		self.new = []
+
+	def intern(self, rows):
+		ids = self.ids
+		for row in rows:
+			key = row[-2]
+			flow_id = ids.get(key)
+			if flow_id is None:
+				flow_id = ids[key] = self.next_id
+				self.next_id += 1
+				self.new.append((flow_id, *key))
+			row[-2] = flow_id
+			yield row
+
+def ip_text(column: str) -> str:
+	"""SQL for the dotted form of an integer ipv4 address column."""
+	return f"(({column} >> 24) || '.' || ({column} >> 16 & 255) || '.' || ({column} >> 8 & 255) || '.' || ({column} & 255))"
+
+B64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def flow_text(table: str) -> str:
+	"""SQL for repr(tcp_util.Flow) of a flows row, the base64 of the packed ip and port of each end."""
+	def address(ip, port):
+		value = f"({table}.{ip} << 16 | {table}.{port})"
+		return ' || '.join(f"substr('{B64}', ({value} >> {shift} & 63) + 1, 1)" for shift in range(42, -1, -6))
+	return f"({address('a_ip', 'a_port')} || {address('b_ip', 'b_port')})"
+
+class PayloadChecksums:
+	"""
+	record_payload_checksum of a batch of tcp/udp packets.  The ip and transport headers of each
+	packet are copied into one buffer and the pseudo header sums of the whole batch are taken
+	with sum_segments.  Without numpy each checksum is computed as its packet is added.
+	"""
+	def __init__(self):
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+		self.np = numpy
+		self.clear()
+
+	def clear(self):
+		self.data = bytearray()
+		self.packets = []
+
+	def add(self, pkt):
+		if self.np is None:
+			self.packets.append(int(record_payload_checksum(pkt)))
+			return
+
+		L3 = pkt['L3']
+		L4 = pkt['L4']
+		base = pkt.offset
+		l3 = base + L3.offset
+		l4 = base + L4.offset
+		# the transport header as far as it was captured, like bytes(L4)
+		end = min(l4 + L4.len, base + len(pkt))
+
+		start = len(self.data)
+		self.data += pkt.data[l3:end]
+		# flat, seven values per packet
+		self.packets.extend((start, start + l4 - l3, end - l4, L4.type == 'tcp', L3.proto, L3.len - len(L3), L4.csum))
+
+	def checksums(self) -> list:
+		if self.np is None or len(self.packets) == 0:
+			values = self.packets
+			self.clear()
+			return values
+
+		np = self.np
+		start, l4, l4_len, tcp, proto, l4_total, csum = np.array(self.packets, dtype=np.int64).reshape(-1, 7).T
+
+		# the pseudo header of record_payload_checksum as three segments per packet: ip src and dst,
+		# the transport header up to its checksum and what follows the checksum (tcp only)
+		offsets = np.concatenate([start + 12, l4, l4 + 18])
+		lengths = np.concatenate([
+			np.full(len(start), 8),
+			np.minimum(l4_len, np.where(tcp, 16, 6)),
+			np.where(tcp, np.maximum(l4_len - 18, 0), 0)
+		])
+		sums = sum_segments(self.data, offsets, lengths).reshape(3, -1).sum(axis=0)
+		# proto and length packed as network-endian words
+		sums += checksum_endian_transform(proto) + checksum_endian_transform(l4_total)
+
+		values = invert(invert(csum) - sums).tolist()
+		self.clear()
+		return values
 
 
 if __name__ == '__main__':
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import socket
+import struct
+import hashlib
+import argparse
+from pcap.pcap_util import PcapWriter, open_reader
+from generator.checksum import update_checksum16, update_checksum32
+
+def arguments():
+	ap = argparse.ArgumentParser(description='rewrite the ipv4 addresses and tcp/udp ports of a pcap, updating checksums incrementally')
+	ap.add_argument('infile', type=str)
+	ap.add_argument('outfile', type=str)
+	ap.add_argument('--map', action='append', default=[], metavar='OLD=NEW', help='replace address OLD with NEW, may be repeated')
+	ap.add_argument('--port', action='append', default=[], metavar='OLD=NEW', help='replace port OLD with NEW, may be repeated')
+	ap.add_argument('--anonymize', type=str, metavar='KEY', help='replace every address not in --map with a hash of it keyed by KEY')
+	ap.add_argument('--limit', type=int)
+	ap.add_argument('--checkpoint', type=int, help='print a message every X packets')
+	ap.add_argument('--mmap', action='store_true', help='memory-map the input file instead of reading it')
+	return ap.parse_args()
+
+def main():
+	args = arguments()
+
+	rewriter = Rewriter(
+		addresses={socket.inet_aton(old): socket.inet_aton(new) for old, new in (m.split('=', 1) for m in args.map)},
+		ports={int(old): int(new) for old, new in (p.split('=', 1) for p in args.port)},
+		key=args.anonymize.encode() if args.anonymize is not None else None
+	)
+
+	reader = None
+	writer = None
+
+	try:
+		reader = open_reader(args.infile, mmap=args.mmap, lazy=True)
+		writer = PcapWriter(
+			args.outfile,
+			endian=reader.header.endian,
+			nano=reader.header.nano,
+			version=reader.header.version,
+			snaplen=reader.header.snaplen,
+			fcs=reader.header.fcs,
+			linktype=reader.header.linktype
+		)
+
+		for pkt in reader:
+			if args.limit and reader.count > args.limit:
+				break
+
+			writer.write_packet(pkt, data=rewriter.rewrite(pkt))
+
+			if args.checkpoint and reader.count % args.checkpoint == 0:
+				print(reader.count)
+
+		print(f"{writer.count} packets, {rewriter.count} rewritten")
+
+	except:
+		raise
+	finally:
+		if reader is not None:
+			reader.close()
+		if writer is not None:
+			writer.close()
+
+class Rewriter:
+	"""
+	Replaces the addresses and ports of a record in a copy of its packet bytes.  The ip header
+	checksum and the tcp/udp checksum, which covers the addresses through the pseudo header,
+	are patched with update_checksum16/32 for each field that changed, so the payload is never
+	summed again.  Fields that weren't captured are left alone, as is the transport header of
+	a fragment other than the first.
+	"""
+	def __init__(self, addresses: dict = None, ports: dict = None, key: bytes = None):
+		self.addresses = dict(addresses or {})
+		self.ports = dict(ports or {})
+		self.key = key
+		self.count = 0
+
+	def address(self, b: bytes) -> bytes:
+		if b not in self.addresses:
+			if self.key is None:
+				return b
+			self.addresses[b] = hashlib.blake2b(b, key=self.key, digest_size=4).digest()
+		return self.addresses[b]
+
+	def rewrite(self, pkt):
+		"""The packet bytes of pkt with its addresses and ports replaced, None if nothing changed."""
+		if 'ip' not in pkt:
+			return None
+
+		ip = pkt['ip']
+		start = pkt.offset + len(pkt.header)
+		incl_len = pkt.header.incl_len
+		# offsets below are into the packet bytes, which follow the record header
+		l3 = ip.offset - len(pkt.header)
+		if l3 + 20 > incl_len:
+			return None
+
+		changes = []
+		for at, old in ((l3 + 12, ip.bsrc), (l3 + 16, ip.bdst)):
+			new = self.address(old)
+			if new != old:
+				changes.append((at, 4, int.from_bytes(old, 'big'), int.from_bytes(new, 'big')))
+		ip_changes = list(changes)
+
+		# the checksum of the first fragment covers the whole datagram and the pseudo header
+		csum_at = None
+		if (ip.off & 0x1fff) == 0 and ('tcp' in pkt or 'udp' in pkt):
+			L4 = pkt['L4']
+			l4 = L4.offset - len(pkt.header)
+
+			if l4 + 4 <= incl_len:
+				for at, old in ((l4, L4.sport), (l4 + 2, L4.dport)):
+					new = self.ports.get(old, old)
+					if new != old:
+						changes.append((at, 2, old, new))
+
+			csum_at = l4 + (16 if L4.type == 'tcp' else 6)
+			# a udp checksum of 0 means there is none
+			if csum_at + 2 > incl_len or (L4.type == 'udp' and L4.csum == 0):
+				csum_at = None
+
+		if not changes:
+			return None
+
+		data = bytearray(pkt.data[start:start + incl_len])
+
+		ip_csum = ip.csum
+		for _, _, old, new in ip_changes:
+			ip_csum = update_checksum32(ip_csum, old, new)
+		struct.pack_into('!H', data, l3 + 10, ip_csum)
+
+		if csum_at is not None:
+			csum = L4.csum
+			for _, size, old, new in changes:
+				csum = update_checksum32(csum, old, new) if size == 4 else update_checksum16(csum, old, new)
+			if L4.type == 'udp' and csum == 0:
+				csum = 0xffff
+			struct.pack_into('!H', data, csum_at, csum)
+
+		for at, size, _, new in changes:
+			data[at:at + size] = new.to_bytes(size, 'big')
+
+		self.count += 1
+		return data
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import random
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'generator'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pcap'))
+import checksum
+import pcap_util
+
+def segment(rnd, tcp, payload):
+	"""An IPv4 packet carrying payload over tcp, with up to 40 bytes of options, or udp, with a valid checksum; returned with its header length."""
+	src, dst = rnd.randbytes(4), rnd.randbytes(4)
+	if tcp:
+		options = bytes(rnd.randrange(0, 11) * 4)
+		l4 = struct.pack('!HHIIBBHHH', rnd.randrange(1 << 16), rnd.randrange(1 << 16), rnd.randrange(1 << 32), 0, (5 + len(options) // 4) << 4, 0x18, 1000, 0, 0) + options
+	else:
+		l4 = struct.pack('!HHHH', rnd.randrange(1 << 16), rnd.randrange(1 << 16), 8 + len(payload), 0)
+
+	l4 = bytearray(l4 + payload)
+	pseudo = src + dst + struct.pack('!BBH', 0, 6 if tcp else 17, len(l4))
+	struct.pack_into('!H', l4, 16 if tcp else 6, checksum.checksum(pseudo + l4))
+	ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, 0, 64, 6 if tcp else 17, 0, src, dst)
+	return ip + bytes(l4), 20 + len(l4) - len(payload)
+
+@pytest.mark.parametrize('kind', [bytes, bytearray])
+def test_sum_segments_matches_sum_words(kind):
+	pytest.importorskip('numpy')
+	rnd = random.Random(1)
+
+	for size in (1, 2, 3, 64, 301):
+		data = kind(rnd.randbytes(size))
+		# odd and even offsets and lengths, empty segments, overlaps and segments up to the end
+		segments = [(o, rnd.randrange(0, size - o + 1)) for o in (rnd.randrange(size) for _ in range(200))]
+		segments += [(0, size), (size - 1, 1), (size, 0)]
+		offsets, lengths = zip(*segments)
+
+		sums = checksum.sum_segments(data, offsets, lengths)
+		assert sums.tolist() == [checksum.sum_words(bytes(data[o:o + n])) for o, n in segments]
+		assert checksum.checksum_segments(data, offsets, lengths).tolist() == [checksum.checksum(bytes(data[o:o + n])) for o, n in segments]
+
+	assert checksum.sum_segments(b'', [0, 0], [0, 0]).tolist() == [0, 0]
+
+def test_update_checksum_matches_recomputing():
+	rnd = random.Random(2)
+
+	for _ in range(500):
+		data = bytearray(rnd.randbytes(rnd.randrange(4, 60) * 2))
+		csum = checksum.checksum(bytes(data))
+
+		at = rnd.randrange(0, len(data) - 3, 2)
+		if rnd.random() < 0.5:
+			old = int.from_bytes(data[at:at + 2], 'big')
+			new = rnd.choice([0, 0xffff, rnd.randrange(0x10000)])
+			data[at:at + 2] = new.to_bytes(2, 'big')
+			assert checksum.update_checksum16(csum, old, new) == checksum.checksum(bytes(data))
+		else:
+			old = int.from_bytes(data[at:at + 4], 'big')
+			new = rnd.choice([0, 0xffffffff, rnd.randrange(0x100000000)])
+			data[at:at + 4] = new.to_bytes(4, 'big')
+			assert checksum.update_checksum32(csum, old, new) == checksum.checksum(bytes(data))
+
+def test_update_checksum_to_a_zero_sum():
+	rnd = random.Random(3)
+
+	# writing the checksum into its zeroed field leaves a checksum of 0, not 0xffff
+	for _ in range(100):
+		data = bytearray(rnd.randbytes(20))
+		data[10:12] = bytes(2)
+		csum = checksum.checksum(bytes(data))
+		data[10:12] = csum.to_bytes(2, 'big')
+		assert checksum.update_checksum16(csum, 0, csum) == checksum.checksum(bytes(data)) == 0
+
+def test_recover_payload_checksum_matches_checksum(tmp_path):
+	rnd = random.Random(4)
+	packets = []
+
+	for i in range(300):
+		payload = rnd.randbytes(rnd.choice([0, 1, 2, rnd.randrange(1, 200)]))
+		data, header = segment(rnd, i % 2 == 0, payload)
+		packets.append((data, header, checksum.checksum(payload)))
+
+		# with or without the payload in the buffer, at any offset into it
+		for captured in (len(data), header):
+			pad = rnd.randbytes(rnd.randrange(0, 4))
+			buf = pad + data[:captured]
+			assert checksum.recover_payload_checksum(buf, len(pad), len(pad) + 20, len(pad) + header) == packets[-1][2]
+
+	# and of records of the packets captured up to the end of their headers
+	fn = str(tmp_path / 'headers.pcap')
+	with open(fn, 'wb') as f:
+		f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+		for i, (data, header, _) in enumerate(packets):
+			f.write(struct.pack('<IIII', 1, i, header, len(data)) + data[:header])
+	with pcap_util.PcapReader(fn) as reader:
+		assert [checksum.record_payload_checksum(pkt) for pkt in reader] == [csum for _, _, csum in packets]
@@ -0,0 +1,88 @@
+import os
+import sys
+import random
+import struct
+import argparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pcap'))
+import compare
+from pcap_util import open_reader
+
+def write_capture(fn, records):
+	"""A raw IPv4 pcap of (ns, packet) records."""
+	with open(fn, 'wb') as f:
+		f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+		for ns, packet in records:
+			f.write(struct.pack('<IIII', ns // 10**9, ns % 10**9 // 1000, len(packet), len(packet)) + packet)
+
+def packets(rnd, n):
+	return [(10**9 + i * 1000, bytes((0x45,)) + rnd.randbytes(rnd.randrange(20, 80))) for i in range(n)]
+
+def run_diff(fn1, fn2, ignore_time=False, window=1000, mmap=False):
+	report = compare.Report(argparse.Namespace(quiet=True, verbose=False, ignore_time=ignore_time))
+	readers = [open_reader(fn, mmap=mmap, lazy=True) for fn in (fn1, fn2)]
+	try:
+		compare.diff(compare.Records(readers[0]), compare.Records(readers[1]), report, window)
+	finally:
+		for reader in readers:
+			reader.close()
+	return report.equal, report.n_time, report.n_modified, report.n_deleted, report.n_inserted
+
+@pytest.fixture
+def captures(tmp_path):
+	rnd = random.Random(1)
+	a = packets(rnd, 100)
+	b = list(a)
+
+	# one record of each kind, far enough apart not to be confused
+	del b[10]
+	b.insert(30, (a[30][0] + 1, bytes((0x45,)) + rnd.randbytes(40)))
+	b[50] = (b[50][0], b[50][1][:-1] + bytes((b[50][1][-1] ^ 0xff,)))
+	b[70] = (b[70][0] + 5000, b[70][1])
+
+	fn1, fn2 = str(tmp_path / 'a.pcap'), str(tmp_path / 'b.pcap')
+	write_capture(fn1, a)
+	write_capture(fn2, b)
+	return fn1, fn2
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_diff_classifies_records(captures, mmap):
+	fn1, fn2 = captures
+
+	assert run_diff(fn1, fn1, mmap=mmap) == (100, 0, 0, 0, 0)
+	assert run_diff(fn1, fn2, mmap=mmap) == (97, 1, 1, 1, 1)
+	assert run_diff(fn1, fn2, ignore_time=True, mmap=mmap) == (98, 0, 1, 1, 1)
+	assert run_diff(fn2, fn1, mmap=mmap) == (97, 1, 1, 1, 1)
+
+def test_diff_without_a_match_in_the_window(captures):
+	fn1, fn2 = captures
+
+	# with no look ahead the deleted record shifts every record after it out of step
+	equal, _, modified, _, _ = run_diff(fn1, fn2, window=1)
+	assert equal < 97 and modified > 1
+
+def test_first_difference(captures, tmp_path, monkeypatch):
+	fn1, fn2 = captures
+	with open(fn1, 'rb') as f:
+		data = f.read()
+
+	assert compare.first_difference(fn1, fn1) is None
+	assert compare.first_difference(fn1, fn2) == 0
+
+	# the offset of the first block that differs
+	monkeypatch.setattr(compare, 'BLOCK_SIZE', 64)
+	(tmp_path / 'c.pcap').write_bytes(data[:1000] + bytes((data[1000] ^ 1,)) + data[1001:])
+	(tmp_path / 'd.pcap').write_bytes(data + b'\0')
+	assert compare.first_difference(fn1, str(tmp_path / 'c.pcap')) == 960
+	assert compare.first_difference(fn1, str(tmp_path / 'd.pcap')) == len(data) // 64 * 64
+
+def test_prefix_records(captures):
+	fn1, _ = captures
+	with open(fn1, 'rb') as f:
+		data = f.read()
+
+	n, pos = compare.prefix_records(fn1, fn1, len(data) - 1)
+	assert n == 99 and pos < len(data) - 1
+	assert compare.prefix_records(fn1, fn1, len(data)) == (100, len(data))
@@ -0,0 +1,165 @@
+import os
+import gzip
+import sys
+import heapq
+import random
+import struct
+from operator import itemgetter
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pcap_to_db
+
+def write_capture(fn, rnd, n, tcp_share):
+	"""A raw IPv4 pcap of n tcp and udp records at increasing times, returned as (ns, tcp) pairs."""
+	records = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101)]
+	times = []
+	ns = 0
+
+	for i in range(n):
+		# some times repeat, across inputs too, to exercise ties
+		ns += rnd.choice([0, 1000, 2000, 5000])
+		tcp = rnd.random() < tcp_share
+		l4 = struct.pack('!HHIIBBHHH', 1024 + i, 80, i, 0, 0x50, 0x10, 1000, 0, 0) if tcp else struct.pack('!HHHH', 1024 + i, 53, 8, 0)
+		ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), i, 0, 64, 6 if tcp else 17, 0, bytes(4), bytes((10, 0, 0, 1)))
+		packet = ip + l4
+		records.append(struct.pack('<IIII', ns // 10**9, ns % 10**9 // 1000, len(packet), len(packet)) + packet)
+		times.append((ns, tcp))
+
+	with open(fn, 'wb') as f:
+		f.write(b''.join(records))
+	return times
+
+@pytest.fixture
+def inputs(tmp_path):
+	rnd = random.Random(1)
+	infiles, records = [], []
+	for filenum, share in enumerate((0.2, 0.8, 0.5), 1):
+		fn = str(tmp_path / f'{filenum}.pcap')
+		infiles.append((fn, filenum))
+		records += [(ns, filenum, i, tcp) for i, (ns, tcp) in enumerate(write_capture(fn, rnd, 300, share))]
+
+	# every record in merged order, ties to the input listed first
+	return infiles, sorted(records)
+
+def expected(records, limit_in):
+	return [(ns, filenum) for ns, filenum, _, tcp in records[:limit_in] if tcp]
+
+def read_rows(reader_type, infiles, **options):
+	"""(ns, filenum) of each packet a MultiReader or ParallelReader returns."""
+	if reader_type is pcap_to_db.ParallelReader:
+		reader = reader_type(infiles, pcap_filter='tcp', jobs=2, chunk_size=2000, **options)
+		rows = lambda: ((row[0] * 10**9 + row[1], row[-1]) for row in reader)
+	else:
+		reader = reader_type(infiles, pcap_filter='tcp', **options)
+		rows = lambda: ((pkt.time.ns, filenum) for pkt, filenum in reader)
+	try:
+		return list(rows())
+	finally:
+		reader.close()
+
+@pytest.mark.parametrize('limit_in', [1, 7, 100, 333, 600, 899, 900, 2000])
+def test_limit_in_counts_filtered_records_in_merged_order(inputs, limit_in):
+	infiles, records = inputs
+	reader = pcap_to_db.MultiReader(infiles, pcap_filter='tcp', limit_in=limit_in)
+	try:
+		out = [(pkt.time.ns, filenum) for pkt, filenum in reader]
+	finally:
+		reader.close()
+
+	assert out == expected(records, limit_in)
+	assert reader.n_read == min(limit_in, len(records))
+
+@pytest.mark.parametrize('limit_in', [7, 333, 900])
+def test_parallel_limit_in_matches(inputs, limit_in):
+	infiles, records = inputs
+	reader = pcap_to_db.ParallelReader(infiles, pcap_filter='tcp', limit_in=limit_in, jobs=2, chunk_size=2000)
+	try:
+		out = [(row[0] * 10**9 + row[1], row[-1]) for row in reader]
+	finally:
+		reader.close()
+
+	assert out == expected(records, limit_in)
+
+def test_parallel_streams_compressed_inputs(inputs, monkeypatch):
+	infiles, records = inputs
+	gzipped = []
+	for fn, filenum in infiles:
+		with open(fn, 'rb') as f, gzip.open(fn + '.gz', 'wb') as out:
+			out.write(f.read())
+		gzipped.append((fn + '.gz', filenum))
+
+	# small batches so each input comes back in many of them
+	monkeypatch.setattr(pcap_to_db, 'STREAM_BATCH', 16)
+	reader = pcap_to_db.ParallelReader(gzipped, pcap_filter='tcp', limit_in=700, jobs=2)
+	try:
+		out = [(row[0] * 10**9 + row[1], row[-1]) for row in reader]
+	finally:
+		reader.close()
+
+	assert reader.pool is None
+	assert out == expected(records, 700)
+
+@pytest.mark.parametrize('reader_type', [pcap_to_db.MultiReader, pcap_to_db.ParallelReader])
+def test_input_without_matches_runs_out(inputs, tmp_path, reader_type):
+	infiles, records = inputs
+	fn = str(tmp_path / 'udp.pcap')
+	write_capture(fn, random.Random(2), 50, 0)
+
+	assert read_rows(reader_type, infiles + [(fn, 4)]) == expected(records, None)
+	assert read_rows(reader_type, [(fn, 4)] + infiles) == expected(records, None)
+
+@pytest.mark.parametrize('reader_type', [pcap_to_db.MultiReader, pcap_to_db.ParallelReader])
+def test_input_without_records_is_an_error(inputs, tmp_path, reader_type):
+	infiles, _ = inputs
+	fn = str(tmp_path / 'empty.pcap')
+	write_capture(fn, random.Random(2), 0, 0)
+
+	with pytest.raises(Exception, match='is empty'):
+		read_rows(reader_type, infiles + [(fn, 4)])
+
+@pytest.mark.parametrize('reader_type', [pcap_to_db.MultiReader, pcap_to_db.ParallelReader])
+@pytest.mark.parametrize('limit_in', [None, 250])
+def test_rejected_records_keep_their_place_in_the_merge(tmp_path, reader_type, limit_in):
+	rnd = random.Random(3)
+	infiles, per_file = [], []
+	for filenum in (1, 2):
+		fn = str(tmp_path / f'{filenum}.pcap')
+		# .times sidecars can be slightly out of order, a rejected record then holds back its input
+		times = [(max(0, ns + rnd.randrange(-20000, 20000)), tcp) for ns, tcp in write_capture(fn, rnd, 300, 0.5)]
+		with open(str(tmp_path / f'{filenum}.times'), 'w') as f:
+			f.writelines(f'{ns // 10**9}.{ns % 10**9:09d}\n' for ns, _ in times)
+		infiles.append((fn, filenum))
+		per_file.append([(ns, filenum, tcp) for ns, tcp in times])
+
+	merged = list(heapq.merge(*per_file, key=itemgetter(0)))
+
+	assert read_rows(reader_type, infiles, limit_in=limit_in) == [(ns, filenum) for ns, filenum, tcp in merged[:limit_in] if tcp]
+
+def test_parallel_reports_a_stream_that_died(inputs, monkeypatch):
+	infiles, _ = inputs
+	fn = infiles[0][0]
+	with open(fn, 'rb') as f, gzip.open(fn + '.gz', 'wb') as out:
+		out.write(f.read())
+
+	# the process has to block on the queue well before the end of its input
+	monkeypatch.setattr(pcap_to_db, 'STREAM_BATCH', 1)
+	monkeypatch.setattr(pcap_to_db, 'STREAM_BATCHES', 1)
+	monkeypatch.setattr(pcap_to_db, 'STREAM_TIMEOUT', 0.1)
+	reader = pcap_to_db.ParallelReader([(fn + '.gz', 1)], jobs=1)
+	try:
+		reader.inputs[0].process.kill()
+		with pytest.raises(Exception, match='exit code'):
+			list(reader)
+	finally:
+		reader.close()
+
+@pytest.mark.parametrize('start', [None, 0])
+def test_parallel_leaves_no_index_behind(inputs, tmp_path, start):
+	infiles, records = inputs
+
+	out = read_rows(pcap_to_db.ParallelReader, infiles, start=start)
+
+	assert out == expected(records, None)
+	assert not list(tmp_path.glob('*.pcapidx'))
@@ -0,0 +1,259 @@
+import os
+import sys
+import gzip
+import itertools
+import random
+import socket
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pcap'))
+import pcap_util
+
+def write_capture(fn, rnd, n):
+	"""A raw IPv4 pcap of n tcp and udp records, slightly out of time order, returned as the time of each in ns."""
+	records = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101)]
+	times = []
+	ns = 10**9
+
+	for i in range(n):
+		ns += rnd.choice([0, 1000, 2000, 5000])
+		at = max(0, ns + rnd.choice([0, 0, 0, -3000, 4000])) // 1000 * 1000
+		tcp = rnd.random() < 0.5
+		l4 = struct.pack('!HHIIBBHHH', 1024 + i, 80, i, 0, 0x50, 0x10, 1000, 0, 0) if tcp else struct.pack('!HHHH', 1024 + i, 53, 8, 0)
+		payload = rnd.randbytes(rnd.randrange(0, 40))
+		ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4) + len(payload), i, 0, 64, 6 if tcp else 17, 0, bytes(4), bytes((10, 0, 0, 1)))
+		packet = ip + l4 + payload
+		records.append(struct.pack('<IIII', at // 10**9, at % 10**9 // 1000, len(packet), len(packet)) + packet)
+		times.append(at)
+
+	with open(fn, 'wb') as f:
+		f.write(b''.join(records))
+	return times
+
+def convert(fn, out, kind):
+	"""Copy the pcap fn to out gzipped or as a pcapng."""
+	if kind == 'gz':
+		with open(fn, 'rb') as f, gzip.open(out, 'wb') as g:
+			g.write(f.read())
+		return
+
+	with pcap_util.PcapReader(fn) as reader:
+		writer = pcap_util.PcapngWriter(out, linktype=reader.header.linktype)
+		try:
+			for pkt in reader:
+				writer.write_packet(pkt)
+		finally:
+			writer.close()
+
+@pytest.fixture
+def capture(tmp_path):
+	fn = str(tmp_path / 'in.pcap')
+	return fn, write_capture(fn, random.Random(1), 500)
+
+def test_index_find_matches_linear_scan(capture):
+	fn, times = capture
+	index = pcap_util.build_index(fn, interval=16)
+
+	with open(fn, 'rb') as f:
+		data = f.read()
+	offsets, pos = [], 24
+	for _ in times:
+		offsets.append(pos)
+		pos += pcap_util.RECORD_HEADER_LEN + struct.unpack_from('<I', data, pos + 8)[0]
+
+	assert index.first == times[0] and index.n_records == len(times) and index.end == pos
+	assert pcap_util.load_index(fn).offsets == index.offsets
+
+	for ns in sorted(set(times)) + [times[0] - 1, max(times) + 1]:
+		# the first record in file order at or after ns
+		expected = next((offset for offset, t in zip(offsets, times) if t >= ns), pos)
+		assert index.find(ns) == expected, ns
+
+@pytest.mark.parametrize('kind', ['pcap', 'mmap', 'gz', 'pcapng'])
+def test_seek_time_matches_linear_scan(capture, tmp_path, kind):
+	fn, times = capture
+	if kind in ('gz', 'pcapng'):
+		convert(fn, str(tmp_path / f'in.{kind}'), kind)
+		fn = str(tmp_path / f'in.{kind}')
+
+	for ns in [times[0], times[0] + 12345, times[len(times) // 2], max(times), max(times) + 1]:
+		with pcap_util.open_reader(fn, mmap=kind == 'mmap') as reader:
+			reader.seek_time(pcap_util.Timestamp.from_ns(ns))
+			k = next((k for k, t in enumerate(times) if t >= ns), len(times))
+			assert [pkt.time.ns for pkt in reader] == times[k:], ns
+
+	assert pcap_util.first_time(fn) == times[0]
+
+def test_pcapng_batches_match_pcap(capture, tmp_path):
+	pytest.importorskip('numpy')
+	fn, _ = capture
+	convert(fn, str(tmp_path / 'in.pcapng'), 'pcapng')
+
+	with pcap_util.open_reader(fn, filter='tcp') as pcap, pcap_util.open_reader(str(tmp_path / 'in.pcapng'), filter='tcp') as pcapng:
+		while True:
+			a, b = pcap.read_batch(64), pcapng.read_batch(64)
+			# offsets are into each reader's own buffer
+			assert [a[k].tolist() for k in a.dtype.names if k != 'offset'] == [b[k].tolist() for k in b.dtype.names if k != 'offset']
+			if len(a) == 0:
+				break
+
+		assert pcap.n_skipped == pcapng.n_skipped > 0
+
+def test_pcapng_round_trip(capture, tmp_path):
+	fn, times = capture
+	out = str(tmp_path / 'out.pcapng')
+
+	# every other packet on a second interface, in ns
+	writer = pcap_util.PcapngWriter(out, linktype=101)
+	nano = writer.add_interface(linktype=101, nano=True)
+	expected = []
+	with pcap_util.PcapReader(fn) as reader:
+		for k, pkt in enumerate(reader):
+			interface = nano if k % 2 else 0
+			writer.write_packet(pkt, interface=interface)
+			expected.append((interface, pkt.time.ns, pkt.header.orig_len, bytes(pkt[len(pkt.header):])))
+	writer.close()
+
+	# a second section appended after the first
+	with pcap_util.PcapReader(fn) as reader:
+		writer = pcap_util.PcapngWriter(out, append=True, linktype=101)
+		for pkt in reader:
+			writer.write_packet(pkt)
+		writer.close()
+	expected += [(0, ns, orig_len, body) for _, ns, orig_len, body in expected]
+
+	with pcap_util.open_reader(out) as reader:
+		assert isinstance(reader, pcap_util.PcapngReader)
+		assert [(pkt.header.interface, pkt.time.ns, pkt.header.orig_len, bytes(pkt[len(pkt.header):])) for pkt in reader] == expected
+
+	# and back to a classic pcap, record for record
+	back = str(tmp_path / 'back.pcap')
+	with pcap_util.open_reader(out) as reader:
+		writer = pcap_util.PcapWriter(back, endian='<', linktype=101, snaplen=65535)
+		for pkt in itertools.islice(reader, len(times)):
+			writer.write_packet(pkt)
+		writer.close()
+
+	with open(fn, 'rb') as f, open(back, 'rb') as g:
+		assert f.read()[24:] == g.read()[24:]
+
+ADDRESSES = ['10.0.0.1', '10.1.2.3', '192.168.0.5', '172.16.0.9']
+PORTS = [53, 80, 443, 1024, 1050, 5000]
+
+def filter_capture(fn, rnd, n, linktype):
+	"""A pcap of n ipv4 tcp, udp, icmp and other packets and a few ipv6 ones, returned as the fields of each."""
+	l2 = bytes(12) + b'\x08\x00' if linktype == 1 else b''
+	records = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, linktype)]
+	packets = []
+
+	for i in range(n):
+		fields = dict(version=4, proto=rnd.choice([6, 6, 17, 17, 1, 47]), src=rnd.choice(ADDRESSES), dst=rnd.choice(ADDRESSES), sport=rnd.choice(PORTS), dport=rnd.choice(PORTS))
+		if rnd.random() < 0.05:
+			fields['version'] = 6
+		proto = fields['proto']
+
+		if proto == 6:
+			l4 = struct.pack('!HHIIBBHHH', fields['sport'], fields['dport'], i, 0, 0x50, 0x10, 1000, 0, 0)
+		elif proto == 17:
+			l4 = struct.pack('!HHHH', fields['sport'], fields['dport'], 8, 0)
+		else:
+			l4 = struct.pack('!BBHHH', 8, 0, 0, i, 0)
+		payload = rnd.randbytes(rnd.randrange(0, 200))
+		ip = struct.pack('!BBHHHBBH4s4s', fields['version'] << 4 | 5, 0, 20 + len(l4) + len(payload), i, 0, 64, proto, 0, socket.inet_aton(fields['src']), socket.inet_aton(fields['dst']))
+		packet = l2 + ip + l4 + payload
+		fields['len'] = len(packet)
+
+		records.append(struct.pack('<IIII', 1, i, len(packet), len(packet)) + packet)
+		packets.append(fields)
+
+	with open(fn, 'wb') as f:
+		f.write(b''.join(records))
+	return packets
+
+def ported(f):
+	return f['version'] == 4 and f['proto'] in (6, 17)
+
+def in_net(address, net):
+	value, bits = net.split('/')
+	mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+	return int.from_bytes(socket.inet_aton(address), 'big') & mask == int.from_bytes(socket.inet_aton(value), 'big') & mask
+
+FILTERS = {
+	'ip': lambda f: f['version'] == 4,
+	'tcp': lambda f: f['version'] == 4 and f['proto'] == 6,
+	'udp': lambda f: f['version'] == 4 and f['proto'] == 17,
+	'icmp': lambda f: f['version'] == 4 and f['proto'] == 1,
+	'proto 47': lambda f: f['version'] == 4 and f['proto'] == 47,
+	'ip proto 17': lambda f: f['version'] == 4 and f['proto'] == 17,
+	'dst port 80': lambda f: ported(f) and f['dport'] == 80,
+	'port 53': lambda f: ported(f) and 53 in (f['sport'], f['dport']),
+	'tcp src port 1024': lambda f: f['version'] == 4 and f['proto'] == 6 and f['sport'] == 1024,
+	'udp port 443': lambda f: f['version'] == 4 and f['proto'] == 17 and 443 in (f['sport'], f['dport']),
+	'portrange 1000-1100': lambda f: ported(f) and any(1000 <= p <= 1100 for p in (f['sport'], f['dport'])),
+	'dst portrange 50-500': lambda f: ported(f) and 50 <= f['dport'] <= 500,
+	'host 10.0.0.1': lambda f: f['version'] == 4 and '10.0.0.1' in (f['src'], f['dst']),
+	'src host 192.168.0.5': lambda f: f['version'] == 4 and f['src'] == '192.168.0.5',
+	'dst net 10.0.0.0/8': lambda f: f['version'] == 4 and in_net(f['dst'], '10.0.0.0/8'),
+	'net 172.16.0.0/12': lambda f: f['version'] == 4 and (in_net(f['src'], '172.16.0.0/12') or in_net(f['dst'], '172.16.0.0/12')),
+	'len > 150': lambda f: f['len'] > 150,
+	'len = 48': lambda f: f['len'] == 48,
+	'less 60': lambda f: f['len'] <= 60,
+	'greater 200': lambda f: f['len'] >= 200,
+	'tcp and not dst port 80': lambda f: f['version'] == 4 and f['proto'] == 6 and f['dport'] != 80,
+	'udp or icmp': lambda f: f['version'] == 4 and f['proto'] in (17, 1),
+	'not (tcp or udp)': lambda f: not ported(f),
+	'! ip': lambda f: f['version'] != 4,
+	'host 10.0.0.1 and (port 80 or port 53)': lambda f: f['version'] == 4 and '10.0.0.1' in (f['src'], f['dst']) and ported(f) and bool({80, 53} & {f['sport'], f['dport']}),
+	# and and or group left to right
+	'tcp || udp && port 53': lambda f: ported(f) and 53 in (f['sport'], f['dport']),
+	'icmp or tcp and src port 80': lambda f: f['version'] == 4 and f['proto'] in (1, 6) and ported(f) and f['sport'] == 80,
+}
+
+@pytest.mark.parametrize('linktype', [101, 1])
+def test_compile_filter_matches_decoded_fields(tmp_path, linktype):
+	fn = str(tmp_path / 'filter.pcap')
+	packets = filter_capture(fn, random.Random(5), 1000, linktype)
+	with open(fn, 'rb') as f:
+		data = f.read()
+	header = pcap_util.PcapHeader(data[:24])
+
+	offsets, pos = [], 24
+	for _ in packets:
+		offsets.append(pos)
+		pos += pcap_util.RECORD_HEADER_LEN + struct.unpack_from('<I', data, pos + 8)[0]
+
+	for expression, expected in FILTERS.items():
+		test = pcap_util.compile_filter(expression, header)
+		matches = [bool(test(data, o, f['len'], f['len'])) for o, f in zip(offsets, packets)]
+		assert matches == [expected(f) for f in packets], expression
+		assert 0 < sum(matches) < len(packets), expression
+
+		with pcap_util.open_reader(fn, filter=expression) as reader:
+			assert [pkt.header.ts_usec for pkt in reader] == [i for i, match in enumerate(matches) if match], expression
+			assert reader.n_skipped == len(packets) - sum(matches)
+
+def test_compile_filter_protocols_match_records(tmp_path):
+	# records captured short of their transport header match a protocol as `'tcp' in record` says
+	fn = str(tmp_path / 'filter.pcap')
+	rnd = random.Random(6)
+	filter_capture(fn, rnd, 300, 101)
+	with open(fn, 'rb') as f:
+		data = f.read()
+
+	records, pos = [data[:24]], 24
+	while pos < len(data):
+		incl_len = struct.unpack_from('<I', data, pos + 8)[0]
+		cut = rnd.choice([incl_len, 0, 20, 21, 23, 24, 27, 28])
+		records.append(data[pos:pos + 8] + struct.pack('<II', min(cut, incl_len), incl_len) + data[pos + 16:pos + 16 + min(cut, incl_len)])
+		pos += 16 + incl_len
+	with open(fn, 'wb') as f:
+		f.write(b''.join(records))
+
+	for proto in ('ip', 'tcp', 'udp', 'icmp'):
+		with pcap_util.PcapReader(fn, lazy=True) as reader:
+			expected = [pkt.header.ts_usec for pkt in reader if proto in pkt]
+		with pcap_util.PcapReader(fn, lazy=True, filter=proto) as reader:
+			assert [pkt.header.ts_usec for pkt in reader] == expected, proto
+		assert 0 < len(expected) < 300
@@ -0,0 +1,142 @@
+import io
+import os
+import sys
+import heapq
+import random
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pcap'))
+import rapcap
+
+pytest.importorskip('numpy')
+
+def capture(rnd, n, snaplen):
+	"""A little-endian pcap of n records of random lengths, some cut to snaplen."""
+	records = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, snaplen, 101)]
+	for i in range(n):
+		orig_len = rnd.choice([rnd.randrange(1, snaplen + 1), rnd.randrange(1, 3 * snaplen)])
+		incl_len = min(orig_len, snaplen)
+		records.append(struct.pack('<IIII', i, 0, incl_len, orig_len) + rnd.randbytes(incl_len))
+	return bytearray(b''.join(records))
+
+def record_offsets(data):
+	offsets, pos = [], 24
+	while pos + rapcap.HEADER_LEN <= len(data):
+		offsets.append(pos)
+		pos += rapcap.HEADER_LEN + struct.unpack_from('<I', data, pos + rapcap.INCL_OFFSET)[0]
+	return offsets
+
+def heap_find_start(file, snap_len, endian):
+	"""The heap walk find_start was vectorized from: chains are tested one header at a time in file order."""
+	packet_len = snap_len + rapcap.HEADER_LEN
+	chunk = file.read(packet_len + rapcap.HEADER_LEN - 1)
+	file_offset = 0
+
+	# [next_index, last_index] of each chain
+	solutions = []
+	for index in range(packet_len):
+		incl_len = rapcap.validate_header(chunk, index, snap_len, endian)
+		if incl_len != 0:
+			heapq.heappush(solutions, [index + incl_len + rapcap.HEADER_LEN, index])
+
+	if len(solutions) == 0:
+		raise ValueError("No solution")
+
+	while len(chunk) >= rapcap.HEADER_LEN:
+		max_index = file_offset + len(chunk) - rapcap.HEADER_LEN
+
+		while len(solutions) > 0 and solutions[0][0] <= max_index:
+			s = heapq.heappop(solutions)
+
+			# chains arriving at the same header merge there
+			while len(solutions) > 0 and solutions[0][0] == s[0]:
+				s[1] = s[0]
+				heapq.heappop(solutions)
+
+			incl_len = rapcap.validate_header(chunk, s[0] - file_offset, snap_len, endian)
+			if incl_len != 0:
+				if len(solutions) == 0:
+					return s[1]
+				s[0] += incl_len + rapcap.HEADER_LEN
+				heapq.heappush(solutions, s)
+
+		if len(solutions) == 0:
+			raise ValueError("No solution")
+
+		file_offset += packet_len
+		chunk = chunk[packet_len:] + file.read(packet_len)
+
+	raise ValueError("Parallel solutions")
+
+def outcome(find_start, data, pos, snaplen):
+	f = io.BytesIO(bytes(data))
+	f.seek(pos)
+	try:
+		return find_start(f, snaplen, '<')
+	except ValueError as e:
+		return str(e)
+
+@pytest.mark.parametrize('kind', ['clean', 'truncated', 'corrupted'])
+def test_find_start_matches_heap_walk(kind):
+	rnd = random.Random(kind)
+
+	for _ in range(300):
+		snaplen = rnd.choice([64, 128, 256, 1500])
+		data = capture(rnd, rnd.randrange(5, 80), snaplen)
+
+		if kind == 'truncated':
+			data = data[:rnd.randrange(25, len(data))]
+		elif kind == 'corrupted':
+			for _ in range(rnd.randrange(1, 4)):
+				at = rnd.randrange(24, len(data))
+				data[at:at + 4] = rnd.randbytes(4)
+
+		pos = rnd.randrange(24, len(data))
+		assert outcome(rapcap.find_start, data, pos, snaplen) == outcome(heap_find_start, data, pos, snaplen), (kind, pos, snaplen)
+
+def test_find_start_on_clean_capture_finds_a_record():
+	rnd = random.Random(1)
+	data = capture(rnd, 200, 256)
+	offsets = set(record_offsets(data))
+
+	# false chains merging into the true one can move the answer past the first record
+	for pos in rnd.sample(range(24, max(offsets) - 20 * 300), 100):
+		assert pos + outcome(rapcap.find_start, data, pos, 256) in offsets
+
+def test_repair_skips_only_a_corrupted_record(tmp_path):
+	rnd = random.Random(2)
+	data = capture(rnd, 2000, 256)
+	offsets = record_offsets(data)
+
+	data[offsets[300] + rapcap.INCL_OFFSET:offsets[300] + rapcap.ORIG_OFFSET] = b'\xff\xff\xff\x7f'
+	(tmp_path / 'in.pcap').write_bytes(data)
+
+	damaged = rapcap.repair(tmp_path / 'in.pcap', tmp_path / 'out.pcap')
+
+	assert damaged == [(offsets[300], offsets[301] - offsets[300])]
+	assert (tmp_path / 'out.pcap').read_bytes() == data[:offsets[300]] + data[offsets[301]:]
+
+@pytest.mark.parametrize('n_chunks', [2, 8, 32])
+def test_chunk_ranges_on_clean_capture(tmp_path, n_chunks):
+	rnd = random.Random(n_chunks)
+	data = capture(rnd, 3000, 1500)
+	offsets = set(record_offsets(data))
+	(tmp_path / 'in.pcap').write_bytes(data)
+
+	ranges = rapcap.chunk_ranges(tmp_path / 'in.pcap', n_chunks)
+
+	assert len(ranges) == n_chunks
+	assert ranges[0][0] == 24 and ranges[-1][1] == len(data)
+	assert all(start in offsets for start, _ in ranges)
+	assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+
+def test_chunk_ranges_warns_when_merging_chunks(tmp_path):
+	rnd = random.Random(3)
+	(tmp_path / 'in.pcap').write_bytes(capture(rnd, 10, 1500))
+
+	with pytest.warns(UserWarning, match='merged into the previous one'):
+		ranges = rapcap.chunk_ranges(tmp_path / 'in.pcap', 64)
+
+	assert 0 < len(ranges) < 64
@@ -0,0 +1,88 @@
+import os
+import sys
+import random
+import socket
+import struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import rewrite
+from generator.checksum import checksum
+
+MAPPED = socket.inet_aton('10.0.0.1')
+TO = socket.inet_aton('192.168.1.7')
+OTHER = socket.inet_aton('10.0.0.2')
+
+def packet(rnd, i, tcp, src, dst, udp_csum=True):
+	"""An IPv4 tcp or udp packet to or from port 80 with valid checksums; the udp checksum is left out unless udp_csum."""
+	sport, dport = (80, 1024 + i) if i % 2 else (1024 + i, 80)
+	payload = rnd.randbytes(rnd.randrange(0, 41))
+	if tcp:
+		segment = bytearray(struct.pack('!HHIIBBHHH', sport, dport, rnd.randrange(1 << 32), 0, 0x50, 0x18, 1000, 0, 0) + payload)
+	else:
+		segment = bytearray(struct.pack('!HHHH', sport, dport, 8 + len(payload), 0) + payload)
+
+	if tcp or udp_csum:
+		pseudo = src + dst + struct.pack('!BBH', 0, 6 if tcp else 17, len(segment))
+		# a udp checksum that comes out 0 is sent as 0xffff
+		struct.pack_into('!H', segment, 16 if tcp else 6, checksum(pseudo + segment) or (0 if tcp else 0xffff))
+
+	ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(segment), i, 0, 64, 6 if tcp else 17, 0, src, dst))
+	struct.pack_into('!H', ip, 10, checksum(bytes(ip)))
+	return bytes(ip + segment)
+
+def write_capture(fn, packets):
+	with open(fn, 'wb') as f:
+		f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+		for i, p in enumerate(packets):
+			f.write(struct.pack('<IIII', 1, i, len(p), len(p)) + p)
+
+def read_packets(fn):
+	with open(fn, 'rb') as f:
+		data = f.read()
+	packets, pos = [], 24
+	while pos < len(data):
+		n = struct.unpack_from('<I', data, pos + 8)[0]
+		packets.append(data[pos + 16:pos + 16 + n])
+		pos += 16 + n
+	return packets
+
+def test_rewrite_keeps_checksums_valid(tmp_path, monkeypatch, capsys):
+	rnd = random.Random(1)
+	packets = []
+	for i in range(200):
+		src, dst = rnd.choice([(MAPPED, OTHER), (OTHER, MAPPED), (OTHER, OTHER)])
+		packets.append(packet(rnd, i, rnd.random() < 0.5, src, dst, udp_csum=i % 10 != 0))
+
+	infile, outfile = str(tmp_path / 'in.pcap'), str(tmp_path / 'out.pcap')
+	write_capture(infile, packets)
+	monkeypatch.setattr(sys, 'argv', ['rewrite.py', infile, outfile, '--map', '10.0.0.1=192.168.1.7', '--port', '80=8080', '--anonymize', 'key'])
+	rewrite.main()
+	assert capsys.readouterr().out.splitlines()[-1] == '200 packets, 200 rewritten'
+
+	rewritten = read_packets(outfile)
+	assert len(rewritten) == len(packets)
+	anonymized = set()
+
+	for old, new in zip(packets, rewritten):
+		assert len(new) == len(old) and checksum(new[:20]) == 0
+
+		# the mapped address, the other one hashed, and port 80 moved to 8080
+		for at in (12, 16):
+			if old[at:at + 4] == MAPPED:
+				assert new[at:at + 4] == TO
+			else:
+				assert new[at:at + 4] != OTHER
+				anonymized.add(new[at:at + 4])
+		assert struct.unpack_from('!HH', new, 20) == tuple(8080 if port == 80 else port for port in struct.unpack_from('!HH', old, 20))
+
+		proto = old[9]
+		csum_at = 20 + (16 if proto == 6 else 6)
+		assert new[csum_at + 2:] == old[csum_at + 2:]
+		if proto == 17 and old[csum_at:csum_at + 2] == bytes(2):
+			assert new[csum_at:csum_at + 2] == bytes(2)
+		else:
+			pseudo = new[12:20] + struct.pack('!BBH', 0, proto, len(new) - 20)
+			assert checksum(pseudo + new[20:]) == 0
+
+	# the same address is always hashed the same way
+	assert len(anonymized) == 1